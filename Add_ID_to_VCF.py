@@ -2,18 +2,31 @@
 """Replace the ID column of a VCF with a sequential identifier, defined
 internally. This is just to help keep track of variants throughout the project
 that will get filtered for selected for various reasons. The IDs will be of the
-form Prefix_Num, where Num is a zero-padded integer. Takes three arguments:
+form Prefix_Num, where Num is a zero-padded integer. Takes three arguments,
+and an optional fourth:
     1) VCF to process
     2) Prefix
-    3) Number of zeroes to pad"""
+    3) Number of zeroes to pad
+    4) Output file (default: standard output). If it ends in .gz, it is
+       written as BGZF, compressed in other threads, so it can be indexed
+       with tabix.
+A gzipped VCF is decompressed in other threads while the IDs are added."""
 
 import sys
-import gzip
+import bgzf
+import vcf_parse
+
+#   Number of threads to decompress a gzipped VCF with, and to compress a
+#   gzipped output with
+THREADS = 4
+#   Compression level of a gzipped output
+LEVEL = 6
 
 try:
     vcf = sys.argv[1]
     pref = sys.argv[2]
     pad = int(sys.argv[3])
+    out = sys.argv[4] if len(sys.argv) > 4 else None
 except IndexError:
     sys.stderr.write(__doc__ + '\n')
     exit(1)
@@ -22,20 +35,34 @@ except ValueError:
     exit(2)
 
 
-def main(v, pre, pval):
+def open_output(o):
+    """Open the output: BGZF if the name ends in .gz, plain text if it does
+    not, and standard output if there is no name."""
+    if o is None:
+        return sys.stdout
+    elif o.endswith('.gz'):
+        return bgzf.Writer(o, LEVEL, THREADS)
+    else:
+        return open(o, 'w')
+
+
+def main(v, pre, pval, o):
     """Main function."""
     varnum = 0
-    with gzip.open(v, 'rt') as f:
-        for line in f:
-            if line.startswith('#'):
-                print(line.strip())
-            else:
-                tmp = line.strip().split('\t')
-                snpid = pre + '_' + str(varnum).zfill(pval)
-                newline = [tmp[0], tmp[1], snpid] + tmp[3:]
-                print('\t'.join(newline))
-                varnum += 1
+    handle = open_output(o)
+    with vcf_parse.VCFReader(v, threads=THREADS) as f:
+        for line in f.header_lines():
+            handle.write(line.strip() + '\n')
+        for rec in f:
+            #   Only the fixed columns are split off; the samples are written
+            #   back as they were
+            tmp = list(rec.fields())
+            tmp[vcf_parse.ID] = pre + '_' + str(varnum).zfill(pval)
+            handle.write('\t'.join(tmp) + '\n')
+            varnum += 1
+    if o is not None:
+        handle.close()
     return
 
 
-main(vcf, pref, pad)
+main(vcf, pref, pad, out)
@@ -4,26 +4,49 @@ listed in a VCF, accounting for the missing data among each comparison. The
 diagonal is the number of called genotypes and the observed heterozygosity.
 Takes two argument:
     1) VCF (gzipped)
-    2) Output prefix"""
+    2) Output prefix
+And optionally --jobs N, to count in N processes, and --checkpoint FILE, to
+save the partial sums every so often (--checkpoint-minutes, 30 by default) and
+pick up from them if the run is killed.
 
+Sites are read in blocks. Each block is decoded into a sites x samples matrix
+of small genotype codes, and the matrices are updated for all pairs of samples
+at once, with matrix products for the number of sites. The matrices are
+symmetric, so only the upper triangle is stored, packed into a flat array.
+
+With --jobs, a bgzipped VCF is split on BGZF block boundaries, and each piece
+is counted in its own process; a VCF compressed with plain gzip is read by the
+main process and handed out in chunks of lines. The partial matrices are added
+up at the end. In this mode the differences are summed exactly, as whole
+numbers of sixths, so the result does not depend on how the VCF was split. It
+can differ from the serial result in the last digits of _Pi.csv, since the
+serial mode adds 2/3 one site at a time as a float, like it always has.
+
+Wherever the main process reads the VCF, it is decompressed in other threads
+(--threads) while the sites are counted.
+
+Requires NumPy, bgzf.py, and vcf_parse.py."""
+
+import argparse
 import gzip
+import multiprocessing
+import os
 import sys
+import time
 
-OUT_PREFIX = sys.argv[2]
+import numpy
 
-PI_OUT = OUT_PREFIX + '_Pi.csv'
-NSITE_OUT = OUT_PREFIX + '_L.csv'
+import bgzf
+import vcf_parse
 
-
-def make_square_mat(n, fill=0):
-    """Return a square matrix of dimension n, populated with the specified
-    fill value."""
-    m = [
-            [fill for i in range(0, n)]
-            for j
-            in range(0, n)
-        ]
-    return m
+# How many sites to decode and add to the matrices at a time
+BLOCK_SIZE = 4096
+# With --jobs, how many pieces to split the VCF into for each process, so
+# that the processes finish at about the same time
+PIECES_PER_JOB = 4
+# Row and column indices of the packed pairs, for each number of samples. See
+# pair_indices().
+PAIRS = {}
 
 
 def pairwise_diff(g1, g2, auto=False):
@@ -58,61 +81,471 @@ def pairwise_diff(g1, g2, auto=False):
         return None
 
 
-# start iterating through the VCF
-nsites_proc = 0
-with gzip.open(sys.argv[1], 'rt') as f:
-    for line in f:
-        if line.startswith('##'):
-            continue
-        elif line.startswith('#CHROM'):
-            hdr = line.strip().split('\t')
-            samples = hdr[9:]
-            nsamp = len(samples)
-            # Make square matrices for both the number of sites and the number
-            # of pairwise differences.
-            l_mat = make_square_mat(nsamp)
-            d_mat = make_square_mat(nsamp)
+class GenotypeCodes(vcf_parse.GenotypeTable):
+    """Hands out a small integer code for each distinct genotype string, and
+    keeps tables of what pairwise_diff() gives for every pair of codes. With
+    0/1 calls, the codes amount to the alternate allele count, plus one for
+    missing data."""
+
+    def __init__(self):
+        vcf_parse.GenotypeTable.__init__(self)
+        # For each pair of codes, whether the comparison counts, and the
+        # average pairwise difference (0 where it does not count), also as a
+        # whole number of sixths. The same for a sample compared with itself.
+        self.defined = numpy.zeros((0, 0), dtype=numpy.float32)
+        self.apd = numpy.zeros((0, 0), dtype=numpy.float64)
+        self.sixths = numpy.zeros((0, 0), dtype=numpy.float32)
+        self.auto_defined = numpy.zeros(0, dtype=numpy.int64)
+        self.auto_apd = numpy.zeros(0, dtype=numpy.int64)
+
+    def added(self, gt):
+        """Fill in the tables for the newest genotype."""
+        n = len(self.genotypes)
+        defined = numpy.zeros((n, n), dtype=numpy.float32)
+        apd_tab = numpy.zeros((n, n), dtype=numpy.float64)
+        defined[:n-1, :n-1] = self.defined
+        apd_tab[:n-1, :n-1] = self.apd
+        for i in range(n):
+            for a, b in ((i, n - 1), (n - 1, i)):
+                apd = pairwise_diff(self.genotypes[a], self.genotypes[b])
+                if apd is not None:
+                    defined[a, b] = 1
+                    apd_tab[a, b] = apd
+        self.defined = defined
+        self.apd = apd_tab
+        # Every value pairwise_diff() gives is a whole number of sixths
+        self.sixths = numpy.round(apd_tab * 6).astype(numpy.float32)
+        # Comparing a sample with itself only ever gives 0 or 1
+        new = self.genotypes[-1]
+        apd = pairwise_diff(new, new, auto=True)
+        self.auto_defined = numpy.append(self.auto_defined, apd is not None)
+        self.auto_apd = numpy.append(
+            self.auto_apd, int(apd) if apd is not None else 0)
+
+
+def pair_indices(nsamp):
+    """Return the row and column of every pair of samples (i < j), in the
+    order they are packed in a PairwiseTotals. These are cached, since they
+    are needed for every block."""
+    if nsamp not in PAIRS:
+        PAIRS[nsamp] = numpy.triu_indices(nsamp, 1)
+    return PAIRS[nsamp]
+
+
+def packed_row(packed, diag, i, nsamp):
+    """Unpack row i of a symmetric matrix, given its packed upper triangle and
+    its diagonal."""
+    # Pair (j, i) for j < i is in row j of the upper triangle, which starts
+    # at j*(2*nsamp - j - 1)/2
+    j = numpy.arange(i)
+    above = packed.take(j * (2 * nsamp - j - 1) // 2 + i - j - 1)
+    start = i * (2 * nsamp - i - 1) // 2
+    below = packed[start:start + nsamp - i - 1]
+    return numpy.concatenate([above, diag[i:i+1], below])
+
+
+class PairwiseTotals(object):
+    """The running totals for every pair of samples: the number of sites
+    compared (l_mat), and the summed average pairwise differences (d_mat).
+    Both are symmetric, so only the pairs i < j are kept, packed row by row
+    into a flat array. The diagonal is kept in l_diag and d_diag. If exact,
+    d_mat holds the differences in sixths, as integers, so that totals from
+    different parts of the VCF can be added up without any rounding."""
+
+    def __init__(self, nsamp, exact=False):
+        self.nsamp = nsamp
+        self.exact = exact
+        npairs = nsamp * (nsamp - 1) // 2
+        self.l_mat = numpy.zeros(npairs, dtype=numpy.int64)
+        if exact:
+            self.d_mat = numpy.zeros(npairs, dtype=numpy.int64)
         else:
-            if nsites_proc % 1000 == 0:
-                sys.stderr.write('Processed ' + str(nsites_proc) + ' sites.\n')
-            tmp = line.strip().split('\t')
-            # Pass a replacement statement over the genotypes to replace them
-            # with values that can be easily processed
-            gts = [
-                './.'
-                if x.split(':')[0] == '.'
-                else x.split(':')[0]
-                for x
-                in tmp[9:]
-                ]
-            # Iterate through all pairs of the genotypes and calculate the
-            # average pairwise difference
-            for i, geno1 in enumerate(gts):
-                for j, geno2 in enumerate(gts):
-                    # Calculate the pairwise difference
-                    if i == j:
-                        apd = pairwise_diff(geno1, geno2, auto=True)
-                    else:
-                        apd = pairwise_diff(geno1, geno2, auto=False)
-                    # If the pairwise difference value is defined, then we have
-                    # a case where we can increment the nsites and diff mat.
-                    # Remember that 0.0 evaluates to boolean False. Ugh.
-                    if apd is not None:
-                        l_mat[i][j] += 1
-                        d_mat[i][j] += apd
-            nsites_proc += 1
-
-# Now we want to print out the matrix
-handle = open(NSITE_OUT, 'w')
-handle.write(','.join([''] + samples) + '\n')
-for s, row in zip(samples, l_mat):
-    towrite = ','.join([s] + [str(x) for x in row]) + '\n'
-    handle.write(towrite)
-handle.close()
-
-handle = open(PI_OUT, 'w')
-handle.write(','.join([''] + samples) + '\n')
-for s, row in zip(samples, d_mat):
-    towrite = ','.join([s] + [str(x) for x in row]) + '\n'
-    handle.write(towrite)
-handle.close()
+            self.d_mat = numpy.zeros(npairs, dtype=numpy.float64)
+        self.l_diag = numpy.zeros(nsamp, dtype=numpy.int64)
+        self.d_diag = numpy.zeros(nsamp, dtype=numpy.int64)
+        self.nsites = 0
+        self.gcodes = GenotypeCodes()
+        self.block = []
+
+    def add_line(self, line):
+        """Decode the genotypes of a VCF data line, and add it to the
+        matrices once a block of sites has built up."""
+        # Pass a replacement statement over the genotypes to replace them
+        # with codes that can be easily processed
+        gts = vcf_parse.VCFRecord(line).gt()
+        code = self.gcodes.code
+        self.block.append([code('./.' if g == '.' else g) for g in gts])
+        self.nsites += 1
+        if len(self.block) == BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Add the sites that are waiting to the matrices."""
+        if self.block:
+            add_block(numpy.array(self.block, dtype=numpy.int32), self)
+        self.block = []
+
+    def add(self, other):
+        """Add the totals from another (exact) PairwiseTotals to these."""
+        self.l_mat += other.l_mat
+        self.d_mat += other.d_mat
+        self.l_diag += other.l_diag
+        self.d_diag += other.d_diag
+        self.nsites += other.nsites
+
+    def save(self, fname, vcf, **progress):
+        """Write the totals to a checkpoint file, along with how far through
+        the VCF they go. The file is replaced in one step, so a run that is
+        killed while writing leaves the last checkpoint in place."""
+        self.flush()
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            numpy.savez(
+                f,
+                l_mat=self.l_mat,
+                d_mat=self.d_mat,
+                l_diag=self.l_diag,
+                d_diag=self.d_diag,
+                nsites=self.nsites,
+                exact=self.exact,
+                vcf=vcf_key(vcf),
+                **progress)
+        os.replace(tmp, fname)
+
+    def load(self, fname, vcf):
+        """Read the totals back from a checkpoint file written by save().
+        Returns the rest of what was saved, which says how far through the VCF
+        the totals go. Exits if the checkpoint does not go with this VCF."""
+        saved = numpy.load(fname)
+        if saved['vcf'].tolist() != vcf_key(vcf) or \
+                saved['l_diag'].shape != self.l_diag.shape:
+            sys.stderr.write(
+                fname + ' is a checkpoint for a different VCF. Remove it to '
+                'start over.\n')
+            exit(1)
+        if bool(saved['exact']) != self.exact:
+            sys.stderr.write(
+                fname + ' was written ' +
+                ('with' if saved['exact'] else 'without') + ' --jobs, and can '
+                'only be resumed the same way.\n')
+            exit(1)
+        self.l_mat = saved['l_mat']
+        self.d_mat = saved['d_mat']
+        self.l_diag = saved['l_diag']
+        self.d_diag = saved['d_diag']
+        self.nsites = int(saved['nsites'])
+        return dict([
+            (k, saved[k])
+            for k
+            in saved.files
+            if k not in ('l_mat', 'd_mat', 'l_diag', 'd_diag', 'nsites',
+                         'exact', 'vcf')
+            ])
+
+    def matrices(self):
+        """Return the finished packed matrices and diagonals of the number of
+        sites and the average pairwise differences."""
+        self.flush()
+        if self.exact:
+            d_mat = self.d_mat / 6.0
+        else:
+            d_mat = self.d_mat
+        return (self.l_mat, self.l_diag, d_mat, self.d_diag)
+
+
+def add_block(block, totals):
+    """Add the comparisons for a block of sites to a PairwiseTotals. block is a
+    sites x samples array of genotype codes."""
+    gcodes = totals.gcodes
+    rows, cols = pair_indices(totals.nsamp)
+    present = numpy.unique(block)
+    # One 0/1 indicator matrix per genotype code in the block
+    onehot = dict([(u, (block == u).astype(numpy.float32)) for u in present])
+    # The products give both triangles; the counts for the block are built
+    # up in full, and then just the upper triangle is added to the totals.
+    # Single precision is exact for counts up to 2**24.
+    l_block = numpy.zeros((totals.nsamp, totals.nsamp), dtype=numpy.float32)
+    if totals.exact:
+        d_block = numpy.zeros_like(l_block)
+    for u in present:
+        # For every site where sample i has genotype u, count the comparisons
+        # with every sample j that has a genotype that can be compared to u.
+        w_l = sum([gcodes.defined[u, v] * onehot[v] for v in present])
+        if numpy.any(w_l):
+            l_block += numpy.dot(onehot[u].T, w_l)
+        if totals.exact:
+            w_d = sum([gcodes.sixths[u, v] * onehot[v] for v in present])
+            if numpy.any(w_d):
+                d_block += numpy.dot(onehot[u].T, w_d)
+        per_sample = onehot[u].sum(axis=0).astype(numpy.int64)
+        totals.l_diag += gcodes.auto_defined[u] * per_sample
+        totals.d_diag += gcodes.auto_apd[u] * per_sample
+    totals.l_mat += l_block[rows, cols].astype(numpy.int64)
+    if totals.exact:
+        totals.d_mat += d_block[rows, cols].astype(numpy.int64)
+    else:
+        # The differences are floats (2/3 is not exact), so they are added
+        # one site at a time, in the order of the VCF. This keeps the sums
+        # identical, to the last digit, to adding them up one pair at a time.
+        # For each site, apd[codes] has a row per sample; pair (i, j) is at
+        # column codes[j] of row i.
+        base = rows * len(gcodes.genotypes)
+        for codes in block:
+            totals.d_mat += gcodes.apd[codes].ravel().take(
+                base + codes.take(cols))
+    return
+
+
+def write_matrix(fname, samples, packed, diag, counts=None):
+    """Write a packed symmetric matrix as a CSV with sample names on the rows
+    and columns. If the packed matrix and diagonal of comparison counts are
+    given, the values are written as floats, except where no comparisons were
+    made, which are written as 0."""
+    nsamp = len(samples)
+    handle = open(fname, 'w')
+    handle.write(','.join([''] + samples) + '\n')
+    for i, s in enumerate(samples):
+        row = packed_row(packed, diag, i, nsamp).tolist()
+        if counts is not None:
+            n_row = packed_row(counts[0], counts[1], i, nsamp).tolist()
+            vals = [str(x) if n else '0' for x, n in zip(row, n_row)]
+        else:
+            vals = [str(x) for x in row]
+        handle.write(','.join([s] + vals) + '\n')
+    handle.close()
+
+
+def vcf_key(vcf):
+    """The size and modification time of the VCF, to tell whether a
+    checkpoint goes with it."""
+    st = os.stat(vcf)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description=('Calculate average pairwise differences between all '
+                     'samples in a VCF, accounting for missing data. Writes '
+                     'PREFIX_Pi.csv and PREFIX_L.csv.'),
+        add_help=True)
+    parser.add_argument('vcf', metavar='VCF', help='Gzipped VCF')
+    parser.add_argument('prefix', metavar='PREFIX', help='Output prefix')
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        required=False,
+        type=int,
+        help=('Number of processes to count with. Works best with a '
+              'bgzipped VCF. Defaults to 1'),
+        default=1)
+    parser.add_argument(
+        '--threads',
+        '-t',
+        required=False,
+        type=int,
+        help=('Number of threads to decompress the VCF with, in the process '
+              'that reads it. Defaults to ' + str(bgzf.DEFAULT_THREADS)),
+        default=bgzf.DEFAULT_THREADS)
+    parser.add_argument(
+        '--checkpoint',
+        '-c',
+        required=False,
+        help=('Save the partial sums to this file as the run goes, and '
+              'resume from it if it already exists. It is removed when the '
+              'run finishes.'),
+        default=None)
+    parser.add_argument(
+        '--checkpoint-minutes',
+        required=False,
+        type=float,
+        help='Minutes between checkpoints. Defaults to 30',
+        default=30)
+    args = parser.parse_args()
+    return args
+
+
+def read_samples(vcf):
+    """Return the sample names from the #CHROM line of the VCF."""
+    with gzip.open(vcf, 'rt') as f:
+        for line in f:
+            if line.startswith('#CHROM'):
+                return line.strip().split('\t')[9:]
+            elif not line.startswith('#'):
+                break
+    sys.stderr.write('No #CHROM line in ' + vcf + '\n')
+    exit(1)
+
+
+class Checkpointer(object):
+    """Saves a PairwiseTotals to the checkpoint file every so often. Does
+    nothing if there is no checkpoint file."""
+
+    def __init__(self, fname, vcf, minutes):
+        self.fname = fname
+        self.vcf = vcf
+        self.interval = minutes * 60
+        self.last = time.time()
+
+    def resume(self, totals):
+        """Load the totals from the checkpoint, if there is one. Returns what
+        was saved about how far the run got, or None."""
+        if not self.fname or not os.path.isfile(self.fname):
+            return None
+        progress = totals.load(self.fname, self.vcf)
+        sys.stderr.write(
+            'Resuming from ' + self.fname + ' after ' + str(totals.nsites) +
+            ' sites.\n')
+        return progress
+
+    def due(self):
+        """Whether it is time for another checkpoint."""
+        return self.fname and time.time() - self.last >= self.interval
+
+    def save(self, totals, **progress):
+        totals.save(self.fname, self.vcf, **progress)
+        self.last = time.time()
+
+    def finish(self):
+        """Remove the checkpoint once the outputs are written."""
+        if self.fname and os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+
+def count_serial(vcf, ckpt, threads=None):
+    """Count every site in the VCF in this process, with the decompression
+    done in threads threads. Returns the samples and the PairwiseTotals."""
+    samples = read_samples(vcf)
+    totals = PairwiseTotals(len(samples))
+    progress = ckpt.resume(totals)
+    # start iterating through the VCF. It is read as bytes, so we can keep
+    # track of how far into the uncompressed VCF we are, for checkpoints.
+    offset = int(progress['offset']) if progress else 0
+    with bgzf.LineReader(vcf, threads, binary=True, start=offset) as f:
+        for raw in f:
+            offset += len(raw)
+            if raw.startswith(b'#'):
+                continue
+            if totals.nsites % 1000 == 0:
+                sys.stderr.write(
+                    'Processed ' + str(totals.nsites) + ' sites.\n')
+            totals.add_line(raw.decode())
+            # Checkpoints are only taken when the matrices are up to date
+            if not totals.block and ckpt.due():
+                ckpt.save(totals, offset=offset)
+    return (samples, totals)
+
+
+def count_piece(task):
+    """Count the sites in a piece of a bgzipped VCF, in a worker process. task
+    is the VCF, the number of samples, and the start and end offsets of the
+    piece. Returns the start, and the PairwiseTotals."""
+    vcf, nsamp, start, end = task
+    totals = PairwiseTotals(nsamp, exact=True)
+    for line in bgzf.read_lines(vcf, start, end):
+        if not line.startswith('#'):
+            totals.add_line(line)
+    totals.flush()
+    return (start, totals)
+
+
+def count_lines(task):
+    """Count the sites in a chunk of VCF data lines, in a worker process. task
+    is the number of samples, the lines, and how far into the uncompressed VCF
+    the chunk ends. Returns the end, and the PairwiseTotals."""
+    nsamp, lines, end = task
+    totals = PairwiseTotals(nsamp, exact=True)
+    for line in lines:
+        totals.add_line(line)
+    totals.flush()
+    return (end, totals)
+
+
+def line_chunks(vcf, nsamp, offset=0, chunk_size=BLOCK_SIZE * PIECES_PER_JOB,
+                threads=None):
+    """Read the data lines of a gzipped VCF from offset into the uncompressed
+    data, and yield them in chunks. The VCF is decompressed in a background
+    thread."""
+    chunk = []
+    with bgzf.LineReader(vcf, threads, binary=True, start=offset) as f:
+        for raw in f:
+            offset += len(raw)
+            if raw.startswith(b'#'):
+                continue
+            chunk.append(raw.decode())
+            if len(chunk) == chunk_size:
+                yield (nsamp, chunk, offset)
+                chunk = []
+    if chunk:
+        yield (nsamp, chunk, offset)
+
+
+def count_parallel(vcf, jobs, ckpt):
+    """Count the sites in the VCF in jobs processes. Returns the samples and
+    the summed PairwiseTotals."""
+    samples = read_samples(vcf)
+    nsamp = len(samples)
+    totals = PairwiseTotals(nsamp, exact=True)
+    progress = ckpt.resume(totals)
+    pool = multiprocessing.Pool(jobs)
+    if bgzf.is_bgzf(vcf):
+        pieces = bgzf.split_blocks(vcf, jobs * PIECES_PER_JOB)
+        starts = [p[0] for p in pieces]
+        done = []
+        if progress:
+            # The pieces depend on --jobs, so it has to be the same as before
+            if progress['starts'].tolist() != starts:
+                sys.stderr.write(
+                    ckpt.fname + ' was written with a different --jobs, and '
+                    'can only be resumed with the same one.\n')
+                exit(1)
+            done = progress['done'].tolist()
+        tasks = [
+            (vcf, nsamp, start, end)
+            for start, end
+            in pieces
+            if start not in done
+            ]
+        for start, part in pool.imap_unordered(count_piece, tasks):
+            totals.add(part)
+            done.append(start)
+            sys.stderr.write('Processed ' + str(totals.nsites) + ' sites.\n')
+            if ckpt.due():
+                ckpt.save(totals, starts=starts, done=done)
+    else:
+        sys.stderr.write(
+            vcf + ' is not bgzipped, so it will be read by one process and '
+            'handed out in chunks.\n')
+        offset = int(progress['offset']) if progress else 0
+        # Chunks come back in order, so everything up to the end of the last
+        # one has been counted
+        for end, part in pool.imap(count_lines,
+                                   line_chunks(vcf, nsamp, offset)):
+            totals.add(part)
+            sys.stderr.write('Processed ' + str(totals.nsites) + ' sites.\n')
+            if ckpt.due():
+                ckpt.save(totals, offset=end)
+    pool.close()
+    pool.join()
+    return (samples, totals)
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    ckpt = Checkpointer(args.checkpoint, args.vcf, args.checkpoint_minutes)
+    if args.jobs > 1:
+        samples, totals = count_parallel(args.vcf, args.jobs, ckpt)
+    else:
+        samples, totals = count_serial(args.vcf, ckpt, args.threads)
+    l_mat, l_diag, d_mat, d_diag = totals.matrices()
+    # Now we want to print out the matrix
+    write_matrix(args.prefix + '_L.csv', samples, l_mat, l_diag)
+    write_matrix(args.prefix + '_Pi.csv', samples, d_mat, d_diag,
+                 (l_mat, l_diag))
+    ckpt.finish()
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -2,29 +2,50 @@
 
 #   A script to count the number of variants per contig for the Morex genome
 #   assembly. This doesn't really make sense to do for a complete reference
+#   With --region or --regions-file, only the variants in those regions are
+#   counted; a bgzipped VCF with a .tbi or .csi index is only read where the
+#   regions are.
 
-import sys
+import argparse
+import vcf_parse
+
+parser = argparse.ArgumentParser(
+    description='Count the variants on each contig of a VCF.',
+    add_help=True)
+parser.add_argument('vcf', metavar='VCF', help='VCF to count')
+parser.add_argument(
+    '--region',
+    '-r',
+    required=False,
+    help=('Only use the variants in this region, given as chrom, '
+          'chrom:start, or chrom:start-end (1-based).'),
+    default=None)
+parser.add_argument(
+    '--regions-file',
+    '-R',
+    required=False,
+    help='Only use the variants in the regions in this BED file.',
+    default=None)
+args = parser.parse_args()
+regions = vcf_parse.get_regions(args.region, args.regions_file)
 
 #   create a dictionary
 #   this won't matter because we don't have order anyway
 contigs = {}
-with open(sys.argv[1], 'r') as f:
-    for line in f:
-        if line.startswith('#'):
-            continue
+with vcf_parse.VCFReader(args.vcf, regions) as f:
+    for rec in f:
+        #   Only the first column of each line is split off
+        chrom = rec.chrom
+        if chrom not in contigs:
+            #   If it's a contig we are seeing for the first time, then we
+            #   add a new value to the dictionary, starting at 1 since this
+            #   is a real count
+            contigs[chrom] = 1
         else:
-            tmp = line.strip().split('\t')
-            chrom = tmp[0]
-            if chrom not in contigs:
-                #   If it's a contig we are seeing for the first time, then we
-                #   add a new value to the dictionary, starting at 1 since this
-                #   is a real count
-                contigs[chrom] = 1
-            else:
-                #   Otherwise, we have seen it already, and we increment it
-                contigs[chrom] += 1
+            #   Otherwise, we have seen it already, and we increment it
+            contigs[chrom] += 1
 
 #   Print it out
-#   use iteritems() since it creates an iterator rather than a list
-for ctg, count in contigs.iteritems():
-    print ctg + '\t' + str(count)
+#   items() gives an iterator in Python 3, rather than a list
+for ctg, count in contigs.items():
+    print(ctg + '\t' + str(count))
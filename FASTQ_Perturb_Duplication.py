@@ -4,12 +4,21 @@
     2) R2 FASTQ to process (gzipped)
 
 Parameters for the duplication are defined as constants within the script.
+The inputs are decompressed in other threads while the reads are processed,
+and the outputs are compressed as BGZF in other threads.
 """
 
 import sys
-import gzip
 import numpy
 
+import bgzf
+
+# Number of threads to decompress each input with, and to compress each
+# output with
+THREADS = 2
+# Compression level of the outputs. They are written as BGZF, so they can be
+# indexed and read back in parallel.
+LEVEL = 6
 # Define the probability that a sequence will be duplicated
 PROB_DUP = 0.0001
 # Define the sequence duplication levels that are to be expected
@@ -18,12 +27,12 @@ DUP_LEVELS = [10, 50, 100, 500, 10000, 15000]
 DUP_PROBS = [0.1, 0.1, 0.3, 0.3, 0.1, 0.1]
 
 # Iterate through the two files
-r1 = gzip.open(sys.argv[1], 'rt')
-r2 = gzip.open(sys.argv[2], 'rt')
+r1 = bgzf.LineReader(sys.argv[1], THREADS)
+r2 = bgzf.LineReader(sys.argv[2], THREADS)
 
 # Make output handles based on the filenames of the inputs
-r1_o = gzip.open(sys.argv[1].replace('.fastq.gz', '_Dup.fastq.gz'), 'wt')
-r2_o = gzip.open(sys.argv[2].replace('.fastq.gz', '_Dup.fastq.gz'), 'wt')
+r1_o = bgzf.Writer(sys.argv[1].replace('.fastq.gz', '_Dup.fastq.gz'), LEVEL, THREADS)
+r2_o = bgzf.Writer(sys.argv[2].replace('.fastq.gz', '_Dup.fastq.gz'), LEVEL, THREADS)
 # Then, iterate through the reads in both
 for r1_name, r1_nuc, r1_comment, r1_qual, r2_name, r2_nuc, r2_comment, r2_qual in zip(r1, r1, r1, r1, r2, r2, r2, r2):
     # decide if we are going to duplicate
@@ -60,6 +69,8 @@ for r1_name, r1_nuc, r1_comment, r1_qual, r2_name, r2_nuc, r2_comment, r2_qual i
         r1_o.write(new_r1)
         r2_o.write(new_r2)
 
+r1.close()
+r2.close()
 r1_o.flush()
 r2_o.flush()
 r1_o.close()
@@ -4,12 +4,16 @@ one argument:
     1) FASTQ to process (gzipped)
 
 Parameters for the quality alteration are given in the script as constants.
+The input is decompressed in other threads while the reads are processed.
 """
 
 import sys
-import gzip
 import numpy
 
+import bgzf
+
+# Number of threads to decompress the input with
+THREADS = 4
 # Define the FASTQ quality offset here
 OFFSET = 33
 # Define the proportion of reads to perturb as a probability
@@ -25,7 +29,7 @@ QUAL_PROBS = [0.35, 0.25, 0.20, 0.1, 0.1]
 # Iterate through the FASTQ, four lines at a time. We are making a possibly
 # strong assumption here about the way the file is formatted. Each piece of
 # information should be on one line.
-with gzip.open(sys.argv[1], 'rt') as f:
+with bgzf.LineReader(sys.argv[1], THREADS) as f:
     for seqname, nucleotides, comment, quals in zip(f, f, f, f):
         # First, decide if we are going to alter the quals
         perturb = numpy.random.binomial(1, PROB_PERTURB, size=1)[0]
@@ -6,11 +6,20 @@ arguments:
     3) R2 (gzipped)
 Will also take a predefined number of non-target reads, to keep the subset
 looking like a "real" dataset. This is for a tutorial that uses a subset of
-the genome.
+the genome. The inputs are decompressed in other threads while the reads are
+checked, and the outputs are compressed as BGZF in other threads.
 """
 
 import sys
-import gzip
+
+import bgzf
+
+# Number of threads to decompress each input with, and to compress each
+# output with
+THREADS = 2
+# Compression level of the outputs. They are written as BGZF, so they can be
+# indexed and read back in parallel.
+LEVEL = 6
 
 # Set the number of non-target fragments here. The dataset is going to use a
 # set of reads mapped to chromosome 19 of mm10. There are about 900,000
@@ -28,11 +37,11 @@ with open(sys.argv[1], 'r') as f:
         TARGET_FRAGMENTS.add(fwd_read_name)
 
 # Iterate through the R1 and R2 files to keep the target reads
-r1 = gzip.open(sys.argv[2], 'rt')
-r2 = gzip.open(sys.argv[3], 'rt')
+r1 = bgzf.LineReader(sys.argv[2], THREADS)
+r2 = bgzf.LineReader(sys.argv[3], THREADS)
 
-r1_o = gzip.open(sys.argv[2].replace('.fastq.gz', '_Sub.fastq.gz'), 'wt')
-r2_o = gzip.open(sys.argv[3].replace('.fastq.gz', '_Sub.fastq.gz'), 'wt')
+r1_o = bgzf.Writer(sys.argv[2].replace('.fastq.gz', '_Sub.fastq.gz'), LEVEL, THREADS)
+r2_o = bgzf.Writer(sys.argv[3].replace('.fastq.gz', '_Sub.fastq.gz'), LEVEL, THREADS)
 
 KEPT_OFF_TARGET = 0
 for r1_name, r1_nuc, r1_comment, r1_qual, r2_name, r2_nuc, r2_comment, r2_qual in zip(r1, r1, r1, r1, r2, r2, r2, r2):
@@ -53,6 +62,8 @@ for r1_name, r1_nuc, r1_comment, r1_qual, r2_name, r2_nuc, r2_comment, r2_qual i
         else:
             continue
 
+r1.close()
+r2.close()
 r1_o.flush()
 r1_o.close()
 r2_o.flush()
@@ -1,14 +1,35 @@
 #!/usr/bin/env python
 
-#   A script to apply various arbitrary filters to a VCF. The three filters
-#   I have included here are genotype quality score, number of heterozygous
+#   A script to apply various arbitrary filters to a VCF. The default filters
+#   are site quality, genotype quality score, number of heterozygous
 #   samples, number of samples with missing data, and read depth.
 #   All threshholds can be adjusted by modifying the parameters at the top
-#   of the script. This script was written with the VCF output from the
-#   GATK version 2.8.1. The format may change in the future.
-#   This script writes the filtered VCF lines to standard output
+#   of the script, or replaced with a filter expression given with --include
+#   or --exclude, such as
+#       QUAL>=40 && n_het<=2 && min(FMT/DP)>=5
+#   See vcf_filter.py for what the expressions can use. FORMAT subfields are
+#   looked up by name, so any FORMAT layout works, not just the GT:AD:DP:GQ:PL
+#   of the GATK version 2.8.1. The records are filtered in blocks, with each
+#   value worked out for every site and sample of a block at once.
+#   This script writes the header and the filtered VCF lines to standard
+#   output, or to --output (bgzipped if it ends in .gz). With --threads, the
+#   VCF is read in big chunks of whole lines, which are filtered in a pool of
+#   processes and written back in the order they were read. With --region or
+#   --regions-file, only the variants in those regions are filtered and
+#   written; a bgzipped VCF with a .tbi or .csi index is only read where the
+#   regions are. With --stats, it also writes how many sites each of the
+#   default criteria removes, histograms of QUAL, DP, and GQ, and counts for
+#   each sample, to help choose the cutoffs in one pass.
 
+import argparse
+import multiprocessing
 import sys
+from collections import deque
+
+import bgzf
+import vcf_parse
+import vcf_filter
+
 #   If variants have below a PHRED-scaled quality of 40,
 #   we exclude them
 quality_cutoff = 40
@@ -24,54 +45,183 @@ per_sample_coverage_cutoff = 5
 n_low_coverage_cutoff = 0
 #   The number of samples
 nsam = 1
+#   The filters above, as named criteria that a site has to pass. We aren't
+#   confident in our ability to call ancestral state of indels, so only SNPs
+#   pass, and sites with more than one alternate allele are counted on their
+#   own. Samples with missing calls are left out of the genotype quality and
+#   coverage counts, because the other fields are not filled in for them. A
+#   missing GQ or DP counts as low.
+low_gq = 'called && !(FMT/GQ>=' + str(gt_cutoff) + ')'
+low_dp = 'called && !(FMT/DP>=' + str(per_sample_coverage_cutoff) + ')'
+criteria = [
+    ('snp', 'len(REF)==1 && MAX_ALT_LEN==1'),
+    ('multiallelic', 'N_ALT<=1'),
+    ('QUAL', 'QUAL>=' + str(quality_cutoff)),
+    ('het', 'n_het<=' + str(het_cutoff)),
+    ('missing', 'n_missing<=' + str(missing_cutoff)),
+    ('GQ', 'count(' + low_gq + ')<=' + str(n_gt_cutoff)),
+    ('DP', 'count(' + low_dp + ')<=' + str(n_low_coverage_cutoff))]
+#   All of them, as one expression
+default_filter = ' && '.join('(' + expr + ')' for _, expr in criteria)
+#   With --stats, what is counted for each sample
+sample_counts = [
+    ('missing', 'missing'),
+    ('het', 'het'),
+    ('low_GQ', low_gq),
+    ('low_DP', low_dp)]
+#   The number of characters of the VCF to read, and filter in one go
+chunk_size = 1 << 22
+#   With --threads, how many chunks to keep waiting for each process
+chunks_per_thread = 4
+
+
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description='Filter the variants in a VCF.',
+        add_help=True)
+    parser.add_argument('vcf', metavar='VCF', help='VCF to filter')
+    parser.add_argument(
+        '--region',
+        '-r',
+        required=False,
+        help=('Only use the variants in this region, given as chrom, '
+              'chrom:start, or chrom:start-end (1-based).'),
+        default=None)
+    parser.add_argument(
+        '--regions-file',
+        '-R',
+        required=False,
+        help='Only use the variants in the regions in this BED file.',
+        default=None)
+    parser.add_argument(
+        '--output',
+        '-o',
+        required=False,
+        help=('Write the filtered VCF to this file, bgzipped if the name '
+              'ends in .gz. Defaults to standard output.'),
+        default=None)
+    parser.add_argument(
+        '--threads',
+        '-t',
+        required=False,
+        type=int,
+        help=('Number of processes to filter with. The VCF is read in big '
+              'chunks, and the output is kept in order. Defaults to 1'),
+        default=1)
+    parser.add_argument(
+        '--stats',
+        '-s',
+        required=False,
+        help=('Also write statistics to this file, as JSON if the name ends '
+              'in .json, or else as a TSV: how many sites each of the '
+              'default criteria would remove on its own, and how many only '
+              'it removes; histograms of QUAL, DP, and GQ; and counts of '
+              'missing, het, low GQ, and low DP calls for each sample.'),
+        default=None)
+    parser.add_argument(
+        '--include',
+        '-i',
+        required=False,
+        help=('Only keep the variants for which this expression is true, in '
+              'place of the default filters. For example, '
+              '"QUAL>=40 && n_het<=2 && min(FMT/DP)>=5"'),
+        default=None)
+    parser.add_argument(
+        '--exclude',
+        '-e',
+        required=False,
+        help=('Remove the variants for which this expression is true. Used '
+              'with --include, both have to pass; on its own, it replaces the '
+              'default filters.'),
+        default=None)
+    args = parser.parse_args()
+    return args
+
+
+def open_output(o):
+    """Open the output: BGZF if the name ends in .gz, plain text if it does
+    not, and standard output if there is no name."""
+    if o is None:
+        return sys.stdout
+    elif o.endswith('.gz'):
+        return bgzf.Writer(o)
+    else:
+        return open(o, 'w')
+
 
-#   Read the file in line-by-line
-with open(sys.argv[1]) as f:
-    for line in f:
-        #   Skip the header lines - write them out without modification
-        if line.startswith('#'):
-            sys.stdout.write(line)
-        else:
-            tmp = line.strip().split('\t')
-            #   we aren't confident in our ability to call ancestral state of
-            #   indels
-            if len(tmp[3]) != 1 or len(tmp[4]) != 1:
-                continue
-            format = tmp[8]
-            sample_information = tmp[9:]
-            #   The genotype information is the first element of each sample
-            #   info block in the VCF
-            #   start counting up the number of hets, low quality genotypes and
-            #   low coverage sites
-            nhet = 0
-            low_qual_gt = 0
-            low_coverage = 0
-            missing_data = 0
-            for s in sample_information:
-                #   For the GATK HaplotypeCaller, the per-sample information
-                #   follows the form
-                #   GT:AD:DP:GQ:PL
-                info = s.split(':')
-                if len(info) != 5:
-                    break
-                gt = info[0]
-                #   We have to check for missing data first, because if it is
-                #   missing, then the other fields are not filled in
-                if '.' in gt:
-                    missing_data += 1
-                else:
-                    dp = info[2]
-                    gq = info[3]
-                    #   Split on / (we have unphased genotypes) and count how
-                    #   many hets we have
-                    if len(set(gt.split('/'))) > 1:
-                        nhet += 1
-                    if dp == '.' or int(dp) < per_sample_coverage_cutoff:
-                        low_coverage += 1
-                    if gq == '.' or int(gq) < gt_cutoff:
-                        low_qual_gt += 1
-            #   The quality score is the sixth element
-            if tmp[5] == '.' or float(tmp[5]) < quality_cutoff or nhet > het_cutoff or low_qual_gt > n_gt_cutoff or low_coverage > n_low_coverage_cutoff or missing_data > missing_cutoff:
-                continue
+def filter_parallel(f, handle, threads, include, exclude, stats=None):
+    """Filter the chunks of the VCF in a pool of processes. Chunks are handed
+    out in order, and their output is written in the same order, with only a
+    few chunks per process waiting at a time. The statistics of each chunk
+    are added to stats, if it is given."""
+    stats_args = None
+    if stats is not None:
+        stats_args = (stats.criteria, stats.sample_counts)
+    pool = multiprocessing.Pool(
+        threads,
+        initializer=vcf_filter.init_worker,
+        initargs=(include, exclude, stats_args))
+    pending = deque()
+
+    def write_next():
+        out = pending.popleft().get()
+        if stats is not None:
+            out, part = out
+            stats.merge(part)
+        handle.write(out)
+
+    try:
+        for text in f.text_chunks(chunk_size):
+            pending.append(
+                pool.apply_async(vcf_filter.filter_worker, (text, )))
+            if len(pending) >= threads * chunks_per_thread:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        pool.terminate()
+        pool.join()
+    return
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    regions = vcf_parse.get_regions(args.region, args.regions_file)
+    include = args.include
+    exclude = args.exclude
+    if include is None and exclude is None:
+        include = default_filter
+    try:
+        #   Check the expressions before anything is written
+        inc = vcf_filter.Filter(include) if include else None
+        exc = vcf_filter.Filter(exclude) if exclude else None
+        stats = None
+        if args.stats:
+            stats = vcf_filter.FilterStats(criteria, sample_counts)
+        handle = open_output(args.output)
+        with vcf_parse.VCFReader(args.vcf, regions) as f:
+            #   Write the header lines out without modification
+            for line in f.header_lines():
+                handle.write(line)
+            if args.threads > 1:
+                filter_parallel(
+                    f, handle, args.threads, include, exclude, stats)
             else:
-                sys.stdout.write(line)
+                for text in f.text_chunks(chunk_size):
+                    handle.write(
+                        vcf_filter.filter_text(text, inc, exc, stats=stats))
+            samples = f.samples
+        if args.output is not None:
+            handle.close()
+        if stats is not None:
+            stats.write(args.stats, samples)
+    except vcf_filter.FilterError as e:
+        sys.stderr.write('Bad filter expression: ' + str(e) + '\n')
+        exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
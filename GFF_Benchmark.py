@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Benchmark the feature lookups in gff_parse.py. Writes a synthetic GFF3 (or
+uses one that is supplied), parses it with GFFHandler, and then times a batch
+of random overlapping_feature() queries against the old linear scan over every
+start and end on the chromosome. The results of both methods are checked
+against each other, so this doubles as a sanity check of the interval index.
+
+If NumPy is installed, the GFF is also parsed into a GFFColumns store, and its
+parse time, memory, and query time are reported alongside GFFHandler. Memory
+is what the parsed data holds once parsing is done, as seen by tracemalloc.
+
+Requires gff_parse.py."""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gff_parse
+
+
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description=('Benchmark gff_parse.GFFHandler feature lookups against '
+                     'a linear scan.'),
+        add_help=True)
+    parser.add_argument(
+        '--gff',
+        '-g',
+        required=False,
+        help='GFF3 to benchmark. Defaults to a synthetic GFF.',
+        default=None)
+    parser.add_argument(
+        '--genes',
+        '-n',
+        required=False,
+        type=int,
+        help='Number of genes in the synthetic GFF. Defaults to 60000',
+        default=60000)
+    parser.add_argument(
+        '--seqids',
+        '-s',
+        required=False,
+        type=int,
+        help='Number of sequences in the synthetic GFF. Defaults to 10',
+        default=10)
+    parser.add_argument(
+        '--queries',
+        '-q',
+        required=False,
+        type=int,
+        help='Number of random positions to query. Defaults to 2000',
+        default=2000)
+    parser.add_argument(
+        '--seed',
+        required=False,
+        type=int,
+        help='Random seed. Defaults to 1',
+        default=1)
+    args = parser.parse_args()
+    return args
+
+
+def write_synthetic_gff(handle, ngenes, nseqids):
+    """Write a synthetic GFF3 with gene, mRNA, exon, and CDS features. Each
+    gene gets one transcript with two to six exons. Returns a dictionary of
+    sequence lengths."""
+    handle.write('##gff-version 3\n')
+    genes_per_seq = max(1, ngenes // nseqids)
+    seqlens = {}
+    gene_no = 0
+    for s in range(nseqids):
+        seqid = 'chr' + str(s + 1)
+        pos = random.randint(1, 5000)
+        for _ in range(genes_per_seq):
+            gene_no += 1
+            gid = 'gene' + str(gene_no)
+            tid = gid + '.t1'
+            nexons = random.randint(2, 6)
+            exons = []
+            epos = pos
+            for _ in range(nexons):
+                elen = random.randint(90, 600)
+                exons.append((epos, epos + elen - 1))
+                epos += elen + random.randint(80, 2000)
+            gstart = exons[0][0]
+            gend = exons[-1][1]
+            strand = random.choice('+-')
+            lines = [
+                [seqid, 'bench', 'gene', gstart, gend, '.', strand, '.',
+                 'ID=' + gid],
+                [seqid, 'bench', 'mRNA', gstart, gend, '.', strand, '.',
+                 'ID=' + tid + ';Parent=' + gid]]
+            for e, (es, ee) in enumerate(exons):
+                lines.append(
+                    [seqid, 'bench', 'exon', es, ee, '.', strand, '.',
+                     'ID=' + tid + '.exon' + str(e + 1) + ';Parent=' + tid])
+                lines.append(
+                    [seqid, 'bench', 'CDS', es, ee, '.', strand, '0',
+                     'ID=' + tid + '.cds' + str(e + 1) + ';Parent=' + tid])
+            for l in lines:
+                handle.write('\t'.join([str(x) for x in l]) + '\n')
+            #   Leave some intergenic space, and sometimes overlap genes
+            pos = gend + random.randint(-500, 10000)
+            pos = max(pos, 1)
+        seqlens[seqid] = pos
+    return seqlens
+
+
+def linear_overlapping_feature(handler, chrom, pos, feat_type=None):
+    """The original overlapping_feature() implementation: a scan over every
+    start and end on the chromosome."""
+    past_start = [pos > f for f in handler.gff_data['starts'][chrom]]
+    before_end = [pos < f for f in handler.gff_data['ends'][chrom]]
+    targeted = [
+        i
+        for i, (a, b)
+        in enumerate(zip(past_start, before_end))
+        if a and b]
+    return [
+        handler.gff_data['obj'][chrom][i]
+        for i
+        in targeted
+        if not feat_type or handler.gff_data['obj'][chrom][i].type == feat_type
+        ]
+
+
+def load_gff(handler_class, gff):
+    """Parse the GFF with the given handler class. Returns the time taken,
+    the memory held by the parsed data, and the handler. tracemalloc slows
+    parsing down a lot, so the memory is measured on a second parse."""
+    t0 = time.time()
+    handler = handler_class()
+    handler.gff_parse(gff)
+    elapsed = time.time() - t0
+    del handler
+    tracemalloc.start()
+    handler = handler_class()
+    handler.gff_parse(gff)
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (elapsed, mem, handler)
+
+
+def time_queries(func, handler, queries, feat_type):
+    """Run every query through func, and return the elapsed time and the
+    results."""
+    results = []
+    t0 = time.time()
+    for chrom, pos in queries:
+        results.append(func(handler, chrom, pos, feat_type))
+    return (time.time() - t0, results)
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    random.seed(args.seed)
+    tmp_gff = None
+    if args.gff:
+        gff = args.gff
+    else:
+        tmp_gff = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='GFF_Benchmark_',
+            suffix='.gff3',
+            delete=False)
+        write_synthetic_gff(tmp_gff, args.genes, args.seqids)
+        tmp_gff.close()
+        gff = tmp_gff.name
+    columns = None
+    try:
+        parse_time, parse_mem, handler = load_gff(gff_parse.GFFHandler, gff)
+        nfeat = sum(len(x) for x in handler.gff_data['obj'].values())
+        print('Features:\t' + str(nfeat))
+        print('GFFHandler parse:\t' + '{0:.2f}'.format(parse_time) + ' s, ' +
+              '{0:.1f}'.format(parse_mem / 1048576.0) + ' MiB')
+        if gff_parse.numpy is not None:
+            col_time, col_mem, columns = load_gff(gff_parse.GFFColumns, gff)
+            print('GFFColumns parse:\t' + '{0:.2f}'.format(col_time) +
+                  ' s, ' + '{0:.1f}'.format(col_mem / 1048576.0) + ' MiB')
+        #   Build the random queries over the span of each sequence
+        chroms = sorted(handler.gff_data['obj'])
+        queries = []
+        for _ in range(args.queries):
+            c = random.choice(chroms)
+            queries.append((c, random.randint(1, max(handler.gff_data['ends'][c]))))
+        lin_time, lin_res = time_queries(
+            linear_overlapping_feature, handler, queries, 'CDS')
+        idx_time, idx_res = time_queries(
+            lambda h, c, p, t: h.overlapping_feature(c, p, feat_type=t),
+            handler, queries, 'CDS')
+        if lin_res != idx_res:
+            sys.stderr.write('Interval index and linear scan disagree!\n')
+            exit(1)
+        hits = sum(len(r) for r in idx_res)
+        print('Queries:\t' + str(len(queries)) + ' (' + str(hits) + ' hits)')
+        print('Linear scan:\t' + '{0:.4f}'.format(lin_time) + ' s')
+        print('Interval index:\t' + '{0:.4f}'.format(idx_time) + ' s')
+        if idx_time > 0:
+            print('Speedup:\t' + '{0:.1f}'.format(lin_time / idx_time) + 'x')
+        if columns is not None:
+            col_time, col_res = time_queries(
+                lambda h, c, p, t: h.overlapping_feature(c, p, feat_type=t),
+                columns, queries, 'CDS')
+            col_res = [[f.astuple() for f in r] for r in col_res]
+            idx_res = [[f.astuple() for f in r] for r in idx_res]
+            if col_res != idx_res:
+                sys.stderr.write('GFFColumns and GFFHandler disagree!\n')
+                exit(1)
+            print('Columnar:\t' + '{0:.4f}'.format(col_time) + ' s')
+    finally:
+        if columns is not None:
+            columns.close()
+        if tmp_gff:
+            os.remove(tmp_gff.name)
+    return
+
+
+main()
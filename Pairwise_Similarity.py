@@ -2,25 +2,247 @@
 
 #   A script to identify how many SNPs are private and shared, on average
 #   between all pairwise comparisons in the samples in a VCF file
+#
+#   Each sample's calls are stored as bit-planes: one bit per site saying
+#   whether the sample has a homozygous call there, and enough further bits to
+#   tell the different calls apart. Sites are packed 64 to a word, so a pair
+#   of samples is compared with AND/XOR over whole words, and the bits are
+#   counted with popcount. With --jobs, the samples x samples matrix is split
+#   into tiles that are compared in a pool of processes, with the bits in
+#   shared memory. Requires NumPy, vcf_parse.py, and Python 3.8 or later.
 
-import sys
-
-#   A function to calculate pairwise similarity
-def pairwise(l1, l2):
-    if len(l1) != len(l2):
-        return(None)
-    comparisons = 0
-    similarity = 0
-    for i in zip(l1, l2):
-        if 'N' in i:
-            continue
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy
+
+import vcf_parse
+
+#   How many sites to read and decode before packing them into bits
+BLOCK_SITES = 4096
+#   How many 64-site words to compare at a time. This bounds the size of the
+#   temporary arrays to about TILE x WORD_CHUNK words.
+WORD_CHUNK = 2048
+#   The samples x samples matrix is compared in tiles of this many samples
+#   on a side
+TILE = 64
+#   State for the worker processes with --jobs. See init_worker().
+WORKER = {}
+
+#   Number of set bits in each byte, for versions of NumPy without
+#   bitwise_count()
+BYTE_COUNTS = numpy.array(
+    [bin(i).count('1') for i in range(256)],
+    dtype=numpy.uint8)
+
+
+def popcount(words):
+    """Count the set bits in each row of a 2D array of uint64 words."""
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(words).sum(axis=-1, dtype=numpy.int64)
+    b = words.view(numpy.uint8).reshape(words.shape[:-1] + (-1, ))
+    return BYTE_COUNTS[b].sum(axis=-1, dtype=numpy.int64)
+
+
+def pack_sites(codes, nplanes):
+    """Pack a sites x samples array of call codes into bit-planes. Code 0 is
+    missing; other codes are the calls, numbered from 1. Returns a samples x
+    words array of the 'called' bits, and a list of nplanes samples x words
+    arrays of the bits of each call (code - 1)."""
+    nsites = codes.shape[0]
+    pad = (-nsites) % 64
+    codes = numpy.pad(codes, ((0, pad), (0, 0))).T
+    #   Bits are packed low bit first, so site k is bit k % 64 of word k // 64
+    called = numpy.packbits(codes > 0, axis=1, bitorder='little')
+    planes = []
+    for p in range(nplanes):
+        bits = ((codes - 1) >> p) & 1
+        bits[codes == 0] = 0
+        planes.append(
+            numpy.packbits(bits.astype(bool), axis=1, bitorder='little'))
+    return (
+        numpy.ascontiguousarray(called).view('<u8'),
+        [numpy.ascontiguousarray(x).view('<u8') for x in planes])
+
+
+class BitGenotypes(object):
+    """Holds the calls of every sample as bit-planes.
+
+    Contains the following methods:
+        call_code(self, call)
+            Returns the code for a call string, with 'N' (missing data) as 0.
+
+        add_block(self, codes)
+            Adds a sites x samples array of call codes.
+
+        finish(self)
+            Joins up the blocks. Called once all the sites are added.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.calls = {'N': 0}
+        self.called = []
+        self.planes = []
+        self.nsites = 0
+
+    def nplanes(self):
+        """How many bits it takes to tell the calls apart."""
+        return max(1, (len(self.calls) - 2).bit_length())
+
+    def call_code(self, call):
+        return self.calls.setdefault(call, len(self.calls))
+
+    def add_block(self, codes):
+        if not len(codes):
+            return
+        called, planes = pack_sites(codes, self.nplanes())
+        self.called.append(called)
+        self.nsites += len(codes)
+        #   A new call might have needed a new plane; the earlier blocks are
+        #   all zero in it.
+        while len(self.planes) < len(planes):
+            self.planes.append([
+                numpy.zeros_like(x)
+                for x
+                in self.called[:-1]])
+        for p, bits in zip(self.planes, planes):
+            p.append(bits)
+
+    def finish(self):
+        nsamp = len(self.samples)
+        if self.called:
+            self.called = numpy.concatenate(self.called, axis=1)
+            self.planes = [numpy.concatenate(p, axis=1) for p in self.planes]
         else:
-            comparisons += 1
-            if i[0] == i[1]:
-                similarity += 1
-            else:
-                continue
-    return(similarity/float(comparisons))
+            self.called = numpy.zeros((nsamp, 0), dtype=numpy.uint64)
+            self.planes = []
+
+
+class CallTable(vcf_parse.GenotypeTable):
+    """Turns genotype call strings into the call codes of a BitGenotypes. Each
+    distinct call string is only looked at once."""
+
+    def __init__(self, geno):
+        vcf_parse.GenotypeTable.__init__(self)
+        self.geno = geno
+        self.call_codes = numpy.zeros(0, dtype=numpy.int64)
+
+    def added(self, gt):
+        #   Get the alleles
+        alleles = set(gt.split('/'))
+        #   If we have a heterozygote, we use a missing data value
+        if len(alleles) > 1 or '.' in alleles:
+            call = 'N'
+        else:
+            #   get the proper call, 0 or 1
+            call = alleles.pop()
+        self.call_codes = numpy.append(
+            self.call_codes, self.geno.call_code(call))
+
+
+def pair_counts(called, planes, r0, r1, c0, c1):
+    """Compare samples r0 to r1 against samples c0 to c1, given the 'called'
+    bits and the call bit-planes. Returns two (r1 - r0) x (c1 - c0) arrays:
+    the number of sites where both have a call, and the number where they
+    have the same call."""
+    comp = numpy.zeros((r1 - r0, c1 - c0), dtype=numpy.int64)
+    same = numpy.zeros((r1 - r0, c1 - c0), dtype=numpy.int64)
+    nwords = called.shape[1]
+    for w0 in range(0, nwords, WORD_CHUNK):
+        w1 = min(w0 + WORD_CHUNK, nwords)
+        cols_called = called[c0:c1, w0:w1]
+        cols_planes = [p[c0:c1, w0:w1] for p in planes]
+        for k, i in enumerate(range(r0, r1)):
+            both = called[i, w0:w1] & cols_called
+            diff = numpy.zeros_like(both)
+            for p, cols in zip(planes, cols_planes):
+                diff |= p[i, w0:w1] ^ cols
+            comp[k] += popcount(both)
+            same[k] += popcount(both & ~diff)
+    return (comp, same)
+
+
+def tiles(nsamp, size=TILE):
+    """Split the upper triangle of the samples x samples matrix into square
+    tiles. Returns a list of (r0, r1, c0, c1)."""
+    return [
+        (r0, min(r0 + size, nsamp), c0, min(c0 + size, nsamp))
+        for r0
+        in range(0, nsamp, size)
+        for c0
+        in range(r0, nsamp, size)]
+
+
+def init_worker(shm_name, shape):
+    """Attach a worker process to the bit-planes in shared memory. The first
+    plane is the 'called' bits, and the rest are the calls."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    bits = numpy.ndarray(shape, dtype=numpy.uint64, buffer=shm.buf)
+    #   Keep the shared memory open for as long as the worker lives
+    WORKER['shm'] = shm
+    WORKER['called'] = bits[0]
+    WORKER['planes'] = list(bits[1:])
+    return
+
+
+def tile_worker(tile):
+    """Compare the samples in one tile, in a worker process."""
+    return (tile, ) + pair_counts(WORKER['called'], WORKER['planes'], *tile)
+
+
+def all_pairs(geno, jobs=1):
+    """Compare every pair of samples. Returns the full samples x samples
+    matrices of the number of sites compared, and the number with the same
+    call. With jobs > 1, the tiles are compared in a pool of processes, which
+    read the bit-planes from shared memory."""
+    nsamp = len(geno.samples)
+    comp = numpy.zeros((nsamp, nsamp), dtype=numpy.int64)
+    same = numpy.zeros((nsamp, nsamp), dtype=numpy.int64)
+    #   Only the upper triangle is compared; the lower is the same
+    if jobs > 1:
+        shape = (len(geno.planes) + 1, ) + geno.called.shape
+        shm = shared_memory.SharedMemory(
+            create=True,
+            size=max(8 * int(numpy.prod(shape)), 8))
+        try:
+            shared = numpy.ndarray(shape, dtype=numpy.uint64, buffer=shm.buf)
+            for k, bits in enumerate([geno.called] + geno.planes):
+                shared[k] = bits
+            del shared
+            pool = multiprocessing.Pool(
+                jobs,
+                initializer=init_worker,
+                initargs=(shm.name, shape))
+            results = pool.imap_unordered(tile_worker, tiles(nsamp))
+            for (r0, r1, c0, c1), c, s in results:
+                comp[r0:r1, c0:c1] = c
+                same[r0:r1, c0:c1] = s
+            pool.close()
+            pool.join()
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        for r0, r1, c0, c1 in tiles(nsamp):
+            c, s = pair_counts(geno.called, geno.planes, r0, r1, c0, c1)
+            comp[r0:r1, c0:c1] = c
+            same[r0:r1, c0:c1] = s
+    #   Tiles on the diagonal filled in part of the lower triangle too, but it
+    #   is simplest to copy the whole thing over
+    lower = numpy.tril_indices(nsamp, -1)
+    comp[lower] = comp.T[lower]
+    same[lower] = same.T[lower]
+    return (comp, same)
+
+
+def similarity(comp, same):
+    """The proportion of compared sites with the same call, or None if no
+    sites could be compared."""
+    if comp == 0:
+        return None
+    return same / float(comp)
 
 
 #   A function to calculate the average
@@ -28,50 +250,83 @@ def average(x):
     return(sum(x)/float(len(x)))
 
 
-vcf_data = []
-#   Read in the VCF and store the data
-with open(sys.argv[1], 'r') as f:
-    for line in f:
-        if line.startswith('##'):
-            continue
-        elif line.startswith('#CHROM'):
-            tmp = line.strip().split('\t')
-            #   This is the header line, and the sample information is
-            #   on the 10th element until the end
-            samples = tmp[9:]
-            #   We will append each sample name to the data list
-            #   but we will do it as a list with one element, so we can
-            #   grow it as we read through the data
-            for s in samples:
-                vcf_data.append([s])
-        else:
-            #   We start reading through the variant call lines
-            tmp = line.strip().split('\t')
-            #   isolate the genotype data
-            sample_information = tmp[9:]
-            #   Append the genotype calls, 1 or 0 to the data list
-            for index, s in enumerate(sample_information):
-                genotype = s.split(':')[0]
-                calls = genotype.split('/')
-                #   Get the alleles
-                alleles = set(calls)
-                #   If we have a heterozygote, we append a missing data value
-                if len(alleles) > 1 or '.' in alleles:
-                    vcf_data[index].append('N')
-                else:
-                    #   get the proper call, 0 or 1
-                    base = list(alleles)[0]
-                    #   Append it!
-                    vcf_data[index].append(base)
-
-pairwise_similarity = []
-#   Now, we go through and make all pairwise comparisons, counting up the
-#   number of common and different alleles
-for index, i in enumerate(vcf_data[:-1]):
-    for j in vcf_data[index+1:]:
-        #   We slice off the first element, since that is the sample name
-        sim = pairwise(i[1:], j[1:])
-        pairwise_similarity.append(sim)
-        print i[0] + '-' + j[0] + ': ' + str(sim)
-
-print 'Average: ' + str(average(pairwise_similarity))
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description=('Calculate the proportion of shared SNP calls between '
+                     'every pair of samples in a VCF. Heterozygous calls are '
+                     'treated as missing.'),
+        add_help=True)
+    parser.add_argument('vcf', metavar='VCF', help='VCF of SNPs')
+    parser.add_argument(
+        '--matrix',
+        '-m',
+        required=False,
+        help=('Also write the full samples x samples similarity matrix to '
+              'this file, as a CSV.'),
+        default=None)
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        required=False,
+        type=int,
+        help=('Number of processes to compare samples with. The matrix is '
+              'split into tiles, and the bits are shared between the '
+              'processes rather than copied. Defaults to 1'),
+        default=1)
+    args = parser.parse_args()
+    return args
+
+
+def read_vcf(vcf):
+    """Read in the VCF and store the calls as bits."""
+    with vcf_parse.VCFReader(vcf) as reader:
+        #   The sample information is on the 10th element of the #CHROM line
+        #   until the end
+        geno = BitGenotypes(reader.samples)
+        ctab = CallTable(geno)
+        for block in reader.blocks(BLOCK_SITES):
+            codes = ctab.decode(block)
+            geno.add_block(ctab.call_codes[codes])
+    geno.finish()
+    return geno
+
+
+def write_matrix(fname, samples, comp, same):
+    """Write the similarity matrix as a CSV, with NA for pairs that share no
+    called sites."""
+    with open(fname, 'w') as handle:
+        handle.write(','.join([''] + samples) + '\n')
+        for i, s in enumerate(samples):
+            row = [
+                similarity(c, x)
+                for c, x
+                in zip(comp[i].tolist(), same[i].tolist())]
+            handle.write(
+                ','.join([s] + ['NA' if x is None else str(x) for x in row]) +
+                '\n')
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    geno = read_vcf(args.vcf)
+    comp, same = all_pairs(geno, args.jobs)
+    pairwise_similarity = []
+    samples = geno.samples
+    for i in range(len(samples) - 1):
+        for j in range(i + 1, len(samples)):
+            sim = similarity(int(comp[i, j]), int(same[i, j]))
+            if sim is None:
+                print(samples[i] + '-' + samples[j] + ': NA')
+                continue
+            pairwise_similarity.append(sim)
+            print(samples[i] + '-' + samples[j] + ': ' + str(sim))
+    print('Average: ' + str(average(pairwise_similarity)))
+    if args.matrix:
+        write_matrix(args.matrix, samples, comp, same)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -7,148 +7,290 @@ nonsynonymous. This will always report positions in 1-based coordinates, from
 "start" to "end." This means that for reverse-strand features, the script will
 count backwards.
 
-Requires Biopython and gff_parse"""
+With --threads, the VCF is split into blocks of SNPs on the same chromosome,
+and the blocks are annotated in a pool of processes. The output is in the same
+order as the VCF.
+
+The reference is read through a .fai index (built next to the FASTA if it is
+missing), and memory mapped, so only the parts of the reference that hold
+CDSs are read from disk. The FASTA must not be compressed.
+
+Requires Biopython, gff_parse, and fasta_index"""
 
 #   Import some modules
 import sys
-import math
+import argparse
+import functools
+import multiprocessing
+from collections import namedtuple
 import gff_parse
+import fasta_index
 #   Biopython modules. These handle sequence objects and translations
-from Bio import SeqIO
 from Bio.Seq import Seq
-from Bio.SeqFeature import SeqFeature, FeatureLocation
+
+#   How many transcript models to keep in memory at once. SNPs in a sorted VCF
+#   arrive transcript by transcript, so this only has to be big enough to
+#   cover the transcripts that overlap each other.
+MODEL_CACHE_SIZE = 512
+#   How many SNPs to hand to a worker at a time with --threads
+BLOCK_SIZE = 5000
+#   State for the worker processes with --threads. See init_worker().
+WORKER = {}
+
+#   The spliced CDS of a transcript. 'offsets' maps 0-based genomic positions
+#   to 0-based positions in the CDS, 'sequence' is the spliced sequence in
+#   the sense orientation, and 'protein' is its translation.
+CDSModel = namedtuple('CDSModel', ['strand', 'offsets', 'sequence', 'protein'])
 
 
 def read_sequence(refseq):
-    """Reads the reference sequence and returns a dictionary of Seq obects."""
-    handle = open(refseq, 'r')
-    #   Start a parser that will iterate through the sequence file
-    ref_parser = SeqIO.parse(handle, 'fasta')
-    #   And then turn the parser into a sequence dictionary
-    ref_dict = SeqIO.to_dict(ref_parser)
-    return ref_dict
+    """Opens the reference sequence through its .fai index, building the index
+    if it is missing. Sequences are read from disk as they are needed."""
+    return fasta_index.IndexedFasta(refseq)
 
 
-def read_gff(gff_file):
+def read_gff(gff_file, cache=False):
     """Reads and parses the GFF."""
     parsed_gff = gff_parse.GFFHandler()
-    parsed_gff.gff_parse(gff_file)
+    parsed_gff.gff_parse(gff_file, cache=cache)
     return parsed_gff
 
 
-def build_cds_sequences(cds_chunks):
-    """Takes a list of CDS annotations and sticks them together."""
-    feature_parts = []
+def build_cds_model(cds_chunks, sequence):
+    """Takes a list of CDS annotations and the sequence they sit on, sticks
+    them together, and returns a CDSModel."""
+    parts = []
     for c in cds_chunks:
         #   We convert all the coordinates to 0-based, since they came out of
-        #   the GFF as 1-based. SeqFeature.extract() will give an interval
-        #   corresponding to [start, end), so we only have to subtract from
-        #   the start.
-        start = int(c.start) - 1
-        end = int(c.end)
+        #   the GFF as 1-based. We keep them as [start, end), so we only have
+        #   to subtract from the start.
+        parts.append((int(c.start) - 1, int(c.end)))
         if c.strand == '+':
             strand = 1
         elif c.strand == '-':
             strand = -1
-        #   Then, we build a FeatureLocation object out of it, and give it the
-        #   proper strandedness
-        feature_sub = FeatureLocation(start, end)
-        feature_parts.append(feature_sub)
-    #   Check the strand, and sort accordingly. For forward strand features,
-    #   we sort from low to high. For reverse strand features, we sort from
-    #   high to low.
-    if strand == 1:
-        feature_parts.sort(key=lambda s: s.start)
-    elif strand == -1:
-        feature_parts.sort(key=lambda s: s.start, reverse=True)
-    #   And then we concatenate them all together
-    joint_feature = sum(feature_parts)
-    joint_feature = SeqFeature(joint_feature, type='CDS', strand=strand)
-    #   Return it!
-    return joint_feature
-
-
-def translate_codons(feature, sequence, alt, position):
+    parts.sort()
+    #   Walk the parts from low to high, and keep track of which base of the
+    #   CDS each genomic position is.
+    positions = []
+    for start, end in parts:
+        positions.extend(range(start, end))
+    cds_seq = Seq(''.join([str(sequence[start:end]) for start, end in parts]))
+    #   For reverse strand features, the CDS runs from high to low, and we
+    #   need the reverse complement.
+    if strand == -1:
+        positions.reverse()
+        cds_seq = cds_seq.reverse_complement()
+    offsets = dict([(p, i) for i, p in enumerate(positions)])
+    #   Translate the whole thing once. Trailing partial codons are dropped.
+    cds_seq = str(cds_seq)
+    protein = str(Seq(cds_seq[:len(cds_seq) - len(cds_seq) % 3]).translate())
+    return CDSModel(strand, offsets, cds_seq, protein)
+
+
+def model_lookup(gff_data, reference, maxsize=MODEL_CACHE_SIZE):
+    """Returns a function that gives the CDSModel for a transcript, building
+    it the first time that transcript is seen. The most recently used models
+    are cached, keyed on chromosome and transcript ID."""
+    @functools.lru_cache(maxsize=maxsize)
+    def get_model(chrom, transcript_id):
+        cds = gff_data.get_children(chrom, transcript_id, feat_type='CDS')
+        return build_cds_model(cds, reference[chrom])
+    return get_model
+
+
+def translate_codons(model, alt, position):
     """Translates the two codon states and returns them."""
-    #   First, extract the feature sequence from the main sequence
-    #   Feature.extract() gives a SeqRecord, and we want just the Seq object
-    #   inside it.
-    cds_seq = feature.extract(sequence).seq
-    seqlen = len(sequence)
-    #   Then, we get the list of positions that are in the feature
-    cds_positions = [x for x in range(0, seqlen) if x in feature]
-    #   If the CDS is on the reverse strand, though, we need to reverse
-    #   this list. We will return a flag, too, since we need to handle the
-    #   ref and alt states accordingly, too
+    #   If the CDS is on the reverse strand, we need to complement the alt
+    #   state. We will return a flag, too, since we need to handle the ref and
+    #   alt states accordingly, too
     rc = False
-    if feature.strand == -1:
-        cds_positions.reverse()
-        #   We need to complement the alt state, too.
+    if model.strand == -1:
         alt = str(Seq(alt).complement())
         rc = True
     #   Sometimes, things slip through the filter and end up here. I'm not
     #   sure what causes this, but we need to trap this. In this case, we
     #   will return missing values for the effect predictions, since we can't
     #   accurately determine the effects.
-    if position not in cds_positions:
+    if position not in model.offsets:
         return(True, ['-', '-'], '-', '-')
     #   Then, which position in the CDS is the SNP?
-    cds_base = cds_positions.index(position)
-    #   Which codon is that?
-    codon = int(math.floor(cds_base / 3))
-    #   What are the positions covered by the codon?
-    codon_bases = [
-        cds_positions[codon*3],
-        cds_positions[codon*3 + 1],
-        cds_positions[codon*3 + 2]
-        ]
-    #   And what is the position of the SNP in the codon?
-    snp_pos = codon_bases.index(position)
-    #   Translate the reference CDS sequence
-    ref_cds = cds_seq.translate()
-    #   Then drop in the alternate base and re-translate
-    alt_cds_seq = cds_seq
-    #   make it a MutableSeq so that we can make substitutions
-    alt_cds_seq = alt_cds_seq.tomutable()
-    alt_cds_seq[cds_base] = alt
-    alt_cds = alt_cds_seq.toseq().translate()
-    states = [ref_cds[codon], alt_cds[codon]]
+    cds_base = model.offsets[position]
+    #   Which codon is that, and where in the codon is the SNP?
+    codon = cds_base // 3
+    snp_pos = cds_base % 3
+    #   SNPs in a trailing partial codon can't be translated
+    if codon >= len(model.protein):
+        return(rc, ['-', '-'], '-', '-')
+    #   Drop the alternate base into the reference codon and translate just
+    #   that codon
+    ref_codon = model.sequence[codon*3:codon*3 + 3]
+    alt_codon = ref_codon[:snp_pos] + alt + ref_codon[snp_pos+1:]
+    states = [model.protein[codon], str(Seq(alt_codon).translate())]
     #   Add 1 to make the offset 1-based
     residue_no = codon + 1
     return(rc, states, residue_no, snp_pos+1)
 
 
-def usage():
-    """Usage function."""
-    message = """
-Usage: SNP_Effect_Predictor.py [REF] [GFF] [VCF]
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description=('Predict the amino acid impact of SNPs listed in a VCF. '
+                     'REF should be a FASTA sequence, and GFF should '
+                     'reference the sequences in REF. Information returned '
+                     'is the SNP ID (read from the VCF), the chromosomal '
+                     'position, the transcript ID (if coding), whether the '
+                     'alternate base represents a silent or nonsynonymous '
+                     'SNP, and the residue number of the affected codon in '
+                     '1-based coordinates. Requires gff_parse.py from '
+                     'TomJKono\'s GitHub, and Biopython.'),
+        add_help=True)
+    parser.add_argument('ref', metavar='REF', help='Reference FASTA')
+    parser.add_argument('gff', metavar='GFF', help='GFF3 annotation of REF')
+    parser.add_argument('vcf', metavar='VCF', help='VCF of SNPs')
+    parser.add_argument(
+        '--threads',
+        '-t',
+        required=False,
+        type=int,
+        help=('Number of processes to annotate with. The VCF is split into '
+              'blocks of SNPs on the same chromosome. Defaults to 1'),
+        default=1)
+    parser.add_argument(
+        '--cache-gff',
+        '-c',
+        required=False,
+        action='store_true',
+        help=('Keep the parsed GFF in GFF.cache, and load it from there on '
+              'later runs with the same GFF.'),
+        default=False)
+    args = parser.parse_args()
+    return args
+
+
+def vcf_blocks(vcf, block_size=BLOCK_SIZE):
+    """Read the VCF and yield lists of at most block_size lines that are all
+    on the same chromosome, in the order they appear in the VCF."""
+    block = []
+    block_chrom = None
+    with open(vcf, 'r') as f:
+        for line in f:
+            #   Skip comments and directives
+            if line.startswith('#'):
+                continue
+            chrom = line.split('\t', 1)[0]
+            if block and (chrom != block_chrom or len(block) >= block_size):
+                yield block
+                block = []
+            block_chrom = chrom
+            block.append(line)
+    if block:
+        yield block
+
+
+def init_worker(gff_data, reference):
+    """Set up the per-process state for annotating blocks of the VCF. Each
+    worker holds the GFF and its own memory map of the reference."""
+    WORKER['gff_data'] = gff_data
+    WORKER['get_model'] = model_lookup(gff_data, reference)
+    return
+
+
+def annotate_worker(block):
+    """Annotate a block of VCF lines in a worker process."""
+    return annotate_block(WORKER['gff_data'], WORKER['get_model'], block)
+
 
-will predict the amino acid impact of SNPs listed in [VCF]. [REF] should be
-a FASTA sequence, and [GFF] should reference the sequences in [REF].
-Information returned is the SNP ID (Read from the VCF), the chromosomal
-position, the gene ID (if genic), the transcript ID (if coding), whether the
-alternate base represents a silent or nonsynonymous SNP, and the residue number
-of the affected codon in 1-based coordinates.
+def annotate_block(gff_data, get_model, block):
+    """Annotate a block of VCF lines from one chromosome. Returns the lines to
+    print, as one string."""
+    #   Separate the fields on tabs. We only want the first five fields, as
+    #   these are the ones that describe the variant (The others contain
+    #   sample data.)
+    snps = [line.strip().split('\t', 5)[:5] for line in block]
+    #   We ask if either the ref or alt alleles involve more than one base. If
+    #   this is the case, then we skip it, as we do not predict indel effects.
+    snps = [s for s in snps if len(s[3]) == 1 and len(s[4]) == 1]
+    if not snps:
+        return ''
+    #   Get all the CDS features that overlap each SNP, in one sweep along the
+    #   chromosome. Subtract 1 from the positions to make them 0-based.
+    overlapping_cds = gff_data.overlapping_features(
+        snps[0][0],
+        [int(s[1]) - 1 for s in snps],
+        feat_type='CDS')
+    out = []
+    for s, cds in zip(snps, overlapping_cds):
+        out.append(annotate_snp(gff_data, get_model, s, cds) + '\n')
+    return ''.join(out)
 
-Requires gff_parse.py from TomJKono's GitHub, and Biopython"""
-    print message
-    exit(1)
+
+def annotate_snp(gff_data, get_model, tmp, overlapping_cds):
+    """Predict the effect of one SNP, given the first five fields of its VCF
+    line and the CDS features that overlap it. Returns the line to print."""
+    chrom = tmp[0]
+    #   Subtract 1 from the position to make it 0-based
+    pos = int(tmp[1]) - 1
+    snp_id = tmp[2]
+    ref_base = tmp[3]
+    alt_base = tmp[4]
+    #   This is not the best approach, probably, but take the first CDS
+    #   feature that is overlapping
+    if overlapping_cds:
+        feat = overlapping_cds[0]
+        #   What transcript is it in?
+        transcript_id = gff_data.get_parents(chrom, feat.ID)
+        transcript_id = transcript_id[0].ID
+        #   Get the spliced CDS of that transcript
+        model = get_model(chrom, transcript_id)
+        revcomp, states, aa_pos, codon_base = translate_codons(
+            model,
+            alt_base,
+            pos)
+        #   Check if the SNP is synonymous or not
+        if len(set(states)) == 1:
+            silent = 'Yes'
+        else:
+            silent = 'No'
+        #   Check if we had to reverse complement or not
+        if revcomp:
+            ref_base = Seq(ref_base).complement()
+            alt_base = Seq(alt_base).complement()
+    else:
+        transcript_id = '-'
+        silent = 'Yes'
+        states = ['-', '-']
+        aa_pos = '-'
+        codon_base = '-'
+    #   Build the list of things to print
+    to_print = '\t'.join(
+        [
+            snp_id,
+            chrom,
+            str(pos + 1),
+            silent,
+            transcript_id,
+            str(codon_base),
+            str(ref_base),
+            str(alt_base),
+            states[0],
+            states[1],
+            str(aa_pos)
+        ]
+        )
+    return to_print
 
 
 def main():
     """Main function."""
-    if len(sys.argv[1:]) != 3:
-        usage()
-    #   Define arguments
-    ref = sys.argv[1]
-    gff = sys.argv[2]
-    vcf = sys.argv[3]
+    args = parse_args()
     #   Parse the GFF information
-    gff_data = read_gff(gff)
-    #   And the reference sequence
-    ref_dict = read_sequence(ref)
+    gff_data = read_gff(args.gff, args.cache_gff)
+    #   And open the reference sequence. This builds the index if we need to,
+    #   before any workers are started.
+    reference = read_sequence(args.ref)
     #   Print out a header
-    print '\t'.join(
+    print('\t'.join(
         [
             'SNP_ID',
             'Chromosome',
@@ -162,93 +304,29 @@ def main():
             'AA2',
             'CDS_Pos'
         ]
-        )
-    #   Start stepping through the VCF, and predicting the effects of each one
-    with open(vcf, 'r') as f:
-        for line in f:
-            #   Skip comments and directives
-            if line.startswith('#'):
-                continue
-            else:
-                #   Separate the fields on tabs
-                tmp = line.strip().split()
-                #   We only want to save the first eight fields, as these are
-                #   the ones that contain variant data (The others contain
-                #   sample data.)
-                chrom = tmp[0]
-                #   Subtract 1 from the position to make it 0-based
-                pos = int(tmp[1]) - 1
-                snp_id = tmp[2]
-                ref_base = tmp[3]
-                alt_base = tmp[4]
-                qual = tmp[5]
-                flt = tmp[6]
-                snp_info = tmp[7]
-                #   We ask if either the ref or alt alleles involve more than
-                #   one base. If this is the case, then we skip it, as we do
-                #   not predict indel effects.
-                if len(ref_base) > 1 or len(alt_base) > 1:
-                    continue
-                else:
-                    #   Get all the CDS features that overlap the SNP
-                    overlapping_cds = gff_data.overlapping_feature(
-                        chrom,
-                        pos,
-                        feat_type='CDS')
-                    #   Then, we get the sequence of the contig or chromosome
-                    #   with the SNP
-                    chrom_seq = ref_dict[chrom]
-                    #   This is not the best approach, probably, but take the
-                    #   first CDS feature that is overlapping
-                    if overlapping_cds:
-                        feat = overlapping_cds[0]
-                        #   What transcript is it in?
-                        transcript_id = gff_data.get_parents(chrom, feat.ID)
-                        transcript_id = transcript_id[0].ID
-                        #   Get the full CDS
-                        full_cds = gff_data.get_siblings(
-                            chrom,
-                            feat.ID,
-                            feat_type='CDS')
-                        full_cds = build_cds_sequences(full_cds)
-                        revcomp, states, aa_pos, codon_base = translate_codons(
-                            full_cds,
-                            chrom_seq,
-                            alt_base,
-                            pos)
-                        #   Check if the SNP is synonymous or not
-                        if len(set(states)) == 1:
-                            silent = 'Yes'
-                        else:
-                            silent = 'No'
-                        #   Check if we had to reverse complement or not
-                        if revcomp:
-                            ref_base = Seq(ref_base).complement()
-                            alt_base = Seq(alt_base).complement()
-                    else:
-                        transcript_id = '-'
-                        silent = 'Yes'
-                        states = ['-', '-']
-                        aa_pos = '-'
-                        codon_base = '-'
-                    #   Build the list of things to print
-                    to_print = '\t'.join(
-                        [
-                            snp_id,
-                            chrom,
-                            str(pos + 1),
-                            silent,
-                            transcript_id,
-                            str(codon_base),
-                            str(ref_base),
-                            str(alt_base),
-                            states[0],
-                            states[1],
-                            str(aa_pos)
-                        ]
-                        )
-                    print to_print
+        ))
+    if args.threads > 1:
+        #   Hand out blocks of SNPs to a pool of workers. imap() gives back
+        #   the results in the order the blocks were handed out, so the
+        #   output is in the same order as the VCF.
+        sys.stdout.flush()
+        pool = multiprocessing.Pool(
+            args.threads,
+            initializer=init_worker,
+            initargs=(gff_data, reference))
+        for out in pool.imap(annotate_worker, vcf_blocks(args.vcf)):
+            sys.stdout.write(out)
+        pool.close()
+        pool.join()
+    else:
+        #   Transcript models are built as we need them
+        get_model = model_lookup(gff_data, reference)
+        #   Start stepping through the VCF, and predicting the effects of each
+        #   one
+        for block in vcf_blocks(args.vcf):
+            sys.stdout.write(annotate_block(gff_data, get_model, block))
     return
 
 
-main()
+if __name__ == '__main__':
+    main()
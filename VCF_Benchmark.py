@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Benchmark the VCF reading in vcf_parse.py. Writes a synthetic VCF (or uses
+one that is supplied), and then times three jobs the VCF scripts do, each done
+the old way, with a line.strip().split('\\t') loop that splits every sample
+column, and with a vcf_parse.VCFReader:
+    1) Counting the sites on each chromosome
+    2) Getting the genotype call of every sample at every site
+    3) Getting the AD of every sample at every site
+The genotype calls are also decoded in blocks with a GenotypeTable, if NumPy
+is installed. The results of the two ways are checked against each other, so
+this doubles as a sanity check of the reader.
+
+Requires vcf_parse.py."""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+import time
+
+import vcf_parse
+
+
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description=('Benchmark vcf_parse.VCFReader against a plain '
+                     'split-every-line loop.'),
+        add_help=True)
+    parser.add_argument(
+        '--vcf',
+        '-v',
+        required=False,
+        help=('VCF to benchmark. May be gzipped. Defaults to a synthetic '
+              'VCF.'),
+        default=None)
+    parser.add_argument(
+        '--sites',
+        '-n',
+        required=False,
+        type=int,
+        help='Number of sites in the synthetic VCF. Defaults to 20000',
+        default=20000)
+    parser.add_argument(
+        '--samples',
+        '-s',
+        required=False,
+        type=int,
+        help='Number of samples in the synthetic VCF. Defaults to 100',
+        default=100)
+    parser.add_argument(
+        '--gzip',
+        '-z',
+        required=False,
+        action='store_true',
+        help='gzip the synthetic VCF.',
+        default=False)
+    parser.add_argument(
+        '--seed',
+        required=False,
+        type=int,
+        help='Random seed. Defaults to 1',
+        default=1)
+    args = parser.parse_args()
+    return args
+
+
+def write_synthetic_vcf(handle, nsites, nsamples):
+    """Write a synthetic VCF of biallelic SNPs with GATK-style sample columns
+    (GT:AD:DP:GQ:PL), spread over a few chromosomes, with some missing
+    calls."""
+    handle.write('##fileformat=VCFv4.2\n')
+    nchrom = 5
+    for c in range(nchrom):
+        handle.write(
+            '##contig=<ID=chr' + str(c + 1) + ',length=' +
+            str(nsites * 100) + '>\n')
+    handle.write(
+        '\t'.join(
+            ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO',
+             'FORMAT'] +
+            ['sample' + str(i + 1) for i in range(nsamples)]) +
+        '\n')
+    per_chrom = max(1, nsites // nchrom)
+    for i in range(nsites):
+        chrom = 'chr' + str(min(i // per_chrom, nchrom - 1) + 1)
+        pos = (i % per_chrom) * 100 + random.randint(1, 99)
+        ref, alt = random.sample('ACGT', 2)
+        calls = []
+        for _ in range(nsamples):
+            gt = random.choice(['0/0', '0/0', '0/1', '1/1', './.'])
+            if gt == './.':
+                calls.append('./.')
+                continue
+            ad = (random.randint(0, 30), random.randint(0, 30))
+            calls.append(
+                gt + ':' + str(ad[0]) + ',' + str(ad[1]) + ':' +
+                str(sum(ad)) + ':' + str(random.randint(0, 99)) + ':0,10,100')
+        handle.write(
+            '\t'.join(
+                [chrom, str(pos), '.', ref, alt,
+                 str(random.randint(10, 5000)), 'PASS', '.',
+                 'GT:AD:DP:GQ:PL'] + calls) +
+            '\n')
+    return
+
+
+def old_lines(vcf):
+    """Yield the data lines of the VCF, split on tabs, like the VCF scripts
+    used to."""
+    if vcf.endswith('.gz'):
+        handle = gzip.open(vcf, 'rt')
+    else:
+        handle = open(vcf, 'r')
+    with handle as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            yield line.strip().split('\t')
+
+
+def old_count(vcf):
+    counts = {}
+    for tmp in old_lines(vcf):
+        counts[tmp[0]] = counts.get(tmp[0], 0) + 1
+    return counts
+
+
+def new_count(vcf):
+    counts = {}
+    with vcf_parse.VCFReader(vcf) as reader:
+        for rec in reader:
+            counts[rec.chrom] = counts.get(rec.chrom, 0) + 1
+    return counts
+
+
+def old_gt(vcf):
+    return [[s.split(':')[0] for s in tmp[9:]] for tmp in old_lines(vcf)]
+
+
+def new_gt(vcf):
+    with vcf_parse.VCFReader(vcf) as reader:
+        return [rec.gt() for rec in reader]
+
+
+def old_ad(vcf):
+    out = []
+    for tmp in old_lines(vcf):
+        fmt = tmp[8].split(':')
+        if 'AD' not in fmt:
+            out.append(None)
+            continue
+        idx = fmt.index('AD')
+        row = []
+        for s in tmp[9:]:
+            sub = s.split(':')
+            row.append(sub[idx] if idx < len(sub) else None)
+        out.append(row)
+    return out
+
+
+def new_ad(vcf):
+    with vcf_parse.VCFReader(vcf) as reader:
+        return [rec.get('AD') for rec in reader]
+
+
+def new_decode(vcf):
+    """Decode the calls in blocks. Returns the table and the arrays of
+    codes."""
+    gtab = vcf_parse.GenotypeTable()
+    with vcf_parse.VCFReader(vcf) as reader:
+        codes = [gtab.decode(block) for block in reader.blocks(10000)]
+    return (gtab, codes)
+
+
+def decoded_calls(res):
+    """Turn the codes from new_decode() back into call strings, to check
+    them."""
+    gtab, codes = res
+    return [
+        [gtab.genotypes[c] for c in row]
+        for block
+        in codes
+        for row
+        in block.tolist()]
+
+
+def time_it(func, vcf):
+    """Run func on the VCF, and return the elapsed time and the result."""
+    t0 = time.time()
+    res = func(vcf)
+    return (time.time() - t0, res)
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    random.seed(args.seed)
+    tmp_vcf = None
+    if args.vcf:
+        vcf = args.vcf
+    else:
+        suffix = '.vcf.gz' if args.gzip else '.vcf'
+        tmp_vcf = tempfile.NamedTemporaryFile(
+            prefix='VCF_Benchmark_',
+            suffix=suffix,
+            delete=False)
+        tmp_vcf.close()
+        if args.gzip:
+            handle = gzip.open(tmp_vcf.name, 'wt')
+        else:
+            handle = open(tmp_vcf.name, 'w')
+        with handle:
+            write_synthetic_vcf(handle, args.sites, args.samples)
+        vcf = tmp_vcf.name
+    try:
+        #   Each job is a name, the old and new ways, and a function to put
+        #   the result of the new way in the same form as the old, untimed
+        jobs = [
+            ('Sites per chromosome', old_count, new_count, None),
+            ('Genotype calls', old_gt, new_gt, None),
+            ('AD values', old_ad, new_ad, None)]
+        if vcf_parse.numpy is not None:
+            jobs.append(('Block decode', old_gt, new_decode, decoded_calls))
+        for name, old, new, convert in jobs:
+            old_time, old_res = time_it(old, vcf)
+            new_time, new_res = time_it(new, vcf)
+            if convert:
+                new_res = convert(new_res)
+            if old_res != new_res:
+                sys.stderr.write(name + ': vcf_parse and split loop disagree!\n')
+                exit(1)
+            print(name + ':')
+            print('\tSplit loop:\t' + '{0:.3f}'.format(old_time) + ' s')
+            print('\tvcf_parse:\t' + '{0:.3f}'.format(new_time) + ' s')
+            if new_time > 0:
+                print('\tSpeedup:\t' + '{0:.1f}'.format(old_time / new_time) +
+                      'x')
+    finally:
+        if tmp_vcf:
+            os.remove(tmp_vcf.name)
+    return
+
+
+main()
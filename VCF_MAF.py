@@ -3,74 +3,175 @@
 #   A script to calculate the alt allele frequency in a VCF file
 #   This is useful only for a BSA-Seq project
 #   Uses the AD annotation from the GATK output
+#   With --region or --regions-file, only the variants in those regions are
+#   used; a bgzipped VCF with a .tbi or .csi index is only read where the
+#   regions are.
+#   The sites are read in blocks. The AD of every sample in a block is parsed
+#   into a sites x samples x alleles array of integers in one pass, the
+#   frequencies and depths are worked out on the whole array, and the block
+#   is written out in one go.
+#   With --binary, the frequencies and depths are written to a columnar file
+#   (see columnar.py) in place of the text table: one column for each sample,
+#   with the site and sample names, so one sample can be read back without
+#   parsing the rest. Frequencies are float32 with NaN where they are missing,
+#   and depths are int32 with -1 where they are missing.
 
+import argparse
 import sys
 
-#   Start iterating through the file
-with open(sys.argv[1], 'r') as f:
-    for line in f:
-        #   ignore header lines
-        if line.startswith('##'):
+import numpy
+
+import columnar
+import vcf_parse
+
+#   How many sites to read and work out at a time
+block_size = 2048
+
+
+def format_floats(values, missing):
+    """Format an array of floats the same way as str(), with NA where missing
+    is True. Depths and frequencies take only a few distinct values, so each
+    one is only formatted once."""
+    uniq, inverse = numpy.unique(values, return_inverse=True)
+    strings = numpy.array(list(map(repr, uniq.tolist())), dtype=object)
+    out = strings[inverse.reshape(values.shape)]
+    out[missing] = 'NA'
+    return out
+
+
+def block_values(block, nsamp):
+    """Work out the alternate allele frequency and read depth of each sample
+    at each site in a block. Returns the frequencies, the depths, which of
+    them are missing, and which sites have an AD field."""
+    n = len(block)
+    aaf = numpy.zeros((n, nsamp))
+    depth = numpy.zeros((n, nsamp))
+    missing = numpy.ones((n, nsamp), dtype=bool)
+    has_ad = numpy.zeros(n, dtype=bool)
+    #   AD has one value for each allele, so sites are grouped by how many
+    #   alleles they have
+    groups = {}
+    for i, rec in enumerate(block):
+        groups.setdefault(rec.alt.count(',') + 2, []).append(i)
+    for nalleles, rows in groups.items():
+        recs = [block[i] for i in rows]
+        ad = vcf_parse.format_ints(recs, 'AD', nalleles)
+        if ad.shape[1] != nsamp:
+            #   None of these sites have sample columns
             continue
-        #   This defines how many samples in the VCF
-        elif line.startswith('#CHROM'):
-            samples = line.strip().split('\t')[9:]
-            #   Create the list of sub-fields for each sample
-            sample_sub_fields = ['_AltAlleleFreq', '_ReadDepth']
-            #   And tack them together
-            per_sample = []
-            for s in samples:
-                for sb in sample_sub_fields:
-                    per_sample.append(s+sb)
-            #   Append the header to the list of data to write
-            print 'SNPPos\tRefAllele\tAltAllele\t' + '\t'.join(per_sample) + '\tNotes'
+        has_ad[rows] = [
+            'AD' in vcf_parse.format_index(r.format)
+            for r
+            in recs]
+        total = ad.sum(axis=2).astype(numpy.float64)
+        alt = ad[:, :, 1].astype(numpy.float64)
+        #   A depth of 0 is given a frequency of 1
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            freq = numpy.where(total == 0, 1.0, alt / total)
+        aaf[rows] = freq
+        depth[rows] = total
+        missing[rows] = (ad < 0).any(axis=2)
+    return aaf, depth, missing, has_ad
+
+
+def block_lines(block, nsamp):
+    """Return the output lines of the sites in a block."""
+    n = len(block)
+    aaf, depth, missing, has_ad = block_values(block, nsamp)
+    aaf_str = format_floats(aaf, missing)
+    depth_str = format_floats(depth, missing)
+    #   Interleave the two, for each sample
+    cells = numpy.empty((n, 2 * nsamp), dtype=object)
+    cells[:, 0::2] = aaf_str
+    cells[:, 1::2] = depth_str
+    lines = []
+    for rec, row, ad_ok in zip(block, cells.tolist(), has_ad.tolist()):
+        f = rec.fields()
+        site = [f[vcf_parse.CHROM] + ':' + f[vcf_parse.POS], rec.ref, rec.alt]
+        #   The Notes column only flags sites without an AD field
+        if ad_ok:
+            lines.append('\t'.join(site + row) + '\t\n')
         else:
-            tmp = line.strip().split('\t')
-            #   Parse out the relevant information
-            chromosome = tmp[0]
-            bp_pos = tmp[1]
-            ref = tmp[3]
-            alt = tmp[4]
-            filt = tmp[6]
-            sample_info = tmp[9:]
-            if 'LowQual' in filt:
-                notes = 'Low Confidence Genotype'
-            else:
-                notes = ''
-            format = tmp[8].split(':')
-            sample_genotypes = [x.split(':') for x in sample_info]
-            #   check if AD is not in the format field
-            #   if not, then skip it
-            if 'AD' not in format:
-                notes = 'Missing Genotype Call'
-                print '\t'.join([chromosome + ':' + bp_pos, ref, alt] + len(samples)*['NA', 'NA'] + [notes])
-            else:
-                notes = ''
-                #   Which column is the AD?
-                AD_pos = format.index('AD')
-                #   For each sample...
-                sample_variant_info = []
-                for s in sample_info:
-                    #   If it is totall missing
-                    if s == './.':
-                        AAF = 'NA'
-                        total_depth = 'NA'
-                    else:
-                        gt = s.split(':')
-                        #   If that sample has missing information
-                        if gt[AD_pos] == '.':
-                            AAF = 'NA'
-                            total_depth = 'NA'
-                        else:
-                            #   Get the allele depths
-                            AD = gt[AD_pos].split(',')
-                            #   Convert to float
-                            AD_flt = [float(i) for i in AD]
-                            total_depth = sum(AD_flt)
-                            if total_depth == 0:
-                                AAF = '1.0'
-                            else:
-                                AAF = str(AD_flt[1]/total_depth)
-                    sample_variant_info += [str(AAF), str(total_depth)]
-                sample_list = [chromosome + ':' + bp_pos, ref, alt] + sample_variant_info + [notes]
-                print '\t'.join(sample_list)
+            lines.append(
+                '\t'.join(site + nsamp * ['NA', 'NA']) +
+                '\tMissing Genotype Call\n')
+    return lines
+
+
+def block_columns(block, nsamp):
+    """Return the site columns and the matrices of the sites in a block, for
+    the columnar file."""
+    aaf, depth, missing, has_ad = block_values(block, nsamp)
+    aaf = aaf.astype(numpy.float32)
+    aaf[missing] = numpy.nan
+    depth = depth.astype(numpy.int32)
+    depth[missing] = -1
+    sites = {
+        'chrom': [rec.chrom for rec in block],
+        'pos': numpy.array(
+            [rec.fields()[vcf_parse.POS] for rec in block], dtype=numpy.int64),
+        'ref': [rec.ref for rec in block],
+        'alt': [rec.alt for rec in block],
+        'has_ad': has_ad}
+    return sites, {'aaf': aaf, 'depth': depth}
+
+
+parser = argparse.ArgumentParser(
+    description=('Calculate the alternate allele frequency and read depth of '
+                 'each sample at each variant in a VCF, from the AD field.'),
+    add_help=True)
+parser.add_argument('vcf', metavar='VCF', help='VCF with AD annotations')
+parser.add_argument(
+    '--region',
+    '-r',
+    required=False,
+    help=('Only use the variants in this region, given as chrom, '
+          'chrom:start, or chrom:start-end (1-based).'),
+    default=None)
+parser.add_argument(
+    '--regions-file',
+    '-R',
+    required=False,
+    help='Only use the variants in the regions in this BED file.',
+    default=None)
+parser.add_argument(
+    '--binary',
+    '-b',
+    required=False,
+    help=('Write the frequencies and depths to this columnar file (a zip of '
+          'NumPy arrays, one for each sample, that numpy.load() can open) '
+          'in place of the text table.'),
+    default=None)
+parser.add_argument(
+    '--uncompressed',
+    required=False,
+    action='store_true',
+    help=('Store the columns of --binary uncompressed, so they can be '
+          'memory-mapped when they are read.'),
+    default=False)
+args = parser.parse_args()
+regions = vcf_parse.get_regions(args.region, args.regions_file)
+
+#   Start iterating through the file
+with vcf_parse.VCFReader(args.vcf, regions) as f:
+    #   This defines how many samples in the VCF
+    samples = f.samples
+    if args.binary:
+        with columnar.Writer(
+                args.binary, samples, not args.uncompressed) as out:
+            for block in f.blocks(block_size):
+                out.append(*block_columns(block, len(samples)))
+    else:
+        #   Create the list of sub-fields for each sample
+        sample_sub_fields = ['_AltAlleleFreq', '_ReadDepth']
+        #   And tack them together
+        per_sample = []
+        for s in samples:
+            for sb in sample_sub_fields:
+                per_sample.append(s+sb)
+        #   Append the header to the list of data to write
+        print(
+            'SNPPos\tRefAllele\tAltAllele\t' + '\t'.join(per_sample) +
+            '\tNotes')
+        for block in f.blocks(block_size):
+            sys.stdout.write(''.join(block_lines(block, len(samples))))
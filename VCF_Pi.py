@@ -1,114 +1,438 @@
 #!/usr/bin/env python
 """Calculates average nuceotide dieversity (Tajima's Pi) over a region using a
 VCF and BED file. Assumes highly inbred samples, so genotypes are treated as
-haploid calls, and heteroygous calls are treated as missing data. Note this
-designed to be run over a single contig/chromosome, as it uses integers as
-keys for identifying the number of unique variants."""
-
-import sys
-
-
-def n_choose_r(n, r):
-    """nCr implemented recursively. Not the *MOST* efficient, but better than
-    computing factorials."""
-    if r == 1:
-        return n
-    elif r == n:
-        return 1
-    elif r == 0 or n == 0:
-        return 0
-    else:
-        return n_choose_r(n-1, r-1) + n_choose_r(n-1, r)
+haploid calls, and heteroygous calls are treated as missing data. Sites are
+kept by chromosome and position, and each BED interval is matched to the sites
+on its own chromosome. The VCF is decoded in blocks of sites, and the
+diversity of a whole block is calculated at once.
 
+With --stream, a sorted VCF and BED are read together, and each interval is
+printed as soon as it is done, so only the sites in the current interval are
+kept in memory. With --window (and --step), diversity is calculated in sliding
+windows along each chromosome instead, with no BED; the output then has the
+chromosome as its first column. Windows are half-open: a window from start
+to end holds the sites with start < POS <= end, so windows that tile a
+chromosome count each site once.
 
-def pairwise_diversity(calls):
-    """Calculate pairwise diversity given a list of genotype calls. Returns 0
-    for a monomorphic site, or sites with only one non-missing call."""
-    #   Count up the number of reference and alternate genotypes.
-    if 0 in calls:
-        ref_count = calls.count(0)
-    else:
-        return 0
-    if 1 in calls:
-        alt_count = calls.count(1)
-    else:
-        return 0
+With --region or --regions-file, only the sites in those regions are read. If
+the VCF is bgzipped and has a .tbi or .csi index, only the parts of the file
+that hold them are decompressed.
+
+Requires NumPy and vcf_parse.py."""
+
+import argparse
+from collections import deque
+from itertools import takewhile
+
+import numpy
+
+import vcf_parse
+
+#   How many VCF lines to decode at a time
+BLOCK_SIZE = 10000
+
+
+def n_choose_2(n):
+    """The number of pairs that can be drawn from n things, for an array of n.
+    This is nCr with r = 2, in closed form."""
+    return n * (n - 1) // 2
+
+
+def pairwise_diversity(ref_count, alt_count):
+    """Calculate pairwise diversity given arrays of the number of reference and
+    alternate calls at each site. Returns 0 for a monomorphic site, or sites
+    with only one non-missing call."""
     #   This sample size will change depending on how many non-missing genotypes
     #   there are.
     total_count = ref_count + alt_count
     #   Calculate up the similarities based on the number of reference and
     #   alternative genotypes. Calculate the number of pairwise comparisons
     #   that were made.
-    ref_sim = n_choose_r(ref_count, 2)
-    alt_sim = n_choose_r(alt_count, 2)
-    total_comp = n_choose_r(total_count, 2)
-    #   Then pairwise diversity is 1-[(ref_sim + alt_sim)/total_comp]
-    return 1 - ((ref_sim + alt_sim) / float(total_comp))
+    ref_sim = n_choose_2(ref_count)
+    alt_sim = n_choose_2(alt_count)
+    total_comp = n_choose_2(total_count)
+    #   Then pairwise diversity is 1-[(ref_sim + alt_sim)/total_comp]. Sites
+    #   without both alleles would divide by zero; they are set to 0 after.
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pi = 1 - ((ref_sim + alt_sim) / total_comp.astype(numpy.float64))
+    pi[(ref_count == 0) | (alt_count == 0)] = 0
+    return pi
+
+
+class PiGenotypes(vcf_parse.GenotypeTable):
+    """Genotype codes that also keep track of which calls are homozygous for
+    the reference or the alternate allele. Calls are treated as haploid, so
+    heterozygous and missing calls are not counted at all."""
+
+    def __init__(self):
+        vcf_parse.GenotypeTable.__init__(self)
+        self.hom_ref = numpy.zeros(0, dtype=bool)
+        self.hom_alt = numpy.zeros(0, dtype=bool)
+
+    def added(self, gt):
+        self.hom_ref = numpy.append(self.hom_ref, gt == '0/0')
+        self.hom_alt = numpy.append(self.hom_alt, gt == '1/1')
 
 
-def read_vcf(vcf):
+def decode_block(records, gtab):
+    """Given a list of VCFRecords, return an array of their positions and an
+    array of the pairwise diversity at each one."""
+    positions = numpy.array([r.pos for r in records], dtype=numpy.int64)
+    #   Get the genotype calls from the sample info fields, as a sites x
+    #   samples array of codes.
+    codes = gtab.decode(records)
+    ref_count = gtab.hom_ref[codes].sum(axis=1)
+    alt_count = gtab.hom_alt[codes].sum(axis=1)
+    return (positions, pairwise_diversity(ref_count, alt_count))
+
+
+def site_blocks(reader, block_size=BLOCK_SIZE):
+    """Read a VCF from a VCFReader, and yield blocks of sites from the same
+    chromosome, in the order they appear. Each block is the chromosome, an
+    array of positions, and an array of the pairwise diversity at each
+    position."""
+    gtab = PiGenotypes()
+    block = []
+    block_chrom = None
+    for rec in reader:
+        chrom = rec.chrom
+        if block and (chrom != block_chrom or len(block) >= block_size):
+            yield (block_chrom, ) + decode_block(block, gtab)
+            block = []
+        block_chrom = chrom
+        block.append(rec)
+    if block:
+        yield (block_chrom, ) + decode_block(block, gtab)
+
+
+def sort_sites(positions, pi_vals):
+    """Sort the sites of a chromosome on position. If a position is in the VCF
+    more than once, the last one is kept. Returns the sorted arrays."""
+    order = numpy.argsort(positions, kind='stable')
+    positions = positions[order]
+    pi_vals = pi_vals[order]
+    last = numpy.append(positions[1:] != positions[:-1], True)
+    return (positions[last], pi_vals[last])
+
+
+def read_vcf(vcf, regions=None):
     """Read a VCF, and calculate pairwise diversity for each site. Returns a
-    a dictionary with genomic coordinate as key and pairwise diversity as the
-    value."""
+    dictionary with chromosome as key, and sorted arrays of the positions and
+    their pairwise diversity as values. If regions are given, only the sites
+    in them are read."""
+    blocks = {}
+    with vcf_parse.VCFReader(vcf, regions) as reader:
+        for chrom, positions, pi_vals in site_blocks(reader):
+            blocks.setdefault(chrom, []).append((positions, pi_vals))
     vcfdata = {}
-    with open(vcf, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            else:
-                tmp = line.strip().split()
-                pos = int(tmp[1])
-                sample_info = tmp[9:]
-                #   Get the genotype calls from the sample info fields
-                gt = [t.split(':')[0] for t in sample_info]
-                hap_calls = []
-                for g in gt:
-                    if g == '0/0':
-                        hap_calls.append(0)
-                    elif g == '1/1':
-                        hap_calls.append(1)
-                    else:
-                        hap_calls.append('NA')
-                site_pi = pairwise_diversity(hap_calls)
-                vcfdata[pos] = site_pi
+    for chrom, b in blocks.items():
+        vcfdata[chrom] = sort_sites(
+            numpy.concatenate([x[0] for x in b]),
+            numpy.concatenate([x[1] for x in b]))
     return vcfdata
 
 
-def calc_div_bed(vcfdata, bed):
-    """Read a BED file, and for each interval, calculate the average pairwise
-    diversity in it. Prints the interval start, end, and the average pairwise
-    diversity."""
-    avg_pairwise_divs = []
+def interval_pi(start, end, in_interval):
+    """Given the pi values of the sites in an interval, find the average
+    pairwise diversity in it. We will just sum the diversities of the
+    individual variants, then divide by the number of sites in the interval.
+    """
+    return sum(in_interval) / float(end - start - len(in_interval))
+
+
+def bed_intervals(bed):
+    """Yield the chromosome, start, and end of each interval in a BED file.
+    Some intervals are of 0 length - these are skipped."""
     with open(bed, 'r') as f:
         for line in f:
             tmp = line.strip().split()
-            #   Add 1 to the end, for 0-based BED coords
             start = int(tmp[1])
             end = int(tmp[2])
-            #   Some intervals are of 0 length - return 0 for these.
             if start == end:
                 continue
-            #   Get the pi values that are between the current BED interval
-            in_interval = [
-                vcfdata[k]
-                for k in vcfdata.keys()
-                if (k >= start and k <= end)]
-            #   Next, find the average pairwise diversity. We will just sum the
-            #   diversities of the individual variants, then divide by the
-            #   number of sites in the interval.
-            pair_div = sum(in_interval) / float(end - start - len(in_interval))
-            #   Then, append it to the list
-            avg_pairwise_divs.append((str(start), str(end), str(pair_div)))
+            yield (tmp[0], start, end)
+
+
+def calc_div_bed(vcfdata, bed):
+    """Read a BED file, and for each interval, calculate the average pairwise
+    diversity in it. Prints the interval start, end, and the average pairwise
+    diversity."""
+    avg_pairwise_divs = []
+    #   Intervals on chromosomes without any sites
+    no_sites = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+    for chrom, start, end in bed_intervals(bed):
+        #   The sites are sorted, so the ones in each interval can be found
+        #   with a binary search, rather than checking every site.
+        positions, pi_vals = vcfdata.get(chrom, no_sites)
+        #   Get the pi values that are between the current BED interval.
+        #   These are summed one by one, rather than from a running total,
+        #   so that the sums come out the same as they always have.
+        in_interval = pi_vals[
+            numpy.searchsorted(positions, start, side='left'):
+            numpy.searchsorted(positions, end, side='right')].tolist()
+        pair_div = interval_pi(start, end, in_interval)
+        #   Then, append it to the list
+        avg_pairwise_divs.append((str(start), str(end), str(pair_div)))
     return avg_pairwise_divs
 
 
-def main(vcf, bed):
+class SiteStream(object):
+    """Walks through the sites of a VCF that is sorted on position, keeping
+    only the sites that can still fall in an interval. Intervals have to be
+    asked for in order: chromosomes in the same order as the VCF, and starts
+    in increasing order within a chromosome. Only the sites from the start of
+    the current interval on are held, so memory use is bounded by the largest
+    interval (plus one block of the VCF).
+
+    chroms is the set of chromosomes that intervals will be asked for. Sites
+    on other chromosomes are skipped over to find the next one asked for. A
+    chromosome that has no sites cannot be told apart from one further on in
+    the VCF, so the sites are never skipped past a chromosome in chroms; if
+    one is reached first, the chromosome asked for is taken to have no sites.
+    If chroms is None, any chromosome might be asked for.
+
+    Contains the following methods:
+        window(self, chrom, start, end)
+            Returns the pi values of the sites in [start, end] on chrom.
+
+        more(self, chrom, start)
+            Returns whether there are sites on chrom at or after start.
+
+        skip(self, chrom)
+            Skips any sites left on chrom.
+
+        finish(self)
+            Checks that no chromosome that was taken to have no sites comes
+            later in the VCF.
+    """
+
+    def __init__(self, vcf, regions=None, chroms=None):
+        self.reader = vcf_parse.VCFReader(vcf, regions)
+        #   Contigs declared in the header, if there are any
+        self.contigs = self.reader.contigs() or None
+        self.sites = self._sites(self.reader)
+        self.pending = next(self.sites, None)
+        self.chrom = None
+        self.last_start = None
+        self.passed = set()
+        self.chroms = None if chroms is None else set(chroms)
+        #   Chromosomes that were taken to have no sites
+        self.empty = set()
+        self.buf = deque()
+
+    @staticmethod
+    def _sites(reader):
+        """Yield the chromosome, position, and pi of every site."""
+        for chrom, positions, pi_vals in site_blocks(reader):
+            for p, pi in zip(positions.tolist(), pi_vals.tolist()):
+                yield (chrom, p, pi)
+
+    def _switch(self, chrom):
+        """Move on to a new chromosome."""
+        if chrom in self.passed:
+            raise ValueError(
+                'Intervals on ' + chrom + ' are out of order with the VCF.')
+        if self.chrom is not None:
+            self.passed.add(self.chrom)
+        self.chrom = chrom
+        self.last_start = None
+        self.buf.clear()
+        #   If the VCF says which contigs it has, and this is not one, there
+        #   is no need to look for it.
+        if self.contigs is not None and chrom not in self.contigs:
+            return
+        #   Skip the sites on any chromosomes in between, unless they are
+        #   still to come
+        while self.pending is not None and self.pending[0] != chrom:
+            self._check_pending()
+            if self.chroms is None or (
+                    self.pending[0] in self.chroms and
+                    self.pending[0] not in self.passed):
+                self.empty.add(chrom)
+                return
+            self.passed.add(self.pending[0])
+            self.pending = next(self.sites, None)
+
+    def _check_pending(self):
+        """Raise an error if the next site is on a chromosome that was taken
+        to have no sites."""
+        if self.pending[0] in self.empty:
+            raise ValueError(
+                'Intervals on ' + self.pending[0] + ' are out of order with '
+                'the VCF.')
+
+    def _fill(self, end):
+        """Read sites on the current chromosome up to end."""
+        while self.pending is not None and self.pending[0] == self.chrom and \
+                self.pending[1] <= end:
+            _, p, pi = self.pending
+            if self.buf and p <= self.buf[-1][0]:
+                if p < self.buf[-1][0]:
+                    raise ValueError(
+                        'The VCF is not sorted: ' + self.chrom + ':' +
+                        str(p) + ' comes after ' + str(self.buf[-1][0]))
+                #   If a position is in the VCF more than once, the last one
+                #   is kept
+                self.buf.pop()
+            self.buf.append((p, pi))
+            self.pending = next(self.sites, None)
+            if self.pending is not None and self.pending[0] != self.chrom:
+                self._check_pending()
+            if self.pending is not None and self.pending[0] != self.chrom \
+                    and self.pending[0] in self.passed:
+                raise ValueError(
+                    'The VCF is not sorted: ' + self.pending[0] + ' is split '
+                    'up.')
+
+    def window(self, chrom, start, end):
+        if chrom != self.chrom:
+            self._switch(chrom)
+        if self.last_start is not None and start < self.last_start:
+            raise ValueError(
+                'Intervals on ' + chrom + ' are not sorted on start.')
+        self.last_start = start
+        self._fill(end)
+        #   Sites before this interval are not needed any more
+        while self.buf and self.buf[0][0] < start:
+            self.buf.popleft()
+        return [pi for p, pi in takewhile(lambda x: x[0] <= end, self.buf)]
+
+    def more(self, chrom, start):
+        if self.buf and self.buf[-1][0] >= start:
+            return True
+        return self.pending is not None and self.pending[0] == chrom
+
+    def skip(self, chrom):
+        while self.pending is not None and self.pending[0] == chrom:
+            self.pending = next(self.sites, None)
+
+    def finish(self):
+        while self.empty and self.pending is not None:
+            self._check_pending()
+            self.pending = next(self.sites, None)
+
+
+def stream_div_bed(vcf, bed, regions=None):
+    """Like calc_div_bed(), but the VCF and BED, both sorted, are read at the
+    same time. Yields the interval start, end, and average pairwise diversity
+    as soon as each interval is done."""
+    chroms = set(chrom for chrom, _, _ in bed_intervals(bed))
+    stream = SiteStream(vcf, regions, chroms)
+    for chrom, start, end in bed_intervals(bed):
+        pair_div = interval_pi(start, end, stream.window(chrom, start, end))
+        yield (str(start), str(end), str(pair_div))
+    stream.finish()
+
+
+def sliding_windows(vcf, size, step, regions=None):
+    """Yield the chromosome, start, end, and average pairwise diversity of
+    windows of size bp, every step bp, along each chromosome in a sorted VCF.
+    Windows have a 0-based start and an exclusive end, so a window holds the
+    sites with start < POS <= end. Unlike BED intervals, whose sites are
+    counted with start <= POS <= end as they always have been, windows that
+    meet at a boundary do not both count the site on it. Windows run to the
+    length of the contig if the VCF header gives it, and to the last site if
+    it does not. With regions, only the chromosomes and sites in them are
+    used."""
+    stream = SiteStream(vcf, regions)
+    while stream.pending is not None:
+        chrom = stream.pending[0]
+        length = None
+        if stream.contigs is not None:
+            length = stream.contigs.get(chrom)
+        start = 0
+        while True:
+            if length is not None:
+                if start >= length:
+                    break
+                end = min(start + size, length)
+            else:
+                if start > 0 and not stream.more(chrom, start + 1):
+                    break
+                end = start + size
+            pair_div = interval_pi(
+                start, end, stream.window(chrom, start + 1, end))
+            yield (chrom, str(start), str(end), str(pair_div))
+            start += step
+        #   Sites past the end of the contig are not in any window
+        stream.skip(chrom)
+
+
+def parse_args():
+    """Parse the arguments."""
+    parser = argparse.ArgumentParser(
+        description=('Calculate average nucleotide diversity over BED '
+                     'intervals or sliding windows, from a VCF of inbred '
+                     'samples.'),
+        add_help=True)
+    parser.add_argument('vcf', metavar='VCF', help='VCF of SNPs')
+    parser.add_argument(
+        'bed',
+        metavar='BED',
+        nargs='?',
+        help='Intervals to calculate diversity over',
+        default=None)
+    parser.add_argument(
+        '--stream',
+        '-s',
+        required=False,
+        action='store_true',
+        help=('Read the VCF and BED together, without holding the VCF in '
+              'memory. Both have to be sorted, with chromosomes in the same '
+              'order.'),
+        default=False)
+    parser.add_argument(
+        '--window',
+        '-w',
+        required=False,
+        type=int,
+        help=('Calculate diversity in windows of this many bp along each '
+              'chromosome, instead of over BED intervals. Implies --stream.'),
+        default=None)
+    parser.add_argument(
+        '--step',
+        required=False,
+        type=int,
+        help='Distance between window starts. Defaults to --window',
+        default=None)
+    parser.add_argument(
+        '--region',
+        '-r',
+        required=False,
+        help=('Only use the sites in this region, given as chrom, '
+              'chrom:start, or chrom:start-end (1-based).'),
+        default=None)
+    parser.add_argument(
+        '--regions-file',
+        '-R',
+        required=False,
+        help='Only use the sites in the regions in this BED file.',
+        default=None)
+    args = parser.parse_args()
+    if not args.bed and not args.window:
+        parser.error('Give either a BED file or --window.')
+    return args
+
+
+def main():
     """Main function."""
-    v = read_vcf(vcf)
-    d = calc_div_bed(v, bed)
+    args = parse_args()
+    regions = vcf_parse.get_regions(args.region, args.regions_file)
+    if args.window:
+        d = sliding_windows(
+            args.vcf,
+            args.window,
+            args.step or args.window,
+            regions)
+    elif args.stream:
+        d = stream_div_bed(args.vcf, args.bed, regions)
+    else:
+        v = read_vcf(args.vcf, regions)
+        d = calc_div_bed(v, args.bed)
     for i in d:
-        print '\t'.join(i)
+        print('\t'.join(i))
     return
 
 
-main(sys.argv[1], sys.argv[2])
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,608 @@
+#!/usr/bin/env python
+"""Low-level access to BGZF files, the blocked gzip format written by bgzip and
+htslib (.vcf.gz, .bam). A BGZF file is a series of independent gzip members of
+at most 64 KiB each, so it can be split at block boundaries and the pieces
+decompressed separately, in different processes if need be. A plain gzip file
+is not split this way, and has to be read as one stream.
+
+Contains the following functions:
+    is_bgzf(fname)
+        Returns True if the file starts with a BGZF block.
+
+    block_offsets(fname)
+        Returns the file offsets of every block in the file, by reading just
+        the block headers.
+
+    split_blocks(fname, nchunks)
+        Returns a list of (start, end) file offsets that split the file into
+        about nchunks pieces of similar compressed size, on block boundaries.
+
+    read_block(handle, offset)
+        Returns the decompressed data of the block at offset, and the offset of
+        the next block.
+
+    read_lines(fname, start, end)
+        Yields the lines (as text) that begin in the blocks between the
+        offsets start and end. Lines that run on past end are read to their
+        finish, and the first line is left to the piece before, so the pieces
+        from split_blocks() give every line exactly once.
+
+    virtual_offset(coffset, uoffset)
+        Returns the virtual offset of a position in the file: the offset of
+        the block it is in, and how far into the decompressed block it is.
+
+    read_chunks(fname, chunks)
+        Yields the lines (as text) that begin in each of a list of (start,
+        end) virtual offsets, such as the chunks of a tabix index.
+
+Contains the following classes:
+    LineReader: Reads the lines of a whole file, decompressing it in other
+                threads while the lines are used. BGZF blocks are inflated in
+                a pool of threads; a plain gzip file is inflated in one
+                background thread; other files are read as they are.
+    Writer:     Writes a BGZF file, compressing the blocks in a pool of
+                threads. The blocks are written in order, so the file can be
+                indexed with tabix or samtools.
+    BGZFError:  Raised when a file is not BGZF, or a block is damaged.
+
+Usage is something like:
+    with bgzf.LineReader('reads.fastq.gz', threads=4) as f, \
+            bgzf.Writer('out.fastq.gz', level=6, threads=4) as out:
+        for line in f:
+            out.write(line)
+"""
+
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#   The fixed part of a gzip member header, with the FEXTRA flag set. BGZF
+#   blocks all start with these four bytes.
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+#   The header is 12 bytes, then XLEN bytes of extra fields
+HEADER_SIZE = 12
+#   Virtual offsets hold the offset of the block in the high 48 bits, and the
+#   offset within the decompressed block in the low 16
+VOFFSET_SHIFT = 16
+VOFFSET_MASK = 0xFFFF
+#   A LineReader inflates this many BGZF blocks in each task it hands to a
+#   thread, and keeps at most this many tasks per thread waiting
+BLOCKS_PER_TASK = 16
+TASKS_PER_THREAD = 4
+#   Plain gzip and uncompressed files are read this many bytes at a time, and
+#   a LineReader keeps at most QUEUE_SIZE pieces waiting
+READ_SIZE = 1 << 20
+QUEUE_SIZE = 8
+#   The most data a Writer puts in a block. This is what htslib uses, so that
+#   even data that does not compress fits in the 64 KiB limit.
+BLOCK_DATA = 0xff00
+#   The header of a written block, up to the size of the block
+BLOCK_HEADER = BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+#   Threads to decompress with, if not given. zlib lets go of the GIL while it
+#   inflates, so threads really do run at the same time.
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+#   Compression level of a Writer, if not given. This is the zlib default,
+#   which is also what bgzip uses.
+DEFAULT_LEVEL = 6
+#   The empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+class BGZFError(IOError):
+    """Raised when a file is not BGZF, or a block in it is damaged."""
+
+
+def _block_size(header, extra):
+    """Given the 12-byte gzip header and the extra field of a BGZF block,
+    return the total size of the block in bytes."""
+    if header[:4] != BGZF_MAGIC:
+        raise BGZFError('Not a BGZF block.')
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack('<BBH', extra[pos:pos+4])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return struct.unpack('<H', extra[pos+4:pos+6])[0] + 1
+        pos += 4 + slen
+    raise BGZFError('gzip member has no BGZF block size.')
+
+
+def _read_header(handle, offset):
+    """Read the header of the block at offset. Returns the size of the header,
+    and the size of the whole block, or (0, 0) at the end of the file."""
+    handle.seek(offset)
+    header = handle.read(HEADER_SIZE)
+    if not header:
+        return (0, 0)
+    if len(header) < HEADER_SIZE:
+        raise BGZFError('Truncated BGZF block at offset ' + str(offset))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = handle.read(xlen)
+    return (HEADER_SIZE + xlen, _block_size(header, extra))
+
+
+def is_bgzf(fname):
+    """Returns True if fname starts with a BGZF block."""
+    with open(fname, 'rb') as f:
+        try:
+            return _read_header(f, 0)[1] > 0
+        except BGZFError:
+            return False
+
+
+def block_offsets(fname):
+    """Returns a list of the file offsets of every block in fname. Only the
+    headers are read, so this is fast even for large files."""
+    offsets = []
+    with open(fname, 'rb') as f:
+        offset = 0
+        while True:
+            bsize = _read_header(f, offset)[1]
+            if not bsize:
+                break
+            offsets.append(offset)
+            offset += bsize
+    return offsets
+
+
+def split_blocks(fname, nchunks):
+    """Split fname into about nchunks pieces of similar compressed size, at
+    block boundaries. Returns a list of (start, end) file offsets; end is None
+    for the last piece."""
+    offsets = block_offsets(fname)
+    if not offsets:
+        return []
+    nchunks = max(1, min(nchunks, len(offsets)))
+    step = len(offsets) / float(nchunks)
+    starts = sorted(set([offsets[int(i * step)] for i in range(nchunks)]))
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def read_block(handle, offset):
+    """Decompress the block at offset. Returns the data, and the offset of the
+    next block. The data is None at the end of the file."""
+    hsize, bsize = _read_header(handle, offset)
+    if not bsize:
+        return (None, offset)
+    handle.seek(offset + hsize)
+    cdata = handle.read(bsize - hsize)
+    if len(cdata) < bsize - hsize:
+        raise BGZFError('Truncated BGZF block at offset ' + str(offset))
+    return (_inflate(cdata, offset), offset + bsize)
+
+
+def _inflate(cdata, offset):
+    """Decompress the data of a block (everything after the header), and
+    check it against the size in the footer."""
+    try:
+        data = zlib.decompress(cdata[:-8], -15)
+    except zlib.error as e:
+        raise BGZFError(
+            'Damaged BGZF block at offset ' + str(offset) + ': ' + str(e))
+    isize = struct.unpack('<I', cdata[-4:])[0]
+    if len(data) != isize:
+        raise BGZFError('Damaged BGZF block at offset ' + str(offset))
+    return data
+
+
+def _inflate_blocks(blocks):
+    """Decompress a list of (offset, data) blocks, and join them up. Run in
+    the threads of a LineReader."""
+    return b''.join([_inflate(cdata, offset) for offset, cdata in blocks])
+
+
+def _deflate_blocks(data, level):
+    """Compress data, split into blocks of BLOCK_DATA bytes, and return the
+    whole BGZF blocks joined up. Run in the threads of a Writer."""
+    out = []
+    for pos in range(0, len(data), BLOCK_DATA):
+        piece = data[pos:pos+BLOCK_DATA]
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = c.compress(piece) + c.flush()
+        out.append(BLOCK_HEADER)
+        #   The size is of the whole block, less one
+        out.append(struct.pack('<H', HEADER_SIZE + 6 + len(cdata) + 8 - 1))
+        out.append(cdata)
+        out.append(struct.pack('<II', zlib.crc32(piece), len(piece)))
+    return b''.join(out)
+
+
+def _raw_blocks(handle):
+    """Yield the offset and the compressed data (after the header) of every
+    block in a BGZF file. The file is read in large pieces, rather than a
+    block at a time."""
+    buf = b''
+    pos = 0
+    offset = 0
+    while True:
+        #   Make sure the header is in buf, and then the whole block
+        need = HEADER_SIZE
+        bsize = None
+        while True:
+            if len(buf) - pos < need:
+                more = handle.read(max(READ_SIZE, need))
+                buf = buf[pos:] + more
+                pos = 0
+                if len(buf) < need:
+                    if buf:
+                        raise BGZFError(
+                            'Truncated BGZF block at offset ' + str(offset))
+                    return
+            if bsize is not None:
+                break
+            xlen = struct.unpack('<H', buf[pos+10:pos+12])[0]
+            if len(buf) - pos < HEADER_SIZE + xlen:
+                need = HEADER_SIZE + xlen
+                continue
+            bsize = _block_size(
+                buf[pos:pos+HEADER_SIZE],
+                buf[pos+HEADER_SIZE:pos+HEADER_SIZE+xlen])
+            need = bsize
+        yield (offset, buf[pos+HEADER_SIZE+xlen:pos+bsize])
+        pos += bsize
+        offset += bsize
+
+
+def read_lines(fname, start=0, end=None):
+    """Yield the lines that begin in the blocks from offset start up to offset
+    end, decoded as text with their newlines. end=None reads to the end of the
+    file. Unless start is 0, the first line is skipped whether or not it began
+    in an earlier block, and the line that begins right at end is read. That
+    way, the pieces from split_blocks() give every line exactly once."""
+    with open(fname, 'rb') as f:
+        offset = start
+        buf = b''
+        skip = start > 0
+        #   Once we get to end, how much of buf came from before it. Only lines
+        #   that begin at or before this point are ours.
+        limit = None
+        while True:
+            if limit is None and end is not None and offset >= end:
+                limit = len(buf)
+            data, offset = read_block(f, offset)
+            if data is None:
+                break
+            buf += data
+            if skip:
+                nl = buf.find(b'\n')
+                if nl < 0:
+                    continue
+                buf = buf[nl+1:]
+                if limit is not None:
+                    limit -= nl + 1
+                skip = False
+            pos = 0
+            while limit is None or pos <= limit:
+                nl = buf.find(b'\n', pos)
+                if nl < 0:
+                    break
+                yield buf[pos:nl+1].decode()
+                pos = nl + 1
+            else:
+                return
+            buf = buf[pos:]
+            if limit is not None:
+                limit -= pos
+        #   A last line without a newline
+        if buf and not skip and (limit is None or limit >= 0):
+            yield buf.decode()
+
+
+def virtual_offset(coffset, uoffset):
+    """Return the virtual offset of the position uoffset bytes into the
+    decompressed data of the block at file offset coffset."""
+    return (coffset << VOFFSET_SHIFT) | uoffset
+
+
+def read_chunks(fname, chunks):
+    """Yield the lines that begin in each chunk, a list of (start, end) virtual
+    offsets, decoded as text with their newlines. start has to be at the
+    start of a line, as it is in an index; a line that begins before end is
+    read to its finish. Chunks are read in the order given. A block that is
+    shared by two chunks in a row is only decompressed once."""
+    with open(fname, 'rb') as f:
+        cached = (None, None, None)
+        for start, end in chunks:
+            offset = start >> VOFFSET_SHIFT
+            pos = start & VOFFSET_MASK
+            carry = b''
+            while True:
+                if cached[0] == offset:
+                    data, next_offset = cached[1:]
+                else:
+                    data, next_offset = read_block(f, offset)
+                    cached = (offset, data, next_offset)
+                if data is None:
+                    break
+                if carry:
+                    #   Finish the line that ran on from the block before
+                    nl = data.find(b'\n')
+                    if nl < 0:
+                        carry += data
+                        offset = next_offset
+                        continue
+                    yield (carry + data[:nl+1]).decode()
+                    carry = b''
+                    pos = nl + 1
+                while pos < len(data):
+                    if virtual_offset(offset, pos) >= end:
+                        break
+                    nl = data.find(b'\n', pos)
+                    if nl < 0:
+                        carry = data[pos:]
+                        pos = len(data)
+                        break
+                    yield data[pos:nl+1].decode()
+                    pos = nl + 1
+                if pos < len(data):
+                    #   Stopped at the end of the chunk
+                    break
+                if not carry and virtual_offset(offset, len(data)) >= end:
+                    break
+                offset = next_offset
+                pos = 0
+            #   A last line without a newline
+            if carry:
+                yield carry.decode()
+
+
+class LineReader(object):
+    """Reads the lines of a file, with the decompression done in other threads
+    so that it overlaps with whatever is done with the lines. A BGZF file is
+    inflated in a pool of threads, a few blocks to each task, and the tasks
+    are handed back in order through a bounded queue. A plain gzip file is
+    inflated in one background thread, which feeds a bounded queue. Anything
+    else is read as it is. The lines come out in order, with their newlines,
+    as text or (with binary=True) bytes.
+
+    start skips that many bytes of the uncompressed data first, like
+    seek() on a gzip file does. It should be at the start of a line.
+
+    Iterate over the reader for the lines, and close() it (or use it in a
+    with statement) if it is not read to the end, to stop the threads.
+    """
+
+    def __init__(self, fname, threads=None, binary=False, start=0):
+        self.fname = fname
+        self.threads = max(1, threads or DEFAULT_THREADS)
+        self.binary = binary
+        self.start = start
+        with open(fname, 'rb') as f:
+            magic = f.read(2)
+        if is_bgzf(fname):
+            self.chunks = self._bgzf_chunks()
+        elif magic == b'\x1f\x8b':
+            self.chunks = self._gzip_chunks()
+        else:
+            self.chunks = self._plain_chunks()
+        self.lines = self._lines()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def close(self):
+        self.lines.close()
+        self.chunks.close()
+
+    def _bgzf_chunks(self):
+        """Yield the inflated data, a few blocks at a time, in order."""
+        pool = ThreadPoolExecutor(self.threads)
+        pending = deque()
+        try:
+            with open(self.fname, 'rb') as f:
+                batch = []
+                for block in _raw_blocks(f):
+                    batch.append(block)
+                    if len(batch) < BLOCKS_PER_TASK:
+                        continue
+                    pending.append(pool.submit(_inflate_blocks, batch))
+                    batch = []
+                    if len(pending) >= self.threads * TASKS_PER_THREAD:
+                        yield pending.popleft().result()
+                if batch:
+                    pending.append(pool.submit(_inflate_blocks, batch))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for task in pending:
+                task.cancel()
+            pool.shutdown()
+
+    def _gzip_chunks(self):
+        """Yield the inflated data of a plain gzip file, from a background
+        thread."""
+        pieces = queue.Queue(maxsize=QUEUE_SIZE)
+        stop = threading.Event()
+
+        def put(item):
+            #   Give up if the reader is closed while the queue is full
+            while not stop.is_set():
+                try:
+                    pieces.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def inflate():
+            try:
+                with open(self.fname, 'rb') as f:
+                    #   wbits of 31 reads the gzip header and footer. A file
+                    #   can be several gzip members one after the other.
+                    d = zlib.decompressobj(31)
+                    started = False
+                    while not stop.is_set():
+                        cdata = f.read(READ_SIZE)
+                        if not cdata:
+                            break
+                        while cdata:
+                            started = True
+                            data = d.decompress(cdata)
+                            if data:
+                                put(data)
+                            cdata = b''
+                            if d.eof:
+                                cdata = d.unused_data
+                                d = zlib.decompressobj(31)
+                                started = False
+                                #   Zeros after the last member are padding
+                                if not cdata.strip(b'\x00'):
+                                    cdata = b''
+                    if started and not stop.is_set():
+                        raise EOFError(
+                            self.fname + ' ended before the end of the gzip '
+                            'data.')
+                put(None)
+            except Exception as e:
+                put(e)
+
+        worker = threading.Thread(target=inflate)
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                item = pieces.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+
+    def _plain_chunks(self):
+        """Yield the data of an uncompressed file."""
+        with open(self.fname, 'rb') as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def _split(self, data):
+        """Split data that ends at the end of a line into lines. Text is
+        split the same way as gzip.open(fname, 'rt') would."""
+        if self.binary:
+            return io.BytesIO(data)
+        return io.TextIOWrapper(io.BytesIO(data))
+
+    def _lines(self):
+        skip = self.start
+        carry = b''
+        for data in self.chunks:
+            if skip:
+                if len(data) <= skip:
+                    skip -= len(data)
+                    continue
+                data = data[skip:]
+                skip = 0
+            #   Only whole lines are split up; the rest waits for the next
+            #   piece
+            nl = data.rfind(b'\n')
+            if nl < 0:
+                carry += data
+                continue
+            for line in self._split(carry + data[:nl+1]):
+                yield line
+            carry = data[nl+1:]
+        if carry:
+            for line in self._split(carry):
+                yield line
+
+
+class Writer(object):
+    """Writes a BGZF file. Data is cut into blocks of BLOCK_DATA bytes, a few
+    blocks to a task, and the tasks are compressed in a pool of threads at
+    the given zlib level. They are written out in order, and at most a few
+    tasks per thread are kept waiting. close() writes the last block and the
+    end-of-file marker; the file is not complete without it.
+
+    fname can also be an open binary file, such as sys.stdout.buffer. It is
+    left open when the Writer is closed.
+
+    Contains the following methods:
+        write(self, data)
+            Writes text or bytes.
+
+        flush(self)
+            Compresses and writes everything so far. The data written so far
+            ends a block, so flushing often makes the file bigger.
+
+        close(self)
+            Flushes, writes the end-of-file marker, and closes the file.
+    """
+
+    def __init__(self, fname, level=None, threads=None):
+        if hasattr(fname, 'write'):
+            self.handle = fname
+            self.own_handle = False
+        else:
+            self.handle = open(fname, 'wb')
+            self.own_handle = True
+        self.level = DEFAULT_LEVEL if level is None else level
+        self.threads = max(1, threads or DEFAULT_THREADS)
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buf = bytearray()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buf += data
+        task_size = BLOCK_DATA * BLOCKS_PER_TASK
+        if len(self.buf) >= task_size:
+            #   Whole tasks go off to the threads; the rest waits for more
+            end = len(self.buf) - len(self.buf) % task_size
+            for pos in range(0, end, task_size):
+                self._submit(bytes(self.buf[pos:pos+task_size]))
+            del self.buf[:end]
+
+    def _submit(self, data):
+        """Hand data to the threads, and write out the oldest tasks if too
+        many are waiting."""
+        self.pending.append(
+            self.pool.submit(_deflate_blocks, data, self.level))
+        while len(self.pending) > self.threads * TASKS_PER_THREAD:
+            self.handle.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.handle.write(self.pending.popleft().result())
+        self.handle.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self.handle.write(EOF_BLOCK)
+            self.handle.flush()
+        finally:
+            self.closed = True
+            self.pool.shutdown()
+            if self.own_handle:
+                self.handle.close()
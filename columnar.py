@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Writes and reads tables of per-sample values, such as allele frequencies
+or genotype calls at each site, as a columnar binary file. The file is a zip
+archive of NumPy .npy members, so numpy.load() can open it as an .npz too.
+Each sample's column of each matrix is a member of its own, so one sample can
+be read without reading or decompressing the rest of the file:
+    samples.npy         The sample names
+    sites/<name>.npy    One value for each site, such as chrom or pos
+    <matrix>/<i>.npy    The values of sample i at each site
+
+The members are compressed with deflate by default. Uncompressed members are
+stored as they are, and the Reader memory-maps them in place of reading them.
+
+Contains the following classes:
+    Writer:         Writes a columnar file, a block of sites at a time. The
+                    matrices are kept in temporary files until close(), and
+                    then split into columns.
+    Reader:         Reads the samples, site columns, and sample columns of a
+                    columnar file.
+    ColumnarError:  Raised when a file is not a columnar file, or is missing
+                    a column that was asked for.
+
+Usage is something like:
+    with columnar.Writer('out.npz', samples) as out:
+        for block in blocks:
+            out.append({'pos': pos}, {'aaf': aaf, 'depth': depth})
+    with columnar.Reader('out.npz') as f:
+        aaf = f.column('aaf', 'sample_1', mmap=True)
+"""
+
+import os
+import struct
+import tempfile
+import zipfile
+
+import numpy
+
+#   A zip local file header is 30 bytes, then the file name and extra field,
+#   whose lengths are the last two 16-bit fields of the header
+LOCAL_HEADER_SIZE = 30
+#   About how many bytes of a matrix to hold in memory at once, when it is
+#   split into columns
+TRANSPOSE_BYTES = 1 << 26
+
+
+class ColumnarError(IOError):
+    pass
+
+
+def _member(matrix, i):
+    """Return the name of the member that holds column i of a matrix."""
+    return matrix + '/' + str(i) + '.npy'
+
+
+class Writer(object):
+    """Writes a columnar file. append() takes a block of sites at a time: a
+    dictionary of site columns, each a 1-D array with one value per site, and
+    a dictionary of matrices, each with one row per site and one column per
+    sample. Every block has to give the same names. The dtype of a matrix is
+    set by its first block, so string matrices should be written in one
+    block, or given a wide enough dtype up front. close() writes the file; it
+    is not complete without it. If the body of a with block raises an
+    exception, the file is not written, and the temporary files are dropped.
+
+    Contains the following methods:
+        append(self, sites, matrices)
+            Adds a block of sites.
+
+        close(self)
+            Splits the matrices into columns, and writes out the file.
+
+        discard(self)
+            Drops what was appended, without writing the file.
+    """
+
+    def __init__(self, fname, samples, compress=True):
+        self.fname = fname
+        self.samples = list(samples)
+        self.compress = compress
+        self.nsites = 0
+        self.sites = {}
+        self.matrices = {}
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def append(self, sites, matrices):
+        for name, values in sites.items():
+            self.sites.setdefault(name, []).append(numpy.asarray(values))
+        n = None
+        for name, values in matrices.items():
+            values = numpy.asarray(values)
+            if values.ndim != 2 or values.shape[1] != len(self.samples):
+                raise ValueError(
+                    name + ' has shape ' + str(values.shape) + ', not one '
+                    'column for each of ' + str(len(self.samples)) +
+                    ' samples')
+            n = values.shape[0]
+            if name not in self.matrices:
+                #   Rows go into a temporary file next to the output, and are
+                #   only read back as columns at the end
+                tmp = tempfile.TemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(self.fname)))
+                self.matrices[name] = (tmp, values.dtype)
+            tmp, dtype = self.matrices[name]
+            tmp.write(numpy.ascontiguousarray(values, dtype=dtype).tobytes())
+        if n is None and sites:
+            n = len(next(iter(sites.values())))
+        self.nsites += n or 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        method = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+        try:
+            with zipfile.ZipFile(self.fname, 'w', method) as z:
+                self._write(z, 'samples.npy', numpy.array(self.samples))
+                for name, parts in self.sites.items():
+                    self._write(
+                        z, 'sites/' + name + '.npy', numpy.concatenate(parts))
+                for name, (tmp, dtype) in self.matrices.items():
+                    self._write_columns(z, name, tmp, dtype)
+        except BaseException:
+            #   Don't leave a file that looks complete but is not
+            if os.path.exists(self.fname):
+                os.remove(self.fname)
+            raise
+        finally:
+            for tmp, _ in self.matrices.values():
+                tmp.close()
+
+    def discard(self):
+        if self.closed:
+            return
+        self.closed = True
+        for tmp, _ in self.matrices.values():
+            tmp.close()
+
+    def _write(self, z, member, values):
+        with z.open(member, 'w', force_zip64=True) as out:
+            numpy.lib.format.write_array(out, values, allow_pickle=False)
+
+    def _write_columns(self, z, name, tmp, dtype):
+        """Read a matrix back from its temporary file a few columns at a
+        time, and write each column as a member."""
+        nsamp = len(self.samples)
+        tmp.flush()
+        if self.nsites == 0 or nsamp == 0:
+            for i in range(nsamp):
+                self._write(z, _member(name, i), numpy.empty(0, dtype=dtype))
+            return
+        rows = numpy.memmap(
+            tmp, dtype=dtype, mode='r', shape=(self.nsites, nsamp))
+        step = max(1, TRANSPOSE_BYTES // (self.nsites * dtype.itemsize))
+        for start in range(0, nsamp, step):
+            cols = numpy.array(rows[:, start:start+step].T)
+            for i, col in enumerate(cols, start):
+                self._write(z, _member(name, i), col)
+        del rows
+
+
+class Reader(object):
+    """Reads a columnar file. Columns are only read when they are asked for.
+    With mmap=True, a column that was stored uncompressed is memory-mapped
+    from the file; a compressed one is read and decompressed as usual.
+
+    Contains the following methods:
+        site(self, name, mmap=False)
+            Returns a site column.
+
+        column(self, matrix, sample, mmap=False)
+            Returns the column of a matrix for one sample, given by name or
+            by index.
+
+        matrix(self, name)
+            Returns a whole matrix, with one column for each sample.
+
+        close(self)
+            Closes the file.
+
+    Contains the following attributes:
+        samples     The sample names
+        site_names  The names of the site columns
+        matrices    The names of the matrices
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        try:
+            self.zip = zipfile.ZipFile(fname)
+        except zipfile.BadZipFile as e:
+            raise ColumnarError(fname + ' is not a columnar file: ' + str(e))
+        names = self.zip.namelist()
+        if 'samples.npy' not in names:
+            self.zip.close()
+            raise ColumnarError(fname + ' has no samples.npy')
+        self.samples = self._load('samples.npy').tolist()
+        self.sample_index = dict((s, i) for i, s in enumerate(self.samples))
+        self.site_names = [
+            n[len('sites/'):-len('.npy')]
+            for n
+            in names
+            if n.startswith('sites/')]
+        self.matrices = sorted(set(
+            n.split('/')[0]
+            for n
+            in names
+            if n.endswith('/0.npy') and not n.startswith('sites/')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def site(self, name, mmap=False):
+        return self._load('sites/' + name + '.npy', mmap)
+
+    def column(self, matrix, sample, mmap=False):
+        if not isinstance(sample, int):
+            if sample not in self.sample_index:
+                raise ColumnarError(
+                    self.fname + ' has no sample ' + str(sample))
+            sample = self.sample_index[sample]
+        return self._load(_member(matrix, sample), mmap)
+
+    def matrix(self, name):
+        cols = [self.column(name, i) for i in range(len(self.samples))]
+        return numpy.column_stack(cols) if cols else numpy.empty((0, 0))
+
+    def _load(self, member, mmap=False):
+        try:
+            info = self.zip.getinfo(member)
+        except KeyError:
+            raise ColumnarError(self.fname + ' has no ' + member)
+        if mmap and info.compress_type == zipfile.ZIP_STORED:
+            return self._mmap(info)
+        with self.zip.open(info) as handle:
+            return numpy.lib.format.read_array(handle, allow_pickle=False)
+
+    def _mmap(self, info):
+        """Memory-map a member that was stored uncompressed. Its data start
+        after the local file header, and the .npy header after that."""
+        with open(self.fname, 'rb') as handle:
+            handle.seek(info.header_offset)
+            header = handle.read(LOCAL_HEADER_SIZE)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            handle.seek(
+                info.header_offset + LOCAL_HEADER_SIZE + name_len + extra_len)
+            version = numpy.lib.format.read_magic(handle)
+            if version == (1, 0):
+                header = numpy.lib.format.read_array_header_1_0(handle)
+            else:
+                header = numpy.lib.format.read_array_header_2_0(handle)
+            shape, fortran_order, dtype = header
+            offset = handle.tell()
+        if 0 in shape:
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.memmap(
+            self.fname,
+            dtype=dtype,
+            mode='r',
+            shape=shape,
+            order='F' if fortran_order else 'C',
+            offset=offset)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""Random access to sequences in a FASTA file through a samtools-style .fai
+index. The index is read from FASTA.fai if it exists, and built (and written
+next to the FASTA, if possible) if it does not. The FASTA itself is memory
+mapped, so only the pieces of sequence that are actually fetched are read from
+disk, and opening a large genome a second time is instant.
+
+Contains the following classes:
+    FastaIndexError:    Raised when the FASTA cannot be indexed, or when a
+                        queried sequence is not in the index.
+    FastaSequence:      A lazy, sliceable view of one sequence in the FASTA.
+    IndexedFasta:       Reads or builds the index, and hands out sequences.
+
+Usage is something like:
+    ref = fasta_index.IndexedFasta('genome.fa')
+    chrom = ref['chr1']
+    len(chrom)      # Length of chr1
+    chrom[99:200]   # Bases 100 to 200 (1-based) as a string
+"""
+
+import os
+import mmap
+import sys
+from collections import namedtuple
+
+#   One line of a .fai: the name of the sequence, its length, the byte offset
+#   of its first base, the number of bases on each line, and the number of
+#   bytes in each line, including the newline.
+FaiEntry = namedtuple(
+    'FaiEntry',
+    ['name', 'length', 'offset', 'linebases', 'linewidth'])
+
+
+class FastaIndexError(LookupError):
+    """Raised when a FASTA cannot be indexed, or when a sequence is not found
+    in the index."""
+
+
+class FastaSequence(object):
+    """A lazy view of one sequence in an IndexedFasta. Slicing it with 0-based
+    [start:end) coordinates reads just that piece of the FASTA and returns it
+    as a string. str() gives the whole sequence."""
+    __slots__ = ['fasta', 'entry']
+
+    def __init__(self, fasta, entry):
+        self.fasta = fasta
+        self.entry = entry
+
+    @property
+    def id(self):
+        return self.entry.name
+
+    def __len__(self):
+        return self.entry.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.entry.length)
+            if step != 1:
+                return self.fasta.fetch(self.entry.name, start, end)[::step]
+            return self.fasta.fetch(self.entry.name, start, end)
+        #   Single bases, with support for negative indices
+        if key < 0:
+            key += self.entry.length
+        if key < 0 or key >= self.entry.length:
+            raise IndexError('Position out of range of ' + self.entry.name)
+        return self.fasta.fetch(self.entry.name, key, key + 1)
+
+    def __str__(self):
+        return self.fasta.fetch(self.entry.name)
+
+
+class IndexedFasta(object):
+    """Handles the .fai index and the memory map of a FASTA file. Sequences
+    can be fetched by name with fetch(), or as FastaSequence objects with
+    indexing, like a dictionary.
+
+    Contains the following methods:
+        fetch(self, name, start=0, end=None)
+            Returns the bases in [start, end) of the named sequence, in 0-based
+            coordinates, as a string. Raises FastaIndexError if the name is
+            not in the index.
+
+        keys(self)
+            Returns the sequence names in the order they appear in the FASTA.
+
+        close(self)
+            Closes the memory map and the file.
+    """
+
+    def __init__(self, fname):
+        if fname.endswith('.gz'):
+            raise FastaIndexError(
+                fname + ' is compressed. Please decompress it first.')
+        self.fname = fname
+        self.index = self.read_fai(fname)
+        self.handle = None
+        self.data = None
+        return
+
+    def __getstate__(self):
+        #   The memory map cannot be pickled. Send the index, and re-open the
+        #   map on the other side when it is first needed.
+        return {'fname': self.fname, 'index': self.index}
+
+    def __setstate__(self, state):
+        self.fname = state['fname']
+        self.index = state['index']
+        self.handle = None
+        self.data = None
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, name):
+        if name not in self.index:
+            raise FastaIndexError(
+                'Sequence {n} not found in FASTA!'.format(n=name))
+        return FastaSequence(self, self.index[name])
+
+    def keys(self):
+        return [
+            e.name
+            for e
+            in sorted(self.index.values(), key=lambda e: e.offset)
+            ]
+
+    @staticmethod
+    def read_fai(fname):
+        """Read FASTA.fai, building it first if it is not there or is older
+        than the FASTA. Returns a dictionary of FaiEntry, keyed on name."""
+        fai = fname + '.fai'
+        if os.path.isfile(fai) and \
+                os.path.getmtime(fai) >= os.path.getmtime(fname):
+            index = {}
+            with open(fai, 'r') as f:
+                for line in f:
+                    tmp = line.strip().split('\t')
+                    index[tmp[0]] = FaiEntry(
+                        tmp[0],
+                        int(tmp[1]),
+                        int(tmp[2]),
+                        int(tmp[3]),
+                        int(tmp[4]))
+            return index
+        entries = IndexedFasta.build_fai(fname)
+        try:
+            with open(fai, 'w') as f:
+                for e in entries:
+                    f.write('\t'.join([str(x) for x in e]) + '\n')
+        except (IOError, OSError):
+            sys.stderr.write(
+                'Could not write ' + fai + '; the index will be rebuilt '
+                'next time.\n')
+        return dict([(e.name, e) for e in entries])
+
+    @staticmethod
+    def build_fai(fname):
+        """Scan a FASTA and return a list of FaiEntry, one per sequence. Every
+        line of a sequence except the last must be the same length, and blank
+        lines can only come at the end of a sequence, as with samtools
+        faidx."""
+        entries = []
+        name = None
+        with open(fname, 'rb') as f:
+            offset = 0
+            for line in f:
+                lstart = offset
+                offset += len(line)
+                if line.startswith(b'>'):
+                    if name is not None:
+                        entries.append(
+                            FaiEntry(name, length, seq_off, lbases or 0,
+                                     lwidth or 0))
+                    name = line[1:].strip().split()[0].decode('ascii')
+                    length = 0
+                    seq_off = offset
+                    lbases = None
+                    lwidth = None
+                    short_line = False
+                    blank = False
+                    continue
+                bases = len(line.rstrip(b'\r\n'))
+                if bases == 0:
+                    #   The offsets of the bases after a blank line would be
+                    #   off, so only more blank lines or a header can follow
+                    blank = True
+                    continue
+                if name is None:
+                    raise FastaIndexError(
+                        fname + ' has sequence before the first header.')
+                if blank:
+                    raise FastaIndexError(
+                        'Sequence ' + name + ' in ' + fname + ' has a blank '
+                        'line in it, and cannot be indexed.')
+                if lbases is None:
+                    lbases = bases
+                    lwidth = len(line)
+                    seq_off = lstart
+                elif short_line or bases > lbases or \
+                        (bases == lbases and len(line) != lwidth and
+                         line.endswith(b'\n')):
+                    raise FastaIndexError(
+                        'Sequence ' + name + ' in ' + fname + ' has lines of '
+                        'different lengths, and cannot be indexed.')
+                if bases < lbases:
+                    short_line = True
+                length += bases
+        if name is not None:
+            entries.append(FaiEntry(name, length, seq_off, lbases or 0,
+                                    lwidth or 0))
+        return entries
+
+    def _open(self):
+        """Map the FASTA into memory."""
+        self.handle = open(self.fname, 'rb')
+        self.data = mmap.mmap(
+            self.handle.fileno(),
+            0,
+            access=mmap.ACCESS_READ)
+        return
+
+    def _byte_offset(self, entry, pos):
+        """Where base pos of a sequence is in the file."""
+        return entry.offset + \
+            (pos // entry.linebases) * entry.linewidth + \
+            pos % entry.linebases
+
+    def fetch(self, name, start=0, end=None):
+        if name not in self.index:
+            raise FastaIndexError(
+                'Sequence {n} not found in FASTA!'.format(n=name))
+        entry = self.index[name]
+        if end is None or end > entry.length:
+            end = entry.length
+        start = max(start, 0)
+        if start >= end:
+            return ''
+        if self.data is None:
+            self._open()
+        chunk = self.data[
+            self._byte_offset(entry, start):self._byte_offset(entry, end)]
+        return chunk.replace(b'\n', b'').replace(b'\r', b'').decode('ascii')
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.handle.close()
+        self.data = None
+        self.handle = None
+        return
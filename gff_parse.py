@@ -4,17 +4,166 @@ child relationships and allows for fetching of parent or children features.
 
 Contains the following classes:
     GFFError:   An error when a queried ID is not found in the GFF data.
+    IntervalIndex:  A static interval tree over the features of one sequence,
+                    used to find overlapping features without a linear scan.
     GFFFeature: Reads a line from a GFF file and parses out the feature info
     GFFHandler: Handles the parsing of the whole GFF file and allows access
                 to parents, children, or "siblings" of individual features.
+    GFFColumns: Like GFFHandler, but holds the features in NumPy arrays, for
+                very large GFFs. Requires NumPy.
+    GFFFeatureView: A feature in a GFFColumns store, with the same attributes
+                    as a GFFFeature.
 """
 
+import os
+import gc
+import sys
+import array
+import struct
+import marshal
+import heapq
+import contextlib
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#   Bump this when the layout of GFFHandler.gff_data changes, so that old
+#   caches are not loaded.
+CACHE_VERSION = 1
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Turn off the cyclic garbage collector for the duration of the block.
+    Building hundreds of thousands of feature objects otherwise triggers a
+    full collection over and over, which more than doubles parse and cache
+    load times. None of the objects we build form reference cycles."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 
 class GFFError(LookupError):
     """Raised when a user asks for a feature ID that is not present in the GFF
     data."""
 
 
+class IntervalIndex(object):
+    """A static, implicit interval tree over a list of (start, end) pairs.
+    The intervals are sorted by start and laid out as an implicit binary tree,
+    where every node also stores the largest end coordinate in its subtree.
+    This is the same layout used by cgranges and Heng Li's iitree. Queries
+    take O(log n + k) time, where k is the number of overlapping intervals.
+
+    Intervals are treated as half-open for the purposes of the overlap test:
+    an interval overlaps the query [qstart, qend) when start < qend and
+    qstart < end. Callers translate their own coordinate conventions into
+    this form. Queries return the original (input) indices of the intervals,
+    in ascending order."""
+    __slots__ = ['starts', 'ends', 'max_ends', 'order', 'max_level']
+
+    def __init__(self, starts, ends):
+        #   Sort the intervals by start, and keep track of where they came
+        #   from so that we can give back indices into the caller's list.
+        self.order = sorted(range(len(starts)), key=lambda i: starts[i])
+        self.starts = [starts[i] for i in self.order]
+        self.ends = [ends[i] for i in self.order]
+        self.max_ends = list(self.ends)
+        self.max_level = self._build()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def astuple(self):
+        """Return the arrays that make up the tree."""
+        return (self.order, self.starts, self.ends, self.max_ends,
+                self.max_level)
+
+    @classmethod
+    def fromtuple(cls, values):
+        """Make an index from the output of astuple(), without sorting or
+        building anything."""
+        idx = cls.__new__(cls)
+        (idx.order, idx.starts, idx.ends, idx.max_ends,
+         idx.max_level) = values
+        return idx
+
+    def _build(self):
+        """Fill in the max_ends array from the bottom of the tree up, and
+        return the level of the root node."""
+        n = len(self.starts)
+        if n == 0:
+            return -1
+        ends = self.ends
+        max_ends = self.max_ends
+        #   Leaves are the even indices, and their max end is just their end.
+        #   last_i points to the rightmost node in the tree.
+        last_i = (n - 1) & ~1
+        last = max_ends[last_i]
+        k = 1
+        while (1 << k) <= n:
+            x = 1 << (k - 1)
+            i0 = (x << 1) - 1
+            step = x << 2
+            for i in range(i0, n, step):
+                el = max_ends[i - x]
+                er = max_ends[i + x] if i + x < n else last
+                max_ends[i] = max(ends[i], el, er)
+            #   Move last_i to the parent of the rightmost node. A right
+            #   child has bit k set, and its parent is x to the left.
+            if (last_i >> k) & 1:
+                last_i -= x
+            else:
+                last_i += x
+            if last_i < n and max_ends[last_i] > last:
+                last = max_ends[last_i]
+            k += 1
+        return k - 1
+
+    def overlap(self, qstart, qend):
+        """Return the input indices of the intervals with start < qend and
+        qstart < end, sorted in ascending order."""
+        n = len(self.starts)
+        if n == 0:
+            return []
+        starts = self.starts
+        ends = self.ends
+        max_ends = self.max_ends
+        hits = []
+        #   The stack holds (level, node, left child already visited)
+        stack = [(self.max_level, (1 << self.max_level) - 1, False)]
+        while stack:
+            k, x, visited = stack.pop()
+            if k <= 3:
+                #   Small subtree; just scan every node in it
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                i = i0
+                while i < i1 and starts[i] < qend:
+                    if qstart < ends[i]:
+                        hits.append(i)
+                    i += 1
+            elif not visited:
+                #   Re-add this node, then descend into the left child if it
+                #   could hold an overlapping interval. The left child may be
+                #   out of range in an incomplete tree.
+                y = x - (1 << (k - 1))
+                stack.append((k, x, True))
+                if y >= n or max_ends[y] > qstart:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] < qend:
+                if qstart < ends[x]:
+                    hits.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        order = self.order
+        return sorted(order[i] for i in hits)
+
+
 class GFFFeature(object):
     """This reads the data out of a single line of a GFF. It is a *very* ugly
     class, but GFF is a *very* ugly file format, and I don't know of a better
@@ -63,6 +212,26 @@ class GFFFeature(object):
         self.Is_circular = None
         self.read_gff_line(line)
 
+    def astuple(self):
+        """Return the values of all the attributes, in __slots__ order."""
+        return (
+            self.seqid, self.source, self.type, self.start, self.end,
+            self.score, self.strand, self.phase, self.ID, self.Name,
+            self.Alias, self.Parent, self.Target, self.Gap,
+            self.Derives_from, self.Note, self.Dbxref, self.Ontology_term,
+            self.Is_circular)
+
+    @classmethod
+    def fromtuple(cls, values):
+        """Make a feature from the output of astuple(), without parsing."""
+        g = cls.__new__(cls)
+        (g.seqid, g.source, g.type, g.start, g.end,
+         g.score, g.strand, g.phase, g.ID, g.Name,
+         g.Alias, g.Parent, g.Target, g.Gap,
+         g.Derives_from, g.Note, g.Dbxref, g.Ontology_term,
+         g.Is_circular) = values
+        return g
+
     def read_gff_line(self, line):
         fields = line.strip().split('\t')
         #   Fixed fields are the first eight
@@ -112,6 +281,12 @@ class GFFHandler(object):
     features.
 
     Contains the following methods:
+        gff_parse(self, fname, cache=False)
+            Parses the GFF. If cache is True, the parsed features and indices
+            are also written to fname.cache, and later calls load them from
+            there instead of parsing the GFF again, as long as the GFF has the
+            same path, size, and modification time.
+
         get_feature(self, feat_id)
             Retuns a single feature, or raises an exception when the ID is not
             found
@@ -149,19 +324,52 @@ class GFFHandler(object):
             region. If there are no features of the specified type in the given
             region, then empty list is returned. Defaults to all types and the
             entire chromosome.
-    """
-    gff_data = {
-        'obj': {},
-        'ids': {},
-        'starts': {},
-        'ends': {}
-        }
 
+        overlapping_feature(self, chrom, pos, feat_type=None)
+            Returns all features on the specified chromosome that start before
+            and end after the given position. If the type keyword is
+            specified, then only features of that type are returned. Features
+            are returned in the order they appear in the GFF.
+
+        overlapping_features(self, chrom, positions, feat_type=None)
+            The same as overlapping_feature(), but for a whole list of
+            positions on one chromosome at once. Returns a list with one list
+            of features per position, in the same order as the positions. This
+            is a single sweep along the chromosome, so it is much faster than
+            one query per position, and fastest when the positions are sorted.
+
+    Both chrom_features() and overlapping_feature() are answered from an
+    interval index (see IntervalIndex) that is built once per sequence at the
+    end of gff_parse(), so each query costs O(log n + k) rather than a scan
+    over every feature on the chromosome. Likewise, gff_parse() indexes the
+    features by ID and by Parent, so get_feature(), get_parents(),
+    get_children(), and get_siblings() are dictionary lookups.
+
+    The parsed data is held per instance, so several GFFs can be loaded at
+    once in separate handlers.
+    """
     def __init__(self):
-        pass
+        #   Each handler keeps its own data, so that several GFFs can be
+        #   loaded in the same process. Everything is keyed on sequence ID.
+        #   'ids' and 'children' map feature IDs and parent IDs to indices
+        #   into the 'obj' list for that sequence, in file order.
+        self.gff_data = {
+            'obj': {},
+            'ids': {},
+            'children': {},
+            'starts': {},
+            'ends': {},
+            'index': {}
+            }
 
-    def gff_parse(self, fname):
-        with open(fname, 'r') as f:
+    def gff_parse(self, fname, cache=False):
+        #   If asked, try the cache first. It is only used if it was written
+        #   from a GFF with the same path, size, and modification time.
+        if cache:
+            cache_key = self._cache_key(fname)
+            if self.load_cache(fname + '.cache', cache_key):
+                return
+        with open(fname, 'r') as f, _gc_paused():
             for line in f:
                 #   Skip lines starting with #; they are directives or comments
                 if line.startswith('#'):
@@ -172,73 +380,167 @@ class GFFHandler(object):
                 else:
                     g = GFFFeature(line)
                     if g.seqid not in self.gff_data['obj']:
-                        self.gff_data['obj'][g.seqid] = [g]
-                    else:
-                        self.gff_data['obj'][g.seqid].append(g)
-                    if g.seqid not in self.gff_data['ids']:
-                        self.gff_data['ids'][g.seqid] = [g.ID]
-                    else:
-                        self.gff_data['ids'][g.seqid].append(g.ID)
-                    if g.seqid not in self.gff_data['starts']:
-                        self.gff_data['starts'][g.seqid] = [g.start]
-                    else:
-                        self.gff_data['starts'][g.seqid].append(g.start)
-                    if g.seqid not in self.gff_data['ends']:
-                        self.gff_data['ends'][g.seqid] = [g.end]
-                    else:
-                        self.gff_data['ends'][g.seqid].append(g.end)
+                        self.gff_data['obj'][g.seqid] = []
+                        self.gff_data['ids'][g.seqid] = {}
+                        self.gff_data['children'][g.seqid] = {}
+                        self.gff_data['starts'][g.seqid] = []
+                        self.gff_data['ends'][g.seqid] = []
+                    #   This is where the feature will sit in the 'obj' list
+                    i = len(self.gff_data['obj'][g.seqid])
+                    self.gff_data['obj'][g.seqid].append(g)
+                    self.gff_data['starts'][g.seqid].append(g.start)
+                    self.gff_data['ends'][g.seqid].append(g.end)
+                    #   Several lines can share an ID (e.g., a multi-line CDS),
+                    #   so IDs map to lists of indices.
+                    ids = self.gff_data['ids'][g.seqid]
+                    ids.setdefault(g.ID, []).append(i)
+                    if g.Parent:
+                        children = self.gff_data['children'][g.seqid]
+                        #   Only count a feature once per parent, even if the
+                        #   parent is listed twice.
+                        for p in set(g.Parent):
+                            children.setdefault(p, []).append(i)
+        self.build_index()
+        if cache:
+            self.write_cache(fname + '.cache', cache_key)
         return
 
-    def get_feature(self, feat_id):
-        if feat_id not in self.gff_ids:
+    @staticmethod
+    def _cache_key(fname):
+        """The values that a cache has to match to be used for fname. The
+        marshal format can change between Python versions, so that is part of
+        the key, too."""
+        st = os.stat(fname)
+        return (
+            CACHE_VERSION,
+            sys.hexversion,
+            os.path.abspath(fname),
+            st.st_size,
+            st.st_mtime)
+
+    def load_cache(self, cache_name, cache_key):
+        """Load parsed GFF data from cache_name if it was written with the
+        same key. Returns True if the cache was used."""
+        try:
+            with open(cache_name, 'rb') as f, _gc_paused():
+                #   The key is stored first, behind its length, so we can
+                #   check it without reading the rest. marshal.load() on a
+                #   file is very slow, so we read the bytes ourselves.
+                key_len = struct.unpack('<Q', f.read(8))[0]
+                if marshal.loads(f.read(key_len)) != cache_key:
+                    return False
+                data = marshal.loads(f.read())
+                data['obj'] = dict([
+                    (c, list(map(GFFFeature.fromtuple, feats)))
+                    for c, feats
+                    in data['obj'].items()])
+                data['index'] = dict([
+                    (c, IntervalIndex.fromtuple(idx))
+                    for c, idx
+                    in data['index'].items()])
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError,
+                struct.error):
+            return False
+        self.gff_data = data
+        return True
+
+    def write_cache(self, cache_name, cache_key):
+        """Write the parsed GFF data to cache_name, along with the key that
+        says which GFF it came from. The features and indices are stored as
+        plain tuples and lists with marshal, which loads several times faster
+        than pickling the objects. A failure to write is not fatal."""
+        data = dict(self.gff_data)
+        data['obj'] = dict([
+            (c, [f.astuple() for f in feats])
+            for c, feats
+            in self.gff_data['obj'].items()])
+        data['index'] = dict([
+            (c, idx.astuple())
+            for c, idx
+            in self.gff_data['index'].items()])
+        tmp_name = cache_name + '.' + str(os.getpid())
+        try:
+            with open(tmp_name, 'wb') as f, _gc_paused():
+                key = marshal.dumps(cache_key)
+                f.write(struct.pack('<Q', len(key)))
+                f.write(key)
+                f.write(marshal.dumps(data))
+            #   Move it into place in one step, so that a reader never sees a
+            #   partly written cache.
+            os.rename(tmp_name, cache_name)
+        except (IOError, OSError, ValueError):
+            sys.stderr.write('Could not write GFF cache ' + cache_name + '\n')
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        return
+
+    def build_index(self):
+        """Build an interval index over the features of every sequence. This
+        is called at the end of gff_parse(), and only has to be called again
+        if features are added by hand."""
+        for chrom in self.gff_data['obj']:
+            self.gff_data['index'][chrom] = IntervalIndex(
+                self.gff_data['starts'][chrom],
+                self.gff_data['ends'][chrom])
+        return
+
+    def _feature_indices(self, chrom, feat_id):
+        """Return the indices of the features with the given ID on chrom, or
+        raise GFFError if there are none."""
+        try:
+            return self.gff_data['ids'][chrom][feat_id]
+        except KeyError:
             raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
-        else:
-            for f in self.gff_data:
-                if f.ID == feat_id:
-                    return f
+
+    def get_feature(self, feat_id):
+        for chrom in self.gff_data['ids']:
+            if feat_id in self.gff_data['ids'][chrom]:
+                i = self.gff_data['ids'][chrom][feat_id][0]
+                return self.gff_data['obj'][chrom][i]
+        raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
 
     def get_parents(self, chrom, feat_id, feat_type=None):
-        if feat_id not in self.gff_data['ids'][chrom]:
-            raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
-        else:
-            parents = []
-            targeted_features = []
-            #   We search through the list and save features that match the
-            #   query ID
-            for f in self.gff_data['obj'][chrom]:
-                if f.Parent and feat_id == f.ID:
-                    if feat_type:
-                        if f.type == feat_type:
-                            parents += f.Parent
-                    else:
+        query = self._feature_indices(chrom, feat_id)
+        feats = self.gff_data['obj'][chrom]
+        ids = self.gff_data['ids'][chrom]
+        parents = []
+        #   Collect the parent IDs of every feature with the query ID
+        for i in query:
+            f = feats[i]
+            if f.Parent:
+                if feat_type:
+                    if f.type == feat_type:
                         parents += f.Parent
-            #   We then search AGAIN to get the features that match the parent
-            #   feature ID. This is not very efficient, but given the structure
-            #   of the data, it works.
-            for f in self.gff_data['obj'][chrom]:
-                if f.ID in parents:
-                    targeted_features.append(f)
-            return targeted_features
+                else:
+                    parents += f.Parent
+        #   Then look up the parent features by ID. We give them back in file
+        #   order, and only once each.
+        targeted_features = set()
+        for p in parents:
+            targeted_features.update(ids.get(p, []))
+        return [feats[i] for i in sorted(targeted_features)]
 
     def get_children(self, chrom, feat_id, feat_type=None):
-        if feat_id not in self.gff_data['ids'][chrom]:
-            raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
-        else:
-            targeted_features = []
-            #   Searching for child features is easy, since we just have to see
-            #   if our query ID is in the Parent GFF attributes.
-            for f in self.gff_data['obj'][chrom]:
-                if f.Parent and feat_id in f.Parent:
-                    if feat_type:
-                        if f.type == feat_type:
-                            targeted_features.append(f)
-                    else:
-                        targeted_features.append(f)
-            return targeted_features
+        self._feature_indices(chrom, feat_id)
+        feats = self.gff_data['obj'][chrom]
+        #   The children are indexed on their Parent attribute when we parse
+        #   the GFF, so this is just a lookup.
+        targeted_features = [
+            feats[i]
+            for i
+            in self.gff_data['children'][chrom].get(feat_id, [])
+            ]
+        if feat_type:
+            targeted_features = [
+                f
+                for f
+                in targeted_features
+                if f.type == feat_type
+                ]
+        return targeted_features
 
     def get_siblings(self, chrom, feat_id, feat_type=None):
-        if feat_id not in self.gff_data['ids'][chrom]:
-            raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
+        self._feature_indices(chrom, feat_id)
         #   This is pretty easy, too. We just take the query ID, find its
         #   parents, and then find all children of those parents. These are the
         #   "siblings"
@@ -249,42 +551,36 @@ class GFFHandler(object):
         return sibs
 
     def chrom_features(self, chrom, left=None, right=None, feat_type=None):
-        targeted_features = []
-        filtered_features = []
-        for f in self.gff_data:
-            if f.seqid == chrom:
-                if feat_type:
-                    if f.type == feat_type:
-                        targeted_features.append(f)
-                else:
-                    targeted_features.append(f)
-        #   Now we go through the list of targeted features and filter based
-        #   on position
-        if left or right:
-            #   if left is not specified, set it to 0
-            if not left:
-                left = 0
-            #   Same with right, except make it huge
-            if not right:
-                right = 1e99
-            left = int(left)
-            right = int(right)
-            for t in targeted_features:
-                if t.start in range(left, right) or t.end in range(left, right):
-                    filtered_features.append(t)
-        else:
-            filtered_features = targeted_features
-        return filtered_features
+        if chrom not in self.gff_data['index']:
+            raise GFFError('Sequence {c} not found in GFF!'.format(c=chrom))
+        #   if left is not specified, set it to 0. Same with right, except
+        #   make it huge.
+        if not left:
+            left = 0
+        if not right:
+            right = 1e99
+        left = int(left)
+        right = int(right)
+        #   We want features with any base in [left, right). GFF ends are
+        #   inclusive, so a feature overlaps if start < right and end >= left.
+        targeted_features = [
+            self.gff_data['obj'][chrom][i]
+            for i
+            in self.gff_data['index'][chrom].overlap(left - 1, right)
+            ]
+        if feat_type:
+            targeted_features = [
+                f
+                for f
+                in targeted_features
+                if f.type == feat_type
+                ]
+        return targeted_features
 
     def overlapping_feature(self, chrom, pos, feat_type=None):
-        #   Find out which features have start positions before the specified
-        #   position, and which have ends after.
-        past_start = [True if pos > f else False for f in self.gff_data['starts'][chrom]]
-        before_end = [True if pos < f else False for f in self.gff_data['ends'][chrom]]
-        #   element-wise AND
-        targeted_features = [a&b for a,b in zip(past_start, before_end)]
-        #   Convert into indices
-        targeted_features = [index for index, value in enumerate(targeted_features) if value]
+        #   Find the features that start before the specified position and
+        #   end after it. The interval index gives us these in file order.
+        targeted_features = self.gff_data['index'][chrom].overlap(pos, pos)
         #   Then, get the correct feature types
         if feat_type:
             targeted_features = [
@@ -299,5 +595,441 @@ class GFFHandler(object):
                 for i
                 in targeted_features
                 ]
-        #   Slice them out of the gff data and return them
         return targeted_features
+
+    def overlapping_features(self, chrom, positions, feat_type=None):
+        feats = self.gff_data['obj'][chrom]
+        index = self.gff_data['index'][chrom]
+        #   Visit the positions from low to high. If they are already sorted,
+        #   as they are from a sorted VCF, this is just a walk down the list.
+        order = range(len(positions))
+        if any(positions[i] > positions[i + 1]
+               for i in range(len(positions) - 1)):
+            order = sorted(order, key=lambda i: positions[i])
+        results = [None] * len(positions)
+        #   Sweep along the chromosome. Features join the active heap when the
+        #   sweep passes their start, and leave it when it reaches their end,
+        #   so the heap always holds the features that overlap the position.
+        active = []
+        j = 0
+        nfeat = len(index)
+        for i in order:
+            pos = positions[i]
+            while j < nfeat and index.starts[j] < pos:
+                f = index.order[j]
+                if not feat_type or feats[f].type == feat_type:
+                    heapq.heappush(active, (index.ends[j], f))
+                j += 1
+            while active and active[0][0] <= pos:
+                heapq.heappop(active)
+            results[i] = [feats[f] for f in sorted([a[1] for a in active])]
+        return results
+
+
+class GFFFeatureView(object):
+    """A feature in a GFFColumns store. It has the same attributes as a
+    GFFFeature. The fixed columns and the ID and Parent attributes come from
+    the arrays in the store; the other attributes are parsed from the line in
+    the GFF the first time one of them is asked for."""
+    __slots__ = ['store', 'i', '_full']
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+        self._full = None
+
+    def __eq__(self, other):
+        return isinstance(other, GFFFeatureView) and \
+            self.store is other.store and self.i == other.i
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.store), self.i))
+
+    def __getattr__(self, name):
+        #   Only called for the attributes that are not properties below
+        if name in GFFFeature.__slots__:
+            if self._full is None:
+                self._full = self.store.read_feature(self.i)
+            return getattr(self._full, name)
+        raise AttributeError(name)
+
+    @property
+    def seqid(self):
+        return self.store.tables['seqid'][self.store.seqid[self.i]]
+
+    @property
+    def source(self):
+        return self.store.tables['source'][self.store.source[self.i]]
+
+    @property
+    def type(self):
+        return self.store.tables['type'][self.store.type[self.i]]
+
+    @property
+    def start(self):
+        return int(self.store.start[self.i])
+
+    @property
+    def end(self):
+        return int(self.store.end[self.i])
+
+    @property
+    def score(self):
+        return self.store.tables['score'][self.store.score[self.i]]
+
+    @property
+    def strand(self):
+        return self.store.tables['strand'][self.store.strand[self.i]]
+
+    @property
+    def phase(self):
+        return self.store.tables['phase'][self.store.phase[self.i]]
+
+    @property
+    def ID(self):
+        code = self.store.id_code[self.i]
+        if code < 0:
+            return None
+        return self.store.tables['ID'][code]
+
+    @property
+    def Parent(self):
+        lo = self.store.parent_ptr[self.i]
+        hi = self.store.parent_ptr[self.i + 1]
+        if lo == hi:
+            return None
+        return [
+            self.store.tables['ID'][c]
+            for c
+            in self.store.parent_code[lo:hi]
+            ]
+
+    def astuple(self):
+        """Return the values of all the attributes, in GFFFeature.__slots__
+        order."""
+        return tuple([getattr(self, a) for a in GFFFeature.__slots__])
+
+
+class GFFColumns(object):
+    """A columnar alternative to GFFHandler, for GFFs that are too big to hold
+    as one GFFFeature per line. Requires NumPy. The features are held in NumPy
+    arrays: codes for the sequence ID, source, type, score, strand, and phase,
+    the start and end, a code for the ID, and the Parent IDs as codes in a
+    compressed (offset, values) layout. The strings behind the codes are held
+    once each. The other attributes are not kept; they are read back from the
+    GFF when they are asked for, so the GFF must stay where it is.
+
+    Features are handed out as GFFFeatureView objects, which are made when
+    they are needed. This has the same methods as GFFHandler, with the same
+    arguments and return values, except that gff_parse() has no cache:
+        gff_parse(self, fname)
+        get_feature(self, feat_id)
+        get_parents(self, chrom, feat_id, feat_type=None)
+        get_children(self, chrom, feat_id, feat_type=None)
+        get_siblings(self, chrom, feat_id, feat_type=None)
+        chrom_features(self, chrom, left=None, right=None, feat_type=None)
+        overlapping_feature(self, chrom, pos, feat_type=None)
+        overlapping_features(self, chrom, positions, feat_type=None)
+
+    The GFF is opened the first time a feature is read back from it, and is
+    closed with close(), or at the end of a with block.
+
+    chrom_features() and the overlapping_feature() methods are vectorized: a
+    binary search over the start coordinates narrows the candidates, and the
+    end and type tests are done as array operations.
+    """
+    #   The columns that are stored as codes into a table of strings
+    coded = ['seqid', 'source', 'type', 'score', 'strand', 'phase']
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError('GFFColumns requires NumPy.')
+        self.fname = None
+        self.handle = None
+        #   Code -> string for each coded column, and for IDs
+        self.tables = dict([(c, []) for c in self.coded + ['ID']])
+        #   String -> code for IDs
+        self.id_codes = {}
+        #   Sequence ID -> (first, last + 1) index of its features
+        self.bounds = {}
+        self.nfeat = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['handle'] = None
+        return state
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+        self.handle = None
+        return
+
+    def gff_parse(self, fname):
+        self.fname = fname
+        #   The sequence ID, source, type, strand, and phase take only a few
+        #   values, and so do their combinations. We code each line by its
+        #   combination as we read, and split the combinations back out into
+        #   columns at the end. Scores can be unique to a line, so they get
+        #   their own codes. Codes are handed out in the order the values are
+        #   first seen.
+        combos = {}
+        scores = {}
+        combo_code = array.array('i')
+        score_code = array.array('i')
+        start = array.array('q')
+        end = array.array('q')
+        offsets = array.array('q')
+        id_code = array.array('i')
+        parent_code = array.array('i')
+        parent_ptr = array.array('q', [0])
+        ids = self.id_codes
+        offset = 0
+        with open(fname, 'rb') as f, _gc_paused():
+            for raw in f:
+                line_offset = offset
+                offset += len(raw)
+                #   Skip directives, comments, and blank lines, as GFFHandler
+                if raw.startswith(b'#') or raw in (b'\n', b'\r\n'):
+                    continue
+                fields = raw.decode('utf-8').strip().split('\t')
+                combo_code.append(combos.setdefault(
+                    (fields[0], fields[1], fields[2], fields[6], fields[7]),
+                    len(combos)))
+                score_code.append(scores.setdefault(fields[5], len(scores)))
+                start.append(int(fields[3]))
+                end.append(int(fields[4]))
+                offsets.append(line_offset)
+                #   Pull out ID and Parent the same way GFFFeature does
+                fid = None
+                parents = ()
+                for a in fields[8].split(';'):
+                    if a.startswith('ID'):
+                        fid = a.split('=')[1]
+                    elif a.startswith('Parent'):
+                        parents = a.split('=')[1].split(',')
+                if fid is None:
+                    id_code.append(-1)
+                else:
+                    id_code.append(ids.setdefault(fid, len(ids)))
+                for p in parents:
+                    parent_code.append(ids.setdefault(p, len(ids)))
+                parent_ptr.append(len(parent_code))
+        #   Split the combinations into one code array per column
+        combo_code = numpy.frombuffer(combo_code, dtype=numpy.int32)
+        cols = {'score': numpy.frombuffer(score_code, dtype=numpy.int32)}
+        self.tables['score'] = list(scores)
+        for j, c in enumerate(['seqid', 'source', 'type', 'strand', 'phase']):
+            lookup = {}
+            per_combo = numpy.array(
+                [lookup.setdefault(k[j], len(lookup)) for k in combos],
+                dtype=numpy.int32)
+            self.tables[c] = list(lookup)
+            cols[c] = per_combo[combo_code]
+        self.tables['ID'] = list(ids)
+        self._finish(cols, start, end, offsets, id_code, parent_code,
+                     parent_ptr)
+        return
+
+    def _finish(self, cols, start, end, offsets, id_code, parent_code,
+                parent_ptr):
+        """Turn the parsed columns into NumPy arrays, group the features by
+        sequence (keeping file order within a sequence), and build the
+        lookup arrays."""
+        seqid = cols['seqid']
+        n = len(seqid)
+        self.nfeat = n
+        order = numpy.argsort(seqid, kind='stable')
+        #   Small tables fit in small integers
+        for c in self.coded:
+            col = cols[c][order]
+            if len(self.tables[c]) < 128:
+                col = col.astype(numpy.int8)
+            elif len(self.tables[c]) < 32768:
+                col = col.astype(numpy.int16)
+            setattr(self, c, col)
+        self.start = numpy.frombuffer(start, dtype=numpy.int64)[order]
+        self.end = numpy.frombuffer(end, dtype=numpy.int64)[order]
+        self.offsets = numpy.frombuffer(offsets, dtype=numpy.int64)[order]
+        self.id_code = numpy.frombuffer(id_code, dtype=numpy.int32)[order]
+        #   Reorder the Parent lists along with the features
+        ptr = numpy.frombuffer(parent_ptr, dtype=numpy.int64)
+        counts = numpy.diff(ptr)
+        pcodes = numpy.frombuffer(parent_code, dtype=numpy.int32)
+        owner = numpy.repeat(numpy.arange(n), counts)
+        new_pos = numpy.empty(n, dtype=numpy.int64)
+        new_pos[order] = numpy.arange(n)
+        pperm = numpy.argsort(new_pos[owner], kind='stable')
+        self.parent_code = pcodes[pperm]
+        self.parent_ptr = numpy.concatenate(
+            ([0], numpy.cumsum(counts[order]))).astype(numpy.int64)
+        parent_owner = new_pos[owner][pperm]
+        #   Where each sequence starts and ends
+        seqs = self.seqid
+        for code, name in enumerate(self.tables['seqid']):
+            lo = numpy.searchsorted(seqs, code, 'left')
+            hi = numpy.searchsorted(seqs, code, 'right')
+            self.bounds[name] = (int(lo), int(hi))
+        #   Features sorted by start within each sequence, and the running
+        #   maximum of their ends. The running maximum never decreases, so a
+        #   binary search on it finds the first feature that could reach a
+        #   position.
+        self.by_start = numpy.lexsort((self.start, seqs))
+        self.sorted_start = self.start[self.by_start]
+        self.max_end = self.end[self.by_start].copy()
+        for lo, hi in self.bounds.values():
+            self.max_end[lo:hi] = numpy.maximum.accumulate(
+                self.max_end[lo:hi])
+        #   Features sorted by ID code, and by the ID codes of their parents,
+        #   so that ID and Parent lookups are binary searches.
+        self.by_id = numpy.argsort(self.id_code, kind='stable')
+        self.sorted_id = self.id_code[self.by_id]
+        cperm = numpy.argsort(self.parent_code, kind='stable')
+        self.children = parent_owner[cperm]
+        self.sorted_parent = self.parent_code[cperm]
+        return
+
+    def read_feature(self, i):
+        """Read feature i back from the GFF as a GFFFeature."""
+        if self.handle is None:
+            self.handle = open(self.fname, 'rb')
+        self.handle.seek(int(self.offsets[i]))
+        return GFFFeature(self.handle.readline().decode('utf-8'))
+
+    def _views(self, indices):
+        return [GFFFeatureView(self, int(i)) for i in indices]
+
+    def _chrom_bounds(self, chrom):
+        if chrom not in self.bounds:
+            raise GFFError('Sequence {c} not found in GFF!'.format(c=chrom))
+        return self.bounds[chrom]
+
+    def _lookup(self, sorted_codes, targets, code, lo, hi):
+        """Return the feature indices in [lo, hi) that are listed against
+        code in a sorted code array, in ascending order."""
+        a = numpy.searchsorted(sorted_codes, code, 'left')
+        b = numpy.searchsorted(sorted_codes, code, 'right')
+        found = targets[a:b]
+        return numpy.unique(found[(found >= lo) & (found < hi)])
+
+    def _feature_indices(self, chrom, feat_id):
+        if chrom not in self.bounds:
+            raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
+        lo, hi = self.bounds[chrom]
+        if feat_id is None:
+            code = -1
+        elif feat_id in self.id_codes:
+            code = self.id_codes[feat_id]
+        else:
+            raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
+        found = self._lookup(self.sorted_id, self.by_id, code, lo, hi)
+        if len(found) == 0:
+            raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
+        return found
+
+    def _type_code(self, feat_type):
+        """The code for a feature type, or -1 if no feature has that type."""
+        if feat_type in self.tables['type']:
+            return self.tables['type'].index(feat_type)
+        return -1
+
+    def get_feature(self, feat_id):
+        for chrom in self.bounds:
+            try:
+                found = self._feature_indices(chrom, feat_id)
+                return self._views(found[:1])[0]
+            except GFFError:
+                continue
+        raise GFFError('ID {fid} not found in GFF!'.format(fid=feat_id))
+
+    def get_parents(self, chrom, feat_id, feat_type=None):
+        query = self._feature_indices(chrom, feat_id)
+        lo, hi = self.bounds[chrom]
+        if feat_type:
+            query = query[self.type[query] == self._type_code(feat_type)]
+        pcodes = set()
+        for i in query:
+            pcodes.update(
+                self.parent_code[self.parent_ptr[i]:self.parent_ptr[i + 1]])
+        found = [
+            self._lookup(self.sorted_id, self.by_id, c, lo, hi)
+            for c
+            in pcodes
+            ]
+        if not found:
+            return []
+        return self._views(numpy.unique(numpy.concatenate(found)))
+
+    def get_children(self, chrom, feat_id, feat_type=None):
+        self._feature_indices(chrom, feat_id)
+        lo, hi = self.bounds[chrom]
+        found = self._lookup(
+            self.sorted_parent,
+            self.children,
+            self.id_codes.get(feat_id, -1),
+            lo,
+            hi)
+        if feat_type:
+            found = found[self.type[found] == self._type_code(feat_type)]
+        return self._views(found)
+
+    def get_siblings(self, chrom, feat_id, feat_type=None):
+        self._feature_indices(chrom, feat_id)
+        parents = self.get_parents(chrom, feat_id, feat_type=feat_type)
+        sibs = []
+        for p in parents:
+            sibs += self.get_children(chrom, p.ID, feat_type=feat_type)
+        return sibs
+
+    def _overlap(self, chrom, qstart, qend, feat_type):
+        """Indices of features on chrom with start < qend and qstart < end,
+        in file order."""
+        lo, hi = self._chrom_bounds(chrom)
+        #   Candidates start before qend, and come after the first feature
+        #   whose running maximum end passes qstart.
+        a = lo + numpy.searchsorted(self.max_end[lo:hi], qstart, 'right')
+        b = lo + numpy.searchsorted(self.sorted_start[lo:hi], qend, 'left')
+        if a >= b:
+            return []
+        cand = self.by_start[a:b]
+        keep = self.end[cand] > qstart
+        if feat_type:
+            keep &= self.type[cand] == self._type_code(feat_type)
+        return self._views(numpy.sort(cand[keep]))
+
+    def chrom_features(self, chrom, left=None, right=None, feat_type=None):
+        if not left:
+            left = 0
+        if not right:
+            right = 1e99
+        return self._overlap(chrom, int(left) - 1, min(int(right), 2**62),
+                             feat_type)
+
+    def overlapping_feature(self, chrom, pos, feat_type=None):
+        return self._overlap(chrom, pos, pos, feat_type)
+
+    def overlapping_features(self, chrom, positions, feat_type=None):
+        lo, hi = self._chrom_bounds(chrom)
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        #   Find the candidate ranges of every position in one go
+        a = lo + numpy.searchsorted(self.max_end[lo:hi], positions, 'right')
+        b = lo + numpy.searchsorted(
+            self.sorted_start[lo:hi], positions, 'left')
+        type_code = self._type_code(feat_type) if feat_type else None
+        results = []
+        for pos, first, last in zip(positions, a, b):
+            cand = self.by_start[first:last]
+            keep = self.end[cand] > pos
+            if feat_type:
+                keep &= self.type[cand] == type_code
+            results.append(self._views(numpy.sort(cand[keep])))
+        return results
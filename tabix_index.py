@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""Reads tabix (.tbi) and coordinate-sorted (.csi) indices of bgzipped files,
+such as the ones written by 'tabix -p vcf' and 'bcftools index'. Both split
+each sequence into a hierarchy of bins, and list for each bin the chunks of
+the file (as BGZF virtual offsets) that hold the records in it. A query for a
+region looks up the bins that can overlap it, so only those chunks of the
+file have to be decompressed; bgzf.read_chunks() then reads their lines.
+
+Contains the following functions:
+    find_index(fname)
+        Returns the name of the .tbi or .csi index of fname, or None if it
+        does not have one.
+
+    reg2bins(beg, end, min_shift, depth)
+        Returns the bins that can hold records overlapping [beg, end).
+
+    merge_chunks(chunks)
+        Sorts a list of (start, end) virtual offsets, and merges the ones that
+        overlap, so no part of the file is read twice.
+
+Contains the following classes:
+    TabixIndexError:    Raised when an index cannot be read.
+    TabixIndex:         Reads an index, and finds the chunks of the file that
+                        hold a region.
+
+Usage is something like:
+    idx = tabix_index.TabixIndex(tabix_index.find_index('calls.vcf.gz'))
+    chunks = idx.chunks('chr1', 999, 2000)  # 0-based, end exclusive
+    for line in bgzf.read_chunks('calls.vcf.gz', chunks):
+        ...
+"""
+
+import gzip
+import os
+import struct
+
+#   tabix indices always have 14-bit bins at the bottom, five levels deep
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+class TabixIndexError(LookupError):
+    """Raised when an index cannot be read."""
+
+
+def find_index(fname):
+    """Return the name of the .tbi or .csi index next to fname, or None if
+    there is not one."""
+    for ext in ('.tbi', '.csi'):
+        if os.path.exists(fname + ext):
+            return fname + ext
+    return None
+
+
+def reg2bins(beg, end, min_shift, depth):
+    """Return a list of the bins that can hold records overlapping the 0-based
+    region [beg, end), for an index with the given bin size and depth."""
+    end -= 1
+    bins = []
+    #   The first bin on each level, and the size of the bins on it
+    first = 0
+    shift = min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+        first += 1 << (level * 3)
+        shift -= 3
+    return bins
+
+
+def merge_chunks(chunks):
+    """Sort a list of (start, end) chunks, and merge the ones that overlap or
+    touch."""
+    merged = []
+    for start, stop in sorted(chunks):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _first_bin(level):
+    """The number of the first bin on a level."""
+    return ((1 << (level * 3)) - 1) // 7
+
+
+class TabixIndex(object):
+    """A .tbi or .csi index. Only the parts needed to find the chunks for a
+    region are kept: the bins of each sequence, and the smallest offset that
+    can hold a record at each position.
+
+    Contains the following attributes:
+        names       The names of the sequences, in the order of the index.
+        min_shift   The size of the smallest bins, as a power of 2.
+        depth       The number of levels of bins below the top one.
+
+    Contains the following methods:
+        chunks(self, name, beg, end)
+            Returns a sorted list of (start, end) virtual offsets that hold
+            all the records on name that overlap [beg, end), with chunks that
+            overlap each other merged. Returns an empty list for a sequence
+            that is not in the index.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        try:
+            with gzip.open(fname, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            raise TabixIndexError(
+                'Could not read index ' + fname + ': ' + str(e))
+        try:
+            if data[:4] == b'TBI\x01':
+                self._read_tbi(data)
+            elif data[:4] == b'CSI\x01':
+                self._read_csi(data)
+            else:
+                raise TabixIndexError(fname + ' is not a .tbi or .csi index.')
+        except struct.error:
+            raise TabixIndexError(fname + ' is truncated.')
+        self.tids = dict((n, i) for i, n in enumerate(self.names))
+        #   The bin that holds the number of records, not any records
+        self.pseudo_bin = _first_bin(self.depth + 1) + 1
+
+    @staticmethod
+    def _names(data, l_nm, offset):
+        """The sequence names, which are stored one after the other, each
+        ending in a null byte."""
+        return [
+            n.decode()
+            for n
+            in data[offset:offset+l_nm].split(b'\x00')[:-1]]
+
+    def _read_tbi(self, data):
+        self.min_shift = TBI_MIN_SHIFT
+        self.depth = TBI_DEPTH
+        n_ref, _, _, _, _, _, _, l_nm = struct.unpack_from('<8i', data, 4)
+        self.names = self._names(data, l_nm, 36)
+        pos = 36 + l_nm
+        self.bins = []
+        self.linear = []
+        for _ in range(n_ref):
+            bins = {}
+            n_bin = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+            for _ in range(n_bin):
+                b, n_chunk = struct.unpack_from('<Ii', data, pos)
+                pos += 8
+                c = struct.unpack_from('<' + str(2 * n_chunk) + 'Q', data, pos)
+                pos += 16 * n_chunk
+                bins[b] = list(zip(c[0::2], c[1::2]))
+            n_intv = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+            self.bins.append(bins)
+            self.linear.append(
+                struct.unpack_from('<' + str(n_intv) + 'Q', data, pos))
+            pos += 8 * n_intv
+        #   There is no linear index in a .csi, but there is a smallest offset
+        #   for every bin. A .tbi does not need these.
+        self.loffsets = None
+
+    def _read_csi(self, data):
+        self.min_shift, self.depth, l_aux = struct.unpack_from('<3i', data, 4)
+        pos = 16 + l_aux
+        #   The names are in the aux data, the same way as in a .tbi, if the
+        #   index was made by tabix or bcftools
+        if l_aux >= 28:
+            l_nm = struct.unpack_from('<i', data, 16 + 24)[0]
+            self.names = self._names(data, l_nm, 16 + 28)
+        else:
+            self.names = []
+        n_ref = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+        self.bins = []
+        self.loffsets = []
+        for _ in range(n_ref):
+            bins = {}
+            loffsets = {}
+            n_bin = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+            for _ in range(n_bin):
+                b, loff, n_chunk = struct.unpack_from('<IQi', data, pos)
+                pos += 16
+                c = struct.unpack_from('<' + str(2 * n_chunk) + 'Q', data, pos)
+                pos += 16 * n_chunk
+                bins[b] = list(zip(c[0::2], c[1::2]))
+                loffsets[b] = loff
+            self.bins.append(bins)
+            self.loffsets.append(loffsets)
+        self.linear = None
+
+    def _min_offset(self, tid, beg):
+        """The smallest virtual offset that a record overlapping beg can be
+        at. Chunks that end before it can be skipped."""
+        if self.linear is not None:
+            linear = self.linear[tid]
+            if not linear:
+                return 0
+            return linear[min(beg >> self.min_shift, len(linear) - 1)]
+        #   For a .csi, start from the smallest bin holding beg, and go up
+        #   until there is a bin in the index
+        loffsets = self.loffsets[tid]
+        b = _first_bin(self.depth) + (beg >> self.min_shift)
+        while True:
+            if b in loffsets:
+                return loffsets[b]
+            if b == 0:
+                return 0
+            b = (b - 1) >> 3
+
+    def chunks(self, name, beg, end):
+        tid = self.tids.get(name)
+        if tid is None or end <= beg:
+            return []
+        #   Nothing can be past the end of the largest bin
+        end = min(end, 1 << (self.min_shift + self.depth * 3))
+        bins = self.bins[tid]
+        min_off = self._min_offset(tid, beg)
+        return merge_chunks([
+            c
+            for b
+            in reg2bins(beg, end, self.min_shift, self.depth)
+            if b in bins and b != self.pseudo_bin
+            for c
+            in bins[b]
+            if c[1] > min_off])
@@ -0,0 +1,32 @@
+"""Tests for the default criteria of Filter_VCF.py."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import Filter_VCF
+import vcf_filter
+
+
+def site(pos, ref, alt):
+    return '\t'.join([
+        'chr1', str(pos), '.', ref, alt, '50', 'PASS', '.', 'GT:DP:GQ',
+        '0/0:10:50', '1/1:10:50']) + '\n'
+
+
+def test_criteria_each_remove_their_own_sites():
+    text = ''.join([
+        site(1, 'A', 'G'),
+        site(2, 'A', 'G,T'),
+        site(3, 'AT', 'A'),
+        site(4, 'A', 'GT,T')])
+    stats = vcf_filter.FilterStats(Filter_VCF.criteria)
+    include = vcf_filter.Filter(Filter_VCF.default_filter)
+    out = vcf_filter.filter_text(text, include, stats=stats)
+    assert out == site(1, 'A', 'G')
+    names = [name for name, _ in Filter_VCF.criteria]
+    removed = dict(zip(names, stats.removed.tolist()))
+    only = dict(zip(names, stats.only.tolist()))
+    assert (removed['snp'], only['snp']) == (2, 1)
+    assert (removed['multiallelic'], only['multiallelic']) == (2, 1)
@@ -0,0 +1,82 @@
+"""Tests for the streaming and sliding window modes of VCF_Pi.py."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import VCF_Pi
+
+
+def write_vcf(path, sites, contigs=()):
+    """Write a VCF with two inbred samples, one homozygous for each allele,
+    at each (chrom, pos) in sites."""
+    lines = ['##fileformat=VCFv4.2\n']
+    for chrom, length in contigs:
+        lines.append(
+            '##contig=<ID=' + chrom + ',length=' + str(length) + '>\n')
+    lines.append(
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n')
+    for chrom, pos in sites:
+        lines.append(
+            chrom + '\t' + str(pos) + '\t.\tA\tG\t50\tPASS\t.\tGT\t0/0\t1/1\n')
+    path.write_text(''.join(lines))
+    return str(path)
+
+
+def window_counts(monkeypatch, vcf, size, step):
+    """Return how many sites each window of sliding_windows() holds."""
+    counts = []
+
+    def count(start, end, in_interval):
+        counts.append((start, end, len(in_interval)))
+        return 0.0
+
+    monkeypatch.setattr(VCF_Pi, 'interval_pi', count)
+    list(VCF_Pi.sliding_windows(vcf, size, step))
+    return counts
+
+
+def test_tiled_windows_count_each_site_once(tmp_path, monkeypatch):
+    #   Sites on both edges of the windows, and in between
+    positions = [1, 9, 10, 11, 20, 21, 29, 30, 31, 40]
+    vcf = write_vcf(tmp_path / 'tiled.vcf', [('chr1', p) for p in positions])
+    counts = window_counts(monkeypatch, vcf, 10, 10)
+    assert sum(n for _, _, n in counts) == len(positions)
+    assert counts == [(0, 10, 3), (10, 20, 2), (20, 30, 3), (30, 40, 2)]
+
+
+def test_tiled_windows_to_contig_length(tmp_path, monkeypatch):
+    positions = [5, 10, 15, 20, 25]
+    vcf = write_vcf(
+        tmp_path / 'contig.vcf',
+        [('chr1', p) for p in positions],
+        contigs=[('chr1', 25)])
+    counts = window_counts(monkeypatch, vcf, 10, 10)
+    assert counts == [(0, 10, 2), (10, 20, 2), (20, 25, 1)]
+
+
+def test_stream_bed_chromosome_not_in_vcf(tmp_path):
+    #   No ##contig lines, and chr2 has intervals but no sites
+    sites = [('chr1', 5), ('chr1', 15), ('chr3', 5), ('chr3', 25)]
+    vcf = write_vcf(tmp_path / 'missing.vcf', sites)
+    bed = tmp_path / 'missing.bed'
+    bed.write_text(
+        'chr1\t0\t10\nchr1\t10\t20\nchr2\t0\t10\nchr2\t10\t20\n'
+        'chr3\t0\t10\nchr3\t20\t30\n')
+    streamed = list(VCF_Pi.stream_div_bed(vcf, str(bed)))
+    in_memory = VCF_Pi.calc_div_bed(VCF_Pi.read_vcf(vcf), str(bed))
+    assert streamed == in_memory
+    assert [float(pi) for _, _, pi in streamed] == [
+        1 / 9.0, 1 / 9.0, 0.0, 0.0, 1 / 9.0, 1 / 9.0]
+
+
+def test_stream_bed_out_of_order(tmp_path):
+    sites = [('chr1', 5), ('chr2', 5)]
+    vcf = write_vcf(tmp_path / 'order.vcf', sites)
+    bed = tmp_path / 'order.bed'
+    bed.write_text('chr2\t0\t10\nchr1\t0\t10\n')
+    with pytest.raises(ValueError, match='chr2 are out of order'):
+        list(VCF_Pi.stream_div_bed(vcf, str(bed)))
@@ -0,0 +1,34 @@
+"""Tests for writing and reading columnar files with columnar.py."""
+
+import os
+import sys
+
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import columnar
+
+
+def test_round_trip(tmp_path):
+    fname = str(tmp_path / 'out.npz')
+    aaf = numpy.array([[0.5, 1.0], [0.25, numpy.nan]], dtype=numpy.float32)
+    with columnar.Writer(fname, ['s1', 's2'], compress=False) as out:
+        out.append({'pos': [10]}, {'aaf': aaf[:1]})
+        out.append({'pos': [20]}, {'aaf': aaf[1:]})
+    with columnar.Reader(fname) as f:
+        assert f.samples == ['s1', 's2']
+        assert f.site('pos').tolist() == [10, 20]
+        assert f.column('aaf', 's1', mmap=True).tolist() == [0.5, 0.25]
+        numpy.testing.assert_array_equal(f.matrix('aaf'), aaf)
+
+
+def test_no_file_after_an_error(tmp_path):
+    fname = str(tmp_path / 'bad.npz')
+    with pytest.raises(ValueError):
+        with columnar.Writer(fname, ['s1']) as out:
+            out.append({'pos': [10]}, {'aaf': [[0.5]]})
+            int('not a position')
+    assert not os.path.exists(fname)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,28 @@
+"""Tests for building the .fai index in fasta_index.py."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import fasta_index
+
+
+def test_blank_line_inside_sequence(tmp_path):
+    fa = tmp_path / 'blank.fa'
+    fa.write_bytes(b'>a\nACGT\n\nTTGG\nCC\n')
+    with pytest.raises(fasta_index.FastaIndexError, match='blank line'):
+        fasta_index.IndexedFasta.build_fai(str(fa))
+
+
+def test_blank_lines_before_header(tmp_path):
+    fa = tmp_path / 'between.fa'
+    fa.write_bytes(b'\n>a\nACGT\nTTGG\nCC\n\n\n>b\nGGCC\nA\n\n')
+    ref = fasta_index.IndexedFasta(str(fa))
+    try:
+        assert ref.fetch('a') == 'ACGTTTGGCC'
+        assert ref.fetch('b') == 'GGCCA'
+    finally:
+        ref.close()
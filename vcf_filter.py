@@ -0,0 +1,791 @@
+#!/usr/bin/env python
+"""Filter expressions for VCF records, such as
+    QUAL>=40 && n_het<=2 && min(FMT/DP)>=5
+An expression is parsed once, and then evaluated for a whole block of records
+at a time: each value in it is a NumPy array over the sites of the block, or
+over the sites x samples for FORMAT fields and genotypes. FORMAT keys are
+looked up by name, once for each distinct FORMAT string, so the order of the
+subfields does not matter.
+
+The expressions can use:
+    Site values     CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO/KEY, and
+                    INFO/KEY[i] for the ith (0-based) of a list of values.
+                    INFO flags are 1 if they are set. N_ALT is the number of
+                    ALT alleles, 0 if ALT is '.', and MAX_ALT_LEN is the
+                    length of the longest one.
+    Sample values   FMT/KEY (or FORMAT/KEY), and FMT/KEY[i].
+    Genotypes       het, hom_ref, hom_alt, missing, and called, for each
+                    sample; and n_het, n_hom_ref, n_hom_alt, n_missing,
+                    n_called, and n_samples for each site. A call is missing
+                    if any of its alleles are '.'.
+    Functions       min(), max(), sum(), and mean() of a sample value over the
+                    samples, count() of the samples for which something is
+                    true, and len() of REF, ALT, or another text value.
+    Operators       || && ! == (or =) != < <= > >= + - * / and parentheses.
+Text is compared with quoted strings, as in FILTER=="PASS". Missing values
+('.', or a FORMAT key a record does not have) are NaN: they fail every
+comparison, and are left out of min(), max(), sum(), and mean(). If the whole
+expression is a sample value, a site passes if it is true for any sample.
+
+Contains the following functions:
+    filter_records(records, include=None, exclude=None)
+        Returns a Boolean array of whether each of a list of VCFRecords (or a
+        Block) passes the include Filter (if there is one) and fails the
+        exclude Filter (if there is one).
+
+    filter_text(text, include=None, exclude=None, block_size=BLOCK_SIZE,
+                stats=None)
+        Filters a string of VCF data lines, block_size records at a time, and
+        returns the lines that pass as one string, in the same order. The
+        records are added to stats, a FilterStats, if it is given.
+
+    init_worker(include, exclude, stats=None) and filter_worker(text)
+        filter_text() in a pool of processes. init_worker() parses the
+        expressions (either can be None) once in each process. If stats, the
+        arguments of a FilterStats, is given, filter_worker() returns the
+        FilterStats of its chunk along with the lines.
+
+Contains the following classes:
+    FilterError:    Raised when an expression cannot be parsed or evaluated.
+    Block:          The values of a block of records, kept once they are
+                    worked out, so that several Filters can share them.
+    Filter:         A parsed expression.
+    FilterStats:    Counts how many sites each of a list of criteria removes,
+                    and keeps histograms of QUAL, DP, and GQ and per-sample
+                    counts, to help choose cutoffs.
+
+Usage is something like:
+    keep = vcf_filter.Filter('QUAL>=40 && count(FMT/DP<5)==0')
+    for block in reader.blocks(2048):
+        passed = keep.evaluate(block)  # Boolean array, one per record
+
+Requires NumPy and vcf_parse.py."""
+
+import json
+import re
+
+import numpy
+
+import vcf_parse
+
+#   The tokens of an expression, in the order they are tried. Names can have
+#   a FMT/ or INFO/ prefix and an [index] suffix.
+TOKENS = re.compile(
+    r'\s*(?:'
+    r'(?P<num>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|'
+    r'(?P<str>"[^"]*"|\'[^\']*\')|'
+    r'(?P<name>(?:(?:FMT|FORMAT|INFO)/)?[A-Za-z_][A-Za-z0-9_.]*'
+    r'(?:\[\d+\])?)|'
+    r'(?P<op>&&|\|\||==|!=|<=|>=|[-+*/<>=!()])'
+    r')')
+#   Comparison operators, and the NumPy functions for them
+COMPARISONS = {
+    '==': numpy.equal,
+    '=': numpy.equal,
+    '!=': numpy.not_equal,
+    '<': numpy.less,
+    '<=': numpy.less_equal,
+    '>': numpy.greater,
+    '>=': numpy.greater_equal}
+ARITHMETIC = {
+    '+': numpy.add,
+    '-': numpy.subtract,
+    '*': numpy.multiply,
+    '/': numpy.divide}
+FUNCTIONS = ('min', 'max', 'sum', 'mean', 'count', 'len')
+#   Site values that are text, and the ones that are numbers
+TEXT_COLUMNS = {
+    'CHROM': vcf_parse.CHROM,
+    'ID': vcf_parse.ID,
+    'REF': vcf_parse.REF,
+    'ALT': vcf_parse.ALT,
+    'FILTER': vcf_parse.FILTER}
+NUMBER_COLUMNS = {
+    'POS': vcf_parse.POS,
+    'QUAL': vcf_parse.QUAL}
+GENOTYPES = ('het', 'hom_ref', 'hom_alt', 'missing', 'called')
+COUNTS = dict(('n_' + g, g) for g in GENOTYPES)
+#   Other numbers worked out for each site
+SITE_COUNTS = ('n_samples', 'N_ALT', 'MAX_ALT_LEN')
+#   The number of records to evaluate at a time
+BLOCK_SIZE = 2048
+#   The histograms of FilterStats: the value, the width of the bins, and the
+#   number of bins. Values past the last bin are counted in it.
+HISTOGRAMS = (('QUAL', 10, 100), ('FMT/DP', 1, 500), ('FMT/GQ', 1, 100))
+#   State for the worker processes. See init_worker().
+WORKER = {}
+
+
+class FilterError(ValueError):
+    """Raised when an expression cannot be parsed or evaluated."""
+
+
+def to_float(values):
+    """Convert a list of strings to a float array, with NaN for anything that
+    is missing or not a number."""
+    nan = numpy.nan
+    try:
+        return numpy.array(
+            [nan if v == '.' or v == '' else float(v) for v in values],
+            dtype=numpy.float64)
+    except ValueError:
+        out = numpy.empty(len(values))
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except ValueError:
+                out[i] = nan
+        return out
+
+
+def truth(x):
+    """The truth of a value: non-zero and not NaN."""
+    x = numpy.asarray(x)
+    if x.dtype == bool:
+        return x
+    if x.dtype.kind == 'f':
+        return (x != 0) & ~numpy.isnan(x)
+    return x.astype(bool)
+
+
+def number(x):
+    """A value as a float array, for arithmetic."""
+    x = numpy.asarray(x)
+    if x.dtype.kind == 'O' or x.dtype.kind == 'U':
+        raise FilterError('Text can only be compared with == or !=.')
+    return x.astype(numpy.float64)
+
+
+def align(a, b):
+    """Make a site value line up with a sample value, so they can be used
+    together."""
+    a = numpy.asarray(a)
+    b = numpy.asarray(b)
+    if a.ndim == 1 and b.ndim == 2:
+        a = a[:, None]
+    elif a.ndim == 2 and b.ndim == 1:
+        b = b[:, None]
+    return (a, b)
+
+
+def subfield_pattern(idx, item):
+    """A regex that finds the idx-th subfield of every sample in a string of
+    sample columns, each ending in a tab, and the item-th value of the
+    comma-separated list in it. Each match takes up a whole sample, so every
+    sample gives exactly one: the value, or '' if the sample does not have
+    it."""
+    value = '(?:[^\\t:]*:){' + str(idx) + '}(?:[^\\t:,]*,){' + str(item) + '}'
+    return re.compile(value + '([^\\t:,]*)[^\\t]*\\t|[^\\t]*\\t')
+
+
+def n_samples(rec):
+    """The number of sample columns of a record, without splitting them."""
+    f = rec.fields()
+    return f[9].count('\t') + 1 if len(f) > 9 else 0
+
+
+def split_values(values, item):
+    """The item-th value of each comma-separated list, if they all have the
+    same number of values. Returns None if they do not."""
+    joined = ','.join(values)
+    per = values[0].count(',') + 1 if values else 1
+    if item >= per or joined.count(',') != len(values) * per - 1:
+        return None
+    return joined.split(',')[item::per]
+
+
+def subfields(cols, parts, nfields, idx, item):
+    """Get the idx-th subfield (and the item-th value of it) of every sample
+    in a string of tab-separated sample columns with a FORMAT of nfields
+    subfields. parts is the columns split into subfields, if every sample has
+    all of them, or else None. Samples without the subfield give ''."""
+    item_of = 0 if item is None else item
+    #   If every sample has every subfield, the subfield is every nfields-th
+    #   of them
+    if parts is not None:
+        values = split_values(parts[idx::nfields], item_of)
+        if values is not None:
+            return values
+    pattern = subfield_pattern(idx, item_of)
+    return pattern.findall(cols + '\t')
+
+
+def genotype_is(kind, gt):
+    """Whether a genotype call string is het, hom_ref, hom_alt, missing, or
+    called."""
+    alleles = set(gt.replace('|', '/').split('/'))
+    if kind == 'missing' or kind == 'called':
+        return ('.' in alleles or gt == '') == (kind == 'missing')
+    if '.' in alleles or gt == '':
+        return False
+    if kind == 'het':
+        return len(alleles) > 1
+    elif kind == 'hom_ref':
+        return alleles == set(['0'])
+    return len(alleles) == 1 and '0' not in alleles
+
+
+class Block(object):
+    """The values of a block of records, worked out as they are asked for,
+    and then kept for the rest of the expression, or for other expressions
+    evaluated on the same Block."""
+
+    def __init__(self, records, gtab):
+        self.records = records
+        self.gtab = gtab
+        self.values = {}
+        self.columns = {}
+        self.codes = None
+
+    def subset(self, rows):
+        """A Block of some of the records."""
+        return Block([self.records[i] for i in rows], self.gtab)
+
+    def get(self, name):
+        if name not in self.values:
+            self.values[name] = self._value(name)
+        return self.values[name]
+
+    def _value(self, name):
+        recs = self.records
+        if name in TEXT_COLUMNS:
+            col = TEXT_COLUMNS[name]
+            return numpy.array([r.fields()[col] for r in recs], dtype=object)
+        elif name in NUMBER_COLUMNS:
+            col = NUMBER_COLUMNS[name]
+            return to_float([r.fields()[col] for r in recs])
+        elif name in GENOTYPES:
+            if self.codes is None:
+                self.codes = self.gtab.decode(recs)
+            kinds = self.gtab.lookup(lambda g: genotype_is(name, g), bool)
+            return kinds[self.codes]
+        elif name in COUNTS:
+            return self.get(COUNTS[name]).sum(axis=1).astype(numpy.float64)
+        elif name == 'N_ALT':
+            return numpy.array(
+                [0 if r.alt == '.' else r.alt.count(',') + 1 for r in recs],
+                dtype=numpy.float64)
+        elif name == 'MAX_ALT_LEN':
+            return numpy.array(
+                [max(len(a) for a in r.alt.split(',')) for r in recs],
+                dtype=numpy.float64)
+        elif name == 'n_samples':
+            return numpy.array(
+                [n_samples(r) for r in recs],
+                dtype=numpy.float64)
+        key, item = split_name(name)
+        if key.startswith('INFO/'):
+            return self._info(key[5:], item)
+        return self._format(key.partition('/')[2], item)
+
+    def _info(self, key, item):
+        pattern = re.compile(
+            '(?:^|;)' + re.escape(key) + '(?:=([^;]*))?(?:;|$)')
+        values = []
+        for r in self.records:
+            m = pattern.search(r.info)
+            if m is None:
+                values.append('')
+            elif m.group(1) is None:
+                #   A flag
+                values.append('1')
+            else:
+                vals = m.group(1).split(',')
+                values.append(vals[item or 0] if (item or 0) < len(vals)
+                              else '')
+        return to_float(values)
+
+    def _columns(self, fmt, rows):
+        """The sample columns of the records with a FORMAT, joined into one
+        string, and split into subfields if every sample has all of them.
+        Kept for the other keys of the same FORMAT."""
+        if fmt not in self.columns:
+            cols = []
+            for i in rows:
+                f = self.records[i].fields()
+                if len(f) > 9:
+                    cols.append(f[9])
+            if len(cols) != len(rows):
+                raise FilterError('Some records have no sample columns.')
+            cols = '\t'.join(cols)
+            nvals = cols.count('\t') + 1
+            parts = None
+            #   They can all be split at once, rather than one at a time
+            if cols.count(':') == nvals * fmt.count(':'):
+                parts = cols.replace('\t', ':').split(':')
+            self.columns[fmt] = (cols, parts)
+        return self.columns[fmt]
+
+    def _format(self, key, item):
+        nsamp = int(max(self.get('n_samples').tolist() + [0]))
+        out = numpy.full((len(self.records), nsamp), numpy.nan)
+        #   Records with the same FORMAT are done together, in a few passes
+        #   in C
+        by_format = {}
+        for i, r in enumerate(self.records):
+            by_format.setdefault(r.format, []).append(i)
+        for fmt, rows in by_format.items():
+            idx = vcf_parse.format_index(fmt).get(key)
+            if idx is None or nsamp == 0:
+                continue
+            cols, parts = self._columns(fmt, rows)
+            flat = subfields(cols, parts, fmt.count(':') + 1, idx, item)
+            if len(flat) != len(rows) * nsamp:
+                raise FilterError(
+                    'Records in the same block have different numbers of '
+                    'samples.')
+            out[rows] = to_float(flat).reshape((len(rows), nsamp))
+        return out
+
+
+def split_name(name):
+    """Split a name into the key and the [index], if there is one."""
+    if name.endswith(']'):
+        key, _, item = name[:-1].partition('[')
+        return (key, int(item))
+    return (name, None)
+
+
+class Filter(object):
+    """A parsed filter expression.
+
+    Contains the following attributes:
+        expression  The expression, as it was given.
+        names       The site and sample values the expression uses.
+
+    Contains the following methods:
+        evaluate(self, records)
+            Returns a Boolean array of whether each of a list of VCFRecords
+            (or a Block of them) passes the expression.
+
+        per_sample(self, records)
+            Returns a records x samples Boolean array of whether the
+            expression is true for each sample at each site.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = self._tokenize(expression)
+        self.pos = 0
+        self.names = set()
+        self.tree = self._or()
+        if self.pos != len(self.tokens):
+            raise FilterError(
+                'Unexpected ' + repr(self.tokens[self.pos][1]) + ' in ' +
+                expression)
+        self.gtab = vcf_parse.GenotypeTable()
+
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            m = TOKENS.match(expression, pos)
+            if m is None or m.end() == pos:
+                raise FilterError(
+                    'Cannot parse ' + repr(expression[pos:].strip()))
+            kind = m.lastgroup
+            tokens.append((kind, m.group(kind)))
+            pos = m.end()
+        return tokens
+
+    #   A recursive descent parser. Each method parses one level of
+    #   precedence, and returns a tree of tuples.
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def _take(self, value=None):
+        tok = self._peek()
+        if tok[0] is None or (value is not None and tok[1] != value):
+            raise FilterError(
+                'Expected ' + (repr(value) if value else 'more') + ' in ' +
+                self.expression)
+        self.pos += 1
+        return tok
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ('op', '||'):
+            self._take()
+            node = ('||', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() == ('op', '&&'):
+            self._take()
+            node = ('&&', node, self._not())
+        return node
+
+    def _not(self):
+        if self._peek() == ('op', '!'):
+            self._take()
+            return ('!', self._not())
+        return self._compare()
+
+    def _compare(self):
+        node = self._sum()
+        kind, value = self._peek()
+        if kind == 'op' and value in COMPARISONS:
+            self._take()
+            node = ('cmp', value, node, self._sum())
+        return node
+
+    def _sum(self):
+        node = self._term()
+        while self._peek() in (('op', '+'), ('op', '-')):
+            op = self._take()[1]
+            node = ('math', op, node, self._term())
+        return node
+
+    def _term(self):
+        node = self._unary()
+        while self._peek() in (('op', '*'), ('op', '/')):
+            op = self._take()[1]
+            node = ('math', op, node, self._unary())
+        return node
+
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self._take()
+            return ('math', '-', ('num', 0.0), self._unary())
+        return self._atom()
+
+    def _atom(self):
+        kind, value = self._take()
+        if kind == 'num':
+            return ('num', float(value))
+        elif kind == 'str':
+            return ('str', value[1:-1])
+        elif kind == 'op' and value == '(':
+            node = self._or()
+            self._take(')')
+            return node
+        elif kind == 'name':
+            if value in FUNCTIONS and self._peek() == ('op', '('):
+                self._take()
+                arg = self._or()
+                self._take(')')
+                return ('func', value, arg)
+            if value.startswith('FORMAT/'):
+                value = 'FMT/' + value[7:]
+            key = split_name(value)[0]
+            if key not in TEXT_COLUMNS and key not in NUMBER_COLUMNS and \
+                    key not in GENOTYPES and key not in COUNTS and \
+                    key not in SITE_COUNTS and '/' not in key:
+                raise FilterError('Unknown name ' + value)
+            self.names.add(value)
+            return ('name', value)
+        raise FilterError(
+            'Unexpected ' + repr(value) + ' in ' + self.expression)
+
+    def _truth(self, records):
+        """The truth of the expression for a list of records or a Block."""
+        if isinstance(records, Block):
+            block = records
+        else:
+            block = Block(records, self.gtab)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (len(block.records), truth(self._eval(self.tree, block)))
+
+    def evaluate(self, records):
+        n, result = self._truth(records)
+        #   A sample value passes if it is true for any sample
+        if result.ndim == 2:
+            result = result.any(axis=1)
+        return numpy.broadcast_to(result, (n, )).copy()
+
+    def per_sample(self, records):
+        n, result = self._truth(records)
+        if result.ndim < 2:
+            raise FilterError(self.expression + ' is not a sample value.')
+        return result
+
+    def _eval(self, node, block):
+        kind = node[0]
+        if kind == 'num' or kind == 'str':
+            return node[1]
+        elif kind == 'name':
+            return block.get(node[1])
+        elif kind == '&&':
+            a = truth(self._eval(node[1], block))
+            #   If most sites fail the left side, the right side is only
+            #   worked out for the ones that pass, so cheap tests put first
+            #   save parsing the samples. Otherwise, the values the block has
+            #   already worked out are used again.
+            if a.ndim == 1 and a.sum() <= len(a) // 2:
+                rows = numpy.flatnonzero(a)
+                out = numpy.zeros(a.shape, dtype=bool)
+                if len(rows):
+                    b = truth(self._eval(node[2], block.subset(rows)))
+                    if b.ndim == 2:
+                        out = numpy.zeros((len(a), b.shape[1]), dtype=bool)
+                    out[rows] = b
+                return out
+            a, b = align(a, truth(self._eval(node[2], block)))
+            return a & b
+        elif kind == '||':
+            a, b = align(
+                truth(self._eval(node[1], block)),
+                truth(self._eval(node[2], block)))
+            return a | b
+        elif kind == '!':
+            return ~truth(self._eval(node[1], block))
+        elif kind == 'cmp':
+            a, b = align(
+                self._eval(node[2], block),
+                self._eval(node[3], block))
+            if a.dtype.kind in 'OU' or b.dtype.kind in 'OU':
+                if node[1] not in ('==', '=', '!='):
+                    raise FilterError('Text can only be compared with == or '
+                                      '!=.')
+                return numpy.asarray(COMPARISONS[node[1]](a, b), dtype=bool)
+            a = number(a)
+            b = number(b)
+            res = COMPARISONS[node[1]](a, b)
+            #   Missing values fail != too
+            if node[1] == '!=':
+                res &= ~(numpy.isnan(a) | numpy.isnan(b))
+            return res
+        elif kind == 'math':
+            a, b = align(
+                self._eval(node[2], block),
+                self._eval(node[3], block))
+            return ARITHMETIC[node[1]](number(a), number(b))
+        elif kind == 'func':
+            return self._function(node[1], self._eval(node[2], block))
+        raise FilterError('Cannot evaluate ' + repr(node))
+
+    @staticmethod
+    def _function(name, x):
+        x = numpy.asarray(x)
+        if name == 'len':
+            if x.dtype.kind != 'O':
+                raise FilterError('len() is for text values, like REF.')
+            return numpy.array([len(v) for v in x], dtype=numpy.float64)
+        if name == 'count':
+            t = truth(x)
+            return t.sum(axis=-1).astype(numpy.float64) if t.ndim == 2 \
+                else t.astype(numpy.float64)
+        x = number(x)
+        #   A site value is already one number per site
+        if x.ndim < 2:
+            return x
+        nan = numpy.isnan(x)
+        n = (~nan).sum(axis=1)
+        if name == 'sum':
+            return numpy.where(nan, 0, x).sum(axis=1)
+        elif name == 'mean':
+            out = numpy.where(nan, 0, x).sum(axis=1) / n
+        elif name == 'min':
+            out = numpy.where(nan, numpy.inf, x).min(axis=1, initial=numpy.inf)
+        else:
+            out = numpy.where(nan, -numpy.inf, x).max(
+                axis=1,
+                initial=-numpy.inf)
+        out[n == 0] = numpy.nan
+        return out
+
+
+class FilterStats(object):
+    """Statistics on the sites given to a filter, to help choose its cutoffs.
+
+    criteria is a list of (name, expression) of the sites that pass each
+    criterion. For each one, the number of sites that fail it (and so it alone
+    would remove), and the number that fail only it, are counted.
+    sample_counts is a list of (name, expression) of sample values, which are
+    counted for each sample. There are also histograms of QUAL, and of DP and
+    GQ over every sample, in fixed bins; see HISTOGRAMS.
+
+    Contains the following methods:
+        add(self, block, keep)
+            Adds a Block of records, and whether each one passed the filter.
+
+        merge(self, other)
+            Adds the counts of another FilterStats with the same criteria.
+
+        write(self, fname, samples)
+            Writes the statistics, as JSON if fname ends in .json, or else as
+            a TSV of (table, name, key, value) rows.
+    """
+
+    def __init__(self, criteria, sample_counts=()):
+        self.criteria = list(criteria)
+        self.sample_counts = list(sample_counts)
+        self.filters = [Filter(expr) for _, expr in self.criteria]
+        self.sample_filters = [Filter(expr) for _, expr in self.sample_counts]
+        self.sites = 0
+        self.passed = 0
+        self.removed = numpy.zeros(len(self.criteria), dtype=numpy.int64)
+        self.only = numpy.zeros(len(self.criteria), dtype=numpy.int64)
+        self.hist = dict(
+            (name, numpy.zeros(nbins, dtype=numpy.int64))
+            for name, _, nbins
+            in HISTOGRAMS)
+        self.hist_missing = dict((name, 0) for name, _, _ in HISTOGRAMS)
+        #   sample_counts x samples, once the number of samples is known
+        self.samples = None
+
+    def add(self, block, keep):
+        n = len(block.records)
+        if n == 0:
+            return
+        self.sites += n
+        self.passed += int(keep.sum())
+        if self.filters:
+            fails = ~numpy.array([f.evaluate(block) for f in self.filters])
+            self.removed += fails.sum(axis=1)
+            self.only += (fails & (fails.sum(axis=0) == 1)).sum(axis=1)
+        for name, width, nbins in HISTOGRAMS:
+            values = block.get(name).ravel()
+            missing = numpy.isnan(values)
+            self.hist_missing[name] += int(missing.sum())
+            bins = numpy.clip(values[~missing] // width, 0, nbins - 1)
+            self.hist[name] += numpy.bincount(
+                bins.astype(numpy.int64),
+                minlength=nbins)
+        if self.sample_filters:
+            counts = numpy.array([
+                f.per_sample(block).sum(axis=0)
+                for f
+                in self.sample_filters])
+            self.samples = self._add_samples(self.samples, counts)
+
+    @staticmethod
+    def _add_samples(a, b):
+        if a is None:
+            return b.astype(numpy.int64)
+        if b is None:
+            return a
+        if a.shape != b.shape:
+            raise FilterError('Sites have different numbers of samples.')
+        return a + b
+
+    def merge(self, other):
+        self.sites += other.sites
+        self.passed += other.passed
+        self.removed += other.removed
+        self.only += other.only
+        for name, _, _ in HISTOGRAMS:
+            self.hist[name] += other.hist[name]
+            self.hist_missing[name] += other.hist_missing[name]
+        self.samples = self._add_samples(self.samples, other.samples)
+
+    def _rows(self, samples):
+        """The statistics as (table, name, key, value) rows."""
+        rows = [
+            ('summary', 'sites', '.', self.sites),
+            ('summary', 'passed', '.', self.passed)]
+        for (name, expr), removed, only in zip(
+                self.criteria,
+                self.removed.tolist(),
+                self.only.tolist()):
+            rows.append(('criterion', name, 'expression', expr))
+            rows.append(('criterion', name, 'removed', removed))
+            rows.append(('criterion', name, 'only', only))
+        for name, width, _ in HISTOGRAMS:
+            for i, c in enumerate(self.hist[name].tolist()):
+                rows.append(('histogram', name, i * width, c))
+            rows.append(
+                ('histogram', name, 'missing', self.hist_missing[name]))
+        if self.samples is not None:
+            for j, (name, _) in enumerate(self.sample_counts):
+                for s, c in zip(samples, self.samples[j].tolist()):
+                    rows.append(('sample', s, name, c))
+        return rows
+
+    def write(self, fname, samples):
+        if fname.endswith('.json'):
+            out = {
+                'sites': self.sites,
+                'passed': self.passed,
+                'criteria': [
+                    {'name': name, 'expression': expr, 'removed': removed,
+                     'only': only}
+                    for (name, expr), removed, only
+                    in zip(self.criteria, self.removed.tolist(),
+                           self.only.tolist())],
+                'histograms': dict(
+                    (name, {'bin_width': width,
+                            'counts': self.hist[name].tolist(),
+                            'missing': self.hist_missing[name]})
+                    for name, width, _
+                    in HISTOGRAMS),
+                'samples': {}}
+            if self.samples is not None:
+                for j, (name, _) in enumerate(self.sample_counts):
+                    out['samples'][name] = dict(
+                        zip(samples, self.samples[j].tolist()))
+            with open(fname, 'w') as handle:
+                json.dump(out, handle, indent=1)
+                handle.write('\n')
+            return
+        with open(fname, 'w') as handle:
+            handle.write('table\tname\tkey\tvalue\n')
+            for row in self._rows(samples):
+                handle.write('\t'.join(str(x) for x in row) + '\n')
+
+
+def filter_records(records, include=None, exclude=None):
+    """Return whether each record passes include and fails exclude."""
+    n = len(records.records) if isinstance(records, Block) else len(records)
+    keep = numpy.ones(n, dtype=bool)
+    if include is not None:
+        keep &= include.evaluate(records)
+    if exclude is not None:
+        keep &= ~exclude.evaluate(records)
+    return keep
+
+
+def filter_text(text, include=None, exclude=None, block_size=BLOCK_SIZE,
+                stats=None):
+    """Filter the VCF data lines in text, and return the ones that pass."""
+    #   Split on newlines only, the same way as reading the file does
+    lines = text.split('\n')
+    last = lines.pop()
+    records = [
+        vcf_parse.VCFRecord(line + '\n')
+        for line
+        in lines
+        if not line.startswith('#')]
+    if last and not last.startswith('#'):
+        records.append(vcf_parse.VCFRecord(last))
+    out = []
+    gtab = vcf_parse.GenotypeTable()
+    for i in range(0, len(records), block_size):
+        #   The filters and the statistics share the values of the block
+        block = Block(records[i:i+block_size], gtab)
+        keep = filter_records(block, include, exclude)
+        if stats is not None:
+            stats.add(block, keep)
+        out.extend(
+            rec.line
+            for rec, k
+            in zip(block.records, keep.tolist())
+            if k)
+    return ''.join(out)
+
+
+def init_worker(include, exclude, stats=None):
+    """Parse the expressions in a worker process."""
+    WORKER['include'] = Filter(include) if include else None
+    WORKER['exclude'] = Filter(exclude) if exclude else None
+    WORKER['stats'] = stats
+    return
+
+
+def filter_worker(text):
+    """Filter a string of VCF data lines in a worker process. With
+    statistics, returns the lines and the FilterStats of this chunk."""
+    if WORKER['stats'] is None:
+        return filter_text(text, WORKER['include'], WORKER['exclude'])
+    stats = FilterStats(*WORKER['stats'])
+    out = filter_text(
+        text,
+        WORKER['include'],
+        WORKER['exclude'],
+        stats=stats)
+    return (out, stats)
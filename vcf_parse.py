@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+"""Shared, fast reading of VCF files for the VCF scripts. Plain, gzipped, and
+bgzipped VCFs are all opened the same way. Records are parsed lazily: the
+fixed columns are split off when first needed, and the sample columns are left
+as one string until something asks for them. FORMAT strings are turned into an
+index of key -> subfield number once per distinct string, and genotype calls
+can be decoded a block of sites at a time into a NumPy array of small integer
+codes.
+
+Contains the following functions:
+    open_vcf(fname, threads=None)
+        Opens a VCF for reading as text, whether it is plain or compressed.
+        With threads, a compressed VCF is decompressed in that many other
+        threads while it is read.
+
+    format_index(fmt)
+        Returns a dictionary of FORMAT key -> subfield number for a FORMAT
+        string. Cached, since most VCFs only have a few distinct ones.
+
+    subfield_regex(idx)
+        Returns a regex that finds the idx-th subfield of every sample in the
+        sample columns of records, joined by tabs.
+
+    format_ints(records, key, width, missing=-1)
+        Returns a records x samples x width NumPy array of the integers in a
+        FORMAT subfield that holds width comma-separated values, such as AD.
+
+    parse_region(region)
+        Parses a region written as chrom, chrom:start, or chrom:start-end
+        (1-based, inclusive), into 0-based (chrom, start, end).
+
+    read_regions(bed)
+        Returns the regions in a BED file, as (chrom, start, end).
+
+    get_regions(region=None, regions_file=None)
+        Returns the regions from a --region and a --regions-file option, or
+        None if neither was given.
+
+Contains the following classes:
+    VCFRecord:      One data line of a VCF, parsed as it is used.
+    VCFReader:      Reads the header of a VCF, and then iterates over its
+                    records, one at a time or in blocks. Can be limited to a
+                    list of regions, in which case only the parts of the file
+                    that hold them are read if the VCF is bgzipped and has a
+                    .tbi or .csi index.
+    GenotypeTable:  Hands out a small integer code for each distinct genotype
+                    call, and decodes blocks of records into arrays of codes.
+
+Usage is something like:
+    with vcf_parse.VCFReader('calls.vcf.gz') as reader:
+        gtab = vcf_parse.GenotypeTable()
+        for block in reader.blocks(10000):
+            codes = gtab.decode(block)  # sites x samples array
+"""
+
+import gzip
+import re
+from bisect import bisect_left
+
+import bgzf
+import tabix_index
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#   The fixed columns of a VCF
+CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, FORMAT = range(9)
+#   FORMAT string -> {key: subfield number}. See format_index().
+FORMAT_INDEX = {}
+#   The first subfield of each sample column, from the sample columns with a
+#   tab in front. This is one pass in C, rather than a split per sample.
+FIRST_SUBFIELD = re.compile(r'\t([^\t:]*)')
+#   The end of a region that runs to the end of its sequence
+MAX_POS = 1 << 62
+#   idx -> compiled regex. See subfield_regex().
+SUBFIELD_REGEX = {}
+
+
+def open_vcf(fname, threads=None):
+    """Open a VCF for reading as text. gzip and BGZF files are recognized by
+    their first two bytes, rather than the file name. If threads is given,
+    compressed VCFs are read with a bgzf.LineReader, which decompresses in
+    other threads."""
+    with open(fname, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        if threads:
+            return bgzf.LineReader(fname, threads)
+        return gzip.open(fname, 'rt')
+    return open(fname, 'r')
+
+
+def format_index(fmt):
+    """Return a dictionary of FORMAT key -> subfield number for fmt."""
+    idx = FORMAT_INDEX.get(fmt)
+    if idx is None:
+        idx = dict((k, i) for i, k in enumerate(fmt.split(':')))
+        FORMAT_INDEX[fmt] = idx
+    return idx
+
+
+def subfield_regex(idx):
+    """Return a regex whose findall() on sample columns joined by tabs, with a
+    tab on the end, gives the idx-th subfield of each sample, or '' for a
+    sample without it. Each match takes up a whole sample, so it is one pass
+    in C with exactly one result per sample."""
+    pattern = SUBFIELD_REGEX.get(idx)
+    if pattern is None:
+        pattern = re.compile(
+            '(?:[^\\t:]*:){' + str(idx) + '}([^\\t:]*)[^\\t]*\\t|[^\\t]*\\t')
+        SUBFIELD_REGEX[idx] = pattern
+    return pattern
+
+
+def format_ints(records, key, width, missing=-1):
+    """Return a records x samples x width array of the width comma-separated
+    integers in FORMAT subfield key of each sample. Samples where it is '.',
+    does not have width values, or is not there at all, get missing, and so
+    do records without key. The records are done a FORMAT string at a time,
+    with a regex for the subfield and one conversion of all the numbers."""
+    nsamp = 0
+    by_format = {}
+    for i, rec in enumerate(records):
+        f = rec.fields()
+        if len(f) > 9:
+            nsamp = max(nsamp, f[9].count('\t') + 1)
+            by_format.setdefault(f[FORMAT], []).append(i)
+    out = numpy.full((len(records), nsamp, width), missing, dtype=numpy.int64)
+    absent = ','.join([str(missing)] * width)
+    fix = {'': absent, '.': absent}
+    for fmt, rows in by_format.items():
+        idx = format_index(fmt).get(key)
+        if idx is None:
+            continue
+        cols = '\t'.join(records[i].fields()[9] for i in rows) + '\t'
+        values = subfield_regex(idx).findall(cols)
+        if len(values) != len(rows) * nsamp:
+            raise ValueError('Records have different numbers of samples.')
+        values = list(map(fix.get, values, values))
+        joined = ','.join(values)
+        arr = None
+        if joined.count(',') == len(values) * width - 1 and '.' not in joined:
+            arr = numpy.fromstring(joined, dtype=numpy.int64, sep=',')
+        if arr is None or arr.size != len(values) * width:
+            #   Some samples are partly missing or have the wrong number of
+            #   values, so they are checked one at a time
+            arr = numpy.array(
+                [_ints(v, width, absent) for v in values],
+                dtype=numpy.int64)
+        out[rows] = arr.reshape((len(rows), nsamp, width))
+    return out
+
+
+def _ints(value, width, absent):
+    """The integers of one comma-separated value, or absent if it is not
+    width integers."""
+    parts = value.split(',')
+    if len(parts) != width:
+        parts = absent.split(',')
+    try:
+        return [int(x) for x in parts]
+    except ValueError:
+        return [int(x) for x in absent.split(',')]
+
+
+def parse_region(region):
+    """Parse a region in the form chrom, chrom:start, or chrom:start-end, with
+    1-based, inclusive coordinates, like samtools and bcftools take. Returns
+    the chromosome, and the 0-based start and end (not included). Sequence
+    names with a ':' in them are fine, as long as they do not look like a
+    range."""
+    chrom, sep, span = region.rpartition(':')
+    if sep and span:
+        try:
+            start, _, end = span.replace(',', '').partition('-')
+            start = int(start) - 1
+            end = int(end) if end else MAX_POS
+        except ValueError:
+            return (region, 0, MAX_POS)
+        if start < 0 or end <= start:
+            raise ValueError('Bad region: ' + region)
+        return (chrom, start, end)
+    return (region, 0, MAX_POS)
+
+
+def read_regions(bed):
+    """Return a list of the (chrom, start, end) regions in a BED file. Header
+    lines are skipped."""
+    regions = []
+    with open(bed, 'r') as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            tmp = line.split()
+            regions.append((tmp[0], int(tmp[1]), int(tmp[2])))
+    return regions
+
+
+def get_regions(region=None, regions_file=None):
+    """Return the list of regions from a --region and a --regions-file option,
+    or None if there were neither."""
+    if region is None and regions_file is None:
+        return None
+    regions = []
+    if region is not None:
+        regions.append(parse_region(region))
+    if regions_file is not None:
+        regions.extend(read_regions(regions_file))
+    return regions
+
+
+class VCFRecord(object):
+    """One data line of a VCF. Only the work that is asked for is done: the
+    fixed columns are split off the first time one is used, and the sample
+    columns are only split when they are used.
+
+    Contains the following methods:
+        samples(self)
+            Returns the sample columns, as a list of strings.
+
+        gt(self)
+            Returns the genotype call of each sample: the first subfield, where
+            the VCF spec puts GT.
+
+        get(self, key, missing=None)
+            Returns the FORMAT subfield key for each sample, as a list of
+            strings. Samples that do not have it give missing. If the FORMAT
+            does not have key at all, returns None.
+
+        fields(self)
+            Returns the line, stripped and split into the nine fixed columns
+            plus one string of all the sample columns. Joining it back with
+            tabs gives the stripped line.
+    """
+    __slots__ = ['line', '_fields', '_samples']
+
+    def __init__(self, line):
+        self.line = line
+        self._fields = None
+        self._samples = None
+
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.line.strip().split('\t', 9)
+        return self._fields
+
+    @property
+    def chrom(self):
+        return self.fields()[CHROM]
+
+    @property
+    def pos(self):
+        return int(self.fields()[POS])
+
+    @property
+    def id(self):
+        return self.fields()[ID]
+
+    @property
+    def ref(self):
+        return self.fields()[REF]
+
+    @property
+    def alt(self):
+        return self.fields()[ALT]
+
+    @property
+    def qual(self):
+        return self.fields()[QUAL]
+
+    @property
+    def filter(self):
+        return self.fields()[FILTER]
+
+    @property
+    def info(self):
+        return self.fields()[INFO]
+
+    @property
+    def format(self):
+        f = self.fields()
+        return f[FORMAT] if len(f) > FORMAT else ''
+
+    def samples(self):
+        if self._samples is None:
+            f = self.fields()
+            self._samples = f[9].split('\t') if len(f) > 9 else []
+        return self._samples
+
+    def gt(self):
+        if self._samples is not None:
+            return [s.partition(':')[0] for s in self._samples]
+        f = self.fields()
+        return FIRST_SUBFIELD.findall('\t' + f[9]) if len(f) > 9 else []
+
+    def get(self, key, missing=None):
+        idx = format_index(self.format).get(key)
+        if idx is None:
+            return None
+        if idx == 0:
+            return [s.partition(':')[0] for s in self.samples()]
+        out = []
+        for s in self.samples():
+            sub = s.split(':')
+            out.append(sub[idx] if idx < len(sub) else missing)
+        return out
+
+
+class VCFReader(object):
+    """Reads a VCF. The header is read when the reader is made; iterating over
+    the reader then gives a VCFRecord for each data line.
+
+    If regions, a list of 0-based (chrom, start, end), is given, only the
+    records that overlap one of them are given, in the order they are in the
+    file, and each record only once. A record covers its position and the
+    length of its REF, as in a tabix index. If the VCF has an index, only the
+    blocks that hold the regions are read; if not, every record is read and
+    checked. threads is passed on to open_vcf().
+
+    Contains the following attributes:
+        header      The meta-information lines (and any other '#' lines before
+                    the '#CHROM' line), as they are in the file.
+        chrom_line  The '#CHROM' line, as it is in the file.
+        samples     The sample names, from the '#CHROM' line.
+        index       The name of the index used for regions, or None.
+
+    Contains the following methods:
+        header_lines(self)
+            Returns all the header lines, including the '#CHROM' line.
+
+        contigs(self)
+            Returns a dictionary of contig lengths from the ##contig lines,
+            with None for contigs without a length.
+
+        blocks(self, size)
+            Yields lists of at most size records.
+
+        text_chunks(self, size)
+            Yields the data lines as strings of whole lines, of about size
+            characters each, without parsing them. Any '#' lines after the
+            header are left in.
+
+        in_regions(self, rec)
+            Returns whether a record overlaps one of the regions.
+
+        close(self)
+            Closes the file.
+    """
+
+    def __init__(self, fname, regions=None, threads=None):
+        self.fname = fname
+        self.handle = open_vcf(fname, threads)
+        self.header = []
+        self.chrom_line = None
+        self.samples = []
+        self._first = None
+        for line in self.handle:
+            if line.startswith('#CHROM'):
+                self.chrom_line = line
+                self.samples = line.strip().split('\t')[9:]
+                break
+            elif line.startswith('#'):
+                self.header.append(line)
+            else:
+                #   A VCF without a #CHROM line; keep the first record
+                self._first = line
+                break
+        #   The regions are merged, and kept for each chromosome as sorted
+        #   lists of starts and ends
+        self.regions = None
+        self.index = None
+        if regions is not None:
+            self.regions = {}
+            for chrom, start, end in sorted(regions):
+                starts, ends = self.regions.setdefault(chrom, ([], []))
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.index = tabix_index.find_index(fname)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        if self.regions is None:
+            return self._records()
+        if self.index is not None:
+            return self._fetch()
+        return (rec for rec in self._records() if self.in_regions(rec))
+
+    def _records(self):
+        """Every record in the file."""
+        if self._first is not None:
+            yield VCFRecord(self._first)
+            self._first = None
+        for line in self.handle:
+            if line.startswith('#'):
+                continue
+            yield VCFRecord(line)
+
+    def _fetch(self):
+        """The records in the regions, read through the index."""
+        idx = tabix_index.TabixIndex(self.index)
+        chunks = []
+        for chrom, (starts, ends) in self.regions.items():
+            for start, end in zip(starts, ends):
+                chunks.extend(idx.chunks(chrom, start, end))
+        for line in bgzf.read_chunks(
+                self.fname,
+                tabix_index.merge_chunks(chunks)):
+            if line.startswith('#'):
+                continue
+            rec = VCFRecord(line)
+            #   The chunks hold every record in the bins that overlap the
+            #   regions, so some are outside them
+            if self.in_regions(rec):
+                yield rec
+
+    def in_regions(self, rec):
+        spans = self.regions.get(rec.chrom)
+        if spans is None:
+            return False
+        starts, ends = spans
+        start = rec.pos - 1
+        #   The last region that starts before the record ends
+        i = bisect_left(starts, start + len(rec.ref)) - 1
+        return i >= 0 and ends[i] > start
+
+    def header_lines(self):
+        if self.chrom_line is None:
+            return list(self.header)
+        return self.header + [self.chrom_line]
+
+    def contigs(self):
+        contigs = {}
+        for line in self.header:
+            if line.startswith('##contig=<'):
+                fields = dict(
+                    x.split('=', 1)
+                    for x
+                    in line.strip()[10:-1].split(',')
+                    if '=' in x)
+                if 'ID' in fields:
+                    contigs[fields['ID']] = \
+                        int(fields.get('length', 0)) or None
+        return contigs
+
+    def blocks(self, size):
+        block = []
+        for rec in self:
+            block.append(rec)
+            if len(block) == size:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    def text_chunks(self, size):
+        #   With regions, the records have to be looked at; otherwise, the
+        #   file is read in big pieces, which are finished off at the end of
+        #   a line
+        if self.regions is not None or not hasattr(self.handle, 'read'):
+            chunk = []
+            n = 0
+            for rec in self:
+                chunk.append(rec.line)
+                n += len(rec.line)
+                if n >= size:
+                    yield ''.join(chunk)
+                    chunk = []
+                    n = 0
+            if chunk:
+                yield ''.join(chunk)
+            return
+        first = self._first or ''
+        self._first = None
+        while True:
+            text = self.handle.read(size)
+            if not text:
+                break
+            if not text.endswith('\n'):
+                text += self.handle.readline()
+            yield first + text
+            first = ''
+        if first:
+            yield first
+
+    def close(self):
+        self.handle.close()
+
+
+class GenotypeTable(object):
+    """Hands out a small integer code for each distinct genotype call string,
+    in the order they are first seen. Scripts can work out what they need
+    (is it heterozygous, which alleles, etc.) once per code, and then apply it
+    to whole arrays of codes. Subclasses can override added() to do this as
+    each new call is seen.
+
+    Contains the following methods:
+        code(self, gt)
+            Returns the code for a call string.
+
+        decode(self, records)
+            Returns a records x samples NumPy array of the codes of the calls
+            of a list of VCFRecords.
+
+        alleles(self, code)
+            Returns the alleles of a call as a list of integers, with None for
+            missing alleles. Both '/' and '|' separate alleles.
+
+        lookup(self, func, dtype)
+            Returns a NumPy array of func(call string) for every code, to be
+            indexed with an array of codes.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.genotypes = []
+
+    def code(self, gt):
+        c = self.codes.get(gt)
+        if c is None:
+            c = len(self.genotypes)
+            self.codes[gt] = c
+            self.genotypes.append(gt)
+            self.added(gt)
+        return c
+
+    def added(self, gt):
+        """Called with each new call string, after it has its code."""
+        return
+
+    def decode(self, records):
+        get = self.codes.get
+        flat = []
+        nsamp = 0
+        for rec in records:
+            gts = rec.gt()
+            row = list(map(get, gts))
+            if None in row:
+                row = [self.code(g) for g in gts]
+            flat.extend(row)
+            nsamp = len(row)
+        #   One flat list converts to an array much faster than a list of rows
+        return numpy.array(flat, dtype=numpy.int32).reshape(
+            (len(records), nsamp))
+
+    def alleles(self, code):
+        gt = self.genotypes[code]
+        return [
+            None if a == '.' else int(a)
+            for a
+            in gt.replace('|', '/').split('/')]
+
+    def lookup(self, func, dtype=None):
+        return numpy.array([func(g) for g in self.genotypes], dtype=dtype)